@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from pulp import models
+
+
+class Command(BaseCommand):
+    help = 'Recount the content units in repositories, repairing any drift in the stored counts'
+
+    def add_arguments(self, parser):
+        parser.add_argument('repositories', nargs='*', metavar='slug',
+                            help='Repositories to recount, defaults to all repositories')
+
+    def handle(self, *args, **options):
+        repositories = models.Repository.objects.all()
+        if options['repositories']:
+            repositories = repositories.filter(slug__in=options['repositories'])
+            models.RepositoryContentUnitCount.objects.rebuild(repositories)
+        else:
+            models.RepositoryContentUnitCount.objects.rebuild()
+        self.stdout.write('Rebuilt content unit counts for {} repositories'.format(
+            repositories.count()))
@@ -0,0 +1,133 @@
+import hashlib
+import os
+import time
+from collections import Counter
+from concurrent.futures import (FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor,
+                                wait)
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.db.models import Q
+from django.utils import timezone
+
+from pulp.models import BULK_CHUNK_SIZE, ContentUnitFile
+from pulp.utils import VERIFY_MISSING, stream_rows, verify_file
+
+
+class Command(BaseCommand):
+    help = ('Check stored content unit files against their recorded sizes and checksums, '
+            'recording the results on each ContentUnitFile')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                            help='Number of files to check at once, defaults to the CPU count')
+        parser.add_argument('--processes', action='store_true',
+                            help='Check files in worker processes rather than threads')
+        parser.add_argument('--older-than', type=float, metavar='HOURS',
+                            help='Also check files last verified more than HOURS ago. By default, '
+                                 'only files that have never been verified are checked.')
+        parser.add_argument('--all', action='store_true', help='Check every file')
+        parser.add_argument('--batch-size', type=int, default=BULK_CHUNK_SIZE,
+                            help='Number of results recorded by each UPDATE')
+        parser.add_argument('--progress-interval', type=float, default=10, metavar='SECONDS',
+                            help='How often to report progress')
+
+    def handle(self, *args, **options):
+        # Files are streamed from the DB with a server-side cursor and checked by a pool of
+        # workers, with at most two files per worker in flight so that reading ahead doesn't
+        # outrun the disks. Results are written batch_size at a time as they come in, so an
+        # interrupted run picks up where it left off when it's started again, since the files
+        # it already checked are no longer unverified (or verified too long ago).
+        queryset = ContentUnitFile.objects.order_by()
+        if not options['all']:
+            unverified = Q(verified__isnull=True)
+            if options['older_than'] is not None:
+                cutoff = timezone.now() - timedelta(hours=options['older_than'])
+                unverified |= Q(verified__lt=cutoff)
+            queryset = queryset.filter(unverified)
+        hash_fields = [field.name for field in ContentUnitFile._meta.fields
+                       if field.name in hashlib.algorithms_guaranteed]
+        # held, since results are committed as they come in (see stream_sql)
+        rows = stream_rows(queryset.values_list('pk', 'content', 'file_size', *hash_fields),
+                           hold=True)
+
+        self.statuses = Counter()
+        self.files = 0
+        self.bytes = 0
+        self.started = self.reported = time.monotonic()
+        self.progress_interval = options['progress_interval']
+        results = []
+
+        storage = ContentUnitFile._meta.get_field('content').storage
+        workers = max(options['workers'], 1)
+        executor_class = ProcessPoolExecutor if options['processes'] else ThreadPoolExecutor
+        with executor_class(max_workers=workers) as executor:
+            in_flight = {}
+            for row in rows:
+                pk, name, size, digests = row[0], row[1], row[2], row[3:]
+                if not name:
+                    self.record(results, pk, VERIFY_MISSING, 0, options['batch_size'])
+                    continue
+                algorithm, digest = self.best_checksum(hash_fields, digests)
+                future = executor.submit(
+                    verify_file, storage.path(name), size, algorithm, digest)
+                in_flight[future] = pk
+                while len(in_flight) >= workers * 2:
+                    done, pending = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        self.record(results, in_flight.pop(future), *future.result(),
+                                    batch_size=options['batch_size'])
+            for future in list(in_flight):
+                self.record(results, in_flight.pop(future), *future.result(),
+                            batch_size=options['batch_size'])
+        self.write_results(results)
+        self.report(final=True)
+
+    def best_checksum(self, hash_fields, digests):
+        # same as ContentUnitFile.best_checksum, the longest digest
+        checksums = [(field, digest) for field, digest in zip(hash_fields, digests) if digest]
+        if not checksums:
+            return None, None
+        return max(checksums, key=lambda checksum: len(checksum[1]))
+
+    def record(self, results, pk, status, hashed, batch_size):
+        results.append((pk, status))
+        self.statuses[status] += 1
+        self.files += 1
+        self.bytes += hashed
+        if len(results) >= batch_size:
+            self.write_results(results)
+        if time.monotonic() - self.reported >= self.progress_interval:
+            self.report()
+
+    def write_results(self, results):
+        # one UPDATE for the whole batch, all verified at the same time
+        if not results:
+            return
+        opts = ContentUnitFile._meta
+        sql = (
+            'UPDATE {table} AS target SET {verified} = %s, {status} = results.status '
+            'FROM (VALUES {values}) AS results (pk, status) WHERE target.{pk} = results.pk'
+        ).format(
+            table=opts.db_table,
+            verified=opts.get_field('verified').column,
+            status=opts.get_field('verify_status').column,
+            pk=opts.pk.column,
+            values=', '.join(['(%s::uuid, %s)'] * len(results)),
+        )
+        params = [timezone.now()]
+        for pk, status in results:
+            params.extend((pk, status))
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+        del results[:]
+
+    def report(self, final=False):
+        self.reported = time.monotonic()
+        elapsed = max(self.reported - self.started, 0.001)
+        statuses = ', '.join('{} {}'.format(count, status)
+                             for status, count in sorted(self.statuses.items()))
+        message = '{} files ({}), {:.1f} MB hashed at {:.1f} MB/s, {:.0f}s elapsed'.format(
+            self.files, statuses or 'none', self.bytes / 1e6, self.bytes / 1e6 / elapsed, elapsed)
+        self.stdout.write(('Verified ' if final else '') + message)
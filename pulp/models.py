@@ -1,18 +1,77 @@
 import hashlib
+import sys
+import threading
 import uuid
+from datetime import timedelta
 from hashlib import sha256
-from collections import abc, namedtuple
+from collections import abc, defaultdict, namedtuple
+from operator import attrgetter
 
 from django.contrib.contenttypes.fields import GenericRelation, GenericForeignKey
 from django.contrib.contenttypes.models import ContentType
-from django.db import models
-from django.db.models import signals
+from django.core.exceptions import FieldDoesNotExist
+from django.db import connections, models, transaction
+from django.db.models import Count, signals
+from django.dispatch import Signal
+from django.db.models.expressions import RawSQL
 from django.utils import timezone
 
-from pulp.storage import content_unit_path
+from pulp.storage import content_storage
+from pulp.utils import (HASH_CHUNK_SIZE, VERIFY_CORRUPT, VERIFY_MISSING, VERIFY_OK, chunked,
+                        digest_chunks, stream_rows, verify_file)
 
 Checksum = namedtuple('Checksum', ('algorithm', 'digest'))
 
+# Results of the bulk association methods on RepositoryContentUnit.objects, so callers
+# (e.g. sync) can report progress without counting the repository contents again
+Associated = namedtuple('Associated', ('added', 'skipped'))
+Disassociated = namedtuple('Disassociated', ('removed', 'skipped'))
+
+# Result of RepositoryContentUnit.objects.diff: {content type: count} dicts of the units
+# that would be added and removed to turn one repository's content into another's
+RepositoryDiff = namedtuple('RepositoryDiff', ('added', 'removed'))
+
+# Result of Repository.changes_since, see there
+RepositoryChanges = namedtuple('RepositoryChanges', ('changed', 'added', 'removed', 'watermark'))
+
+# How long a transaction that changes repository content can take to commit, at most. Changes
+# are timestamped before their transaction commits, so Repository.changes_since keeps its
+# watermarks at least this far in the past, so that a change that commits late is still newer
+# than the watermark the next time around.
+CHANGES_LAG = timedelta(minutes=10)
+
+# Number of rows written by each set-based statement in the bulk association methods.
+# Postgres is happy with much larger statements than this, but keeping them bounded keeps
+# the statement size (and the number of parameters) sane for huge repositories.
+BULK_CHUNK_SIZE = 1000
+
+
+def _uuid4_sql(seed):
+    # SQL for a new random (version 4) UUID, for primary keys of rows inserted by INSERT ...
+    # SELECT, where they can't come from uuid.uuid4 like everywhere else. Postgres doesn't have
+    # a uuid4 function without an extension, so the random bits come from hashing random data,
+    # along with seed (an SQL expression, e.g. a column of the row) so rows inserted in the
+    # same instant by the same statement don't collide, and then the version and variant bits
+    # are set the same way uuid4 does.
+    return (
+        "overlay(overlay(md5(random()::text || clock_timestamp()::text || ({})::text) "
+        "placing '4' from 13) "
+        "placing substr('89ab', floor(random() * 4)::int + 1, 1) from 17)::uuid"
+    ).format(seed)
+
+# Sent by RepositoryChangeTracker after it writes its changes, as the last thing in the
+# transaction that made them, so that plugins can keep data derived from repository content
+# (e.g. pulp_rpm's errata package links) up to date. changed is a {repository pk: set of
+# content types} dict of the types of units added to or removed from each repository, where
+# None in the set means units of unknown types changed. units is a {repository pk: set of unit
+# pks} dict of the units added to or removed from each repository, with None rather than a set
+# when they aren't known (e.g. after set-based operations, or too many to keep track of).
+repository_content_changed = Signal(providing_args=['changed', 'units', 'using'])
+
+# Most unit pks a RepositoryChangeTracker keeps for one repository, for the units argument of
+# repository_content_changed. Past this, the repository's changed units count as unknown.
+TRACKED_UNITS_LIMIT = 10000
+
 
 class UUIDModel(models.Model):
     # plain old django model, with a UUID PK.
@@ -52,6 +111,74 @@ class GenericModel(models.Model):
 
     class Meta:
         abstract = True
+        # every lookup through a GenericRelation filters on both of these
+        index_together = [('content_type', 'object_id')]
+
+
+# Database aliases that have had all of their ContentTypes loaded into the ContentTypeManager cache
+_content_types_warmed = set()
+
+
+def get_content_type(model, for_concrete_model=True, using='default'):
+    # ContentType.objects caches lookups for the life of the process, but fills that cache one
+    # query per model. The first lookup here loads every ContentType with one query, so that
+    # generic relation lookups for any model after that never need to ask the DB for them.
+    manager = ContentType.objects.db_manager(using)
+    if using not in _content_types_warmed:
+        for content_type in manager.all():
+            manager._add_to_cache(using, content_type)
+        _content_types_warmed.add(using)
+    return manager.get_for_model(model, for_concrete_model=for_concrete_model)
+
+
+def prefetch_generic(parents, *relations):
+    # Like prefetch_related for GenericRelations, but parents can be a mix of models, e.g. all of
+    # the groups, categories, and environments in a comps document. Each named relation is
+    # loaded for every parent model that has it, with one query per related model, so
+    # prefetch_generic(groups + categories, 'translated_name', 'grouplist') is two queries
+    # no matter how many parents there are. Parent models without a relation are skipped.
+    # Results go into each parent's prefetch cache, so parent.translated_name.all() (and a
+    # cached_mapping, for GenericKeyValueStores) uses them without querying again.
+    parents = list(parents)
+    # {related model: {relation name: {(content type id, object id): parent}}}
+    lookups = defaultdict(lambda: defaultdict(dict))
+    for parent in parents:
+        for name in relations:
+            try:
+                field = parent._meta.get_field(name)
+            except FieldDoesNotExist:
+                continue
+            if not isinstance(field, GenericRelation):
+                raise ValueError('{} is not a GenericRelation on {}'.format(
+                    name, parent._meta.object_name))
+            content_type = get_content_type(type(parent), field.for_concrete_model)
+            lookups[field.related_model][name][(content_type.pk, parent.pk)] = parent
+
+    for related_model, by_name in lookups.items():
+        keys = set()
+        for parent_keys in by_name.values():
+            keys.update(parent_keys)
+        rows = defaultdict(list)
+        # content types and object ids are matched up below, since the parents of a
+        # content type and their object ids are filtered separately here
+        related = related_model._default_manager.filter(
+            content_type__in=set(key[0] for key in keys),
+            object_id__in=set(key[1] for key in keys),
+        )
+        for row in related:
+            rows[(row.content_type_id, row.object_id)].append(row)
+
+        for name, parent_keys in by_name.items():
+            for key, parent in parent_keys.items():
+                if not hasattr(parent, '_prefetched_objects_cache'):
+                    parent._prefetched_objects_cache = {}
+                manager = getattr(parent, name)
+                parent._prefetched_objects_cache.pop(manager.prefetch_cache_name, None)
+                queryset = manager.get_queryset()
+                queryset._result_cache = rows.get(key, [])
+                queryset._prefetch_done = True
+                parent._prefetched_objects_cache[manager.prefetch_cache_name] = queryset
+    return parents
 
 
 class GenericKeyValueMutableMapping(abc.MutableMapping):
@@ -64,32 +191,113 @@ class GenericKeyValueMutableMapping(abc.MutableMapping):
     # __len__ falls back to the manager's count method rather than evaluating the queryset iterable
     # __iter__ returns a generator of keys (like dict does)
     # __repr__ includes the model name, and falls back to dict.__repr__ for the contents
-    def __init__(self, manager):
+    # update/bulk_set write any number of keys with one upsert, and bulk_delete removes any
+    # number of keys with one delete, e.g. r.notes.mapping.update({'k1': 'v1', 'k2': 'v2'})
+    #
+    # With cached=True (e.g. r.notes.cached_mapping), all of the keys and values are loaded
+    # with one query the first time any of them are needed, or taken from the prefetch cache if
+    # the relation was prefetched, e.g. Repository.objects.prefetch_related('notes'). Reads are
+    # then served from memory, and writes and deletes are buffered until flush is called,
+    # which saves them with at most two queries. Used as a context manager, a cached mapping
+    # flushes when the block exits without an error:
+    #     with importer.config.cached_mapping as config:
+    #         config['key'] = 'value'
+    def __init__(self, manager, cached=False):
         self.manager = manager
+        self.cached = cached
+        self._cache = None
+        # buffered writes ({key: value}) and deletes (set of keys) for cached mappings
+        self._pending_set = {}
+        self._pending_delete = set()
 
     def __getitem__(self, key):
+        if self.cached:
+            return self._items()[key]
         return self.manager.get(key=key).value
 
     def __setitem__(self, key, value):
         # The underlying field is a textfield, so the value will be coerced to str when saved
-        try:
-            item = self.manager.get(key=key)
-            item.value = value
-            item.save()
-        except self.manager.model.DoesNotExist:
-            item = self.manager.create(key=key, value=value)
+        self.bulk_set({key: value})
 
     def __delitem__(self, key):
-        return self.manager.filter(key=key).delete()
+        if self.cached and key not in self._items():
+            raise KeyError(key)
+        self.bulk_delete([key])
 
     def __iter__(self):
+        if self.cached:
+            return iter(list(self._items()))
         return (kv.key for kv in self.manager.all())
 
     def __len__(self):
+        if self.cached:
+            return len(self._items())
         return self.manager.count()
 
     def __repr__(self):
-        return '{}({})'.format(self.manager.model._meta.object_name, repr(dict(self)))
+        if self.cached:
+            contents = self._items()
+        else:
+            # one query for the whole thing, rather than one per key
+            contents = dict(self.manager.values_list('key', 'value'))
+        return '{}({})'.format(self.manager.model._meta.object_name, repr(contents))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+
+    def update(*args, **kwargs):
+        # Same signature as dict.update, but all of the keys are written together
+        if not args:
+            raise TypeError('update() needs a mapping instance')
+        self, args = args[0], args[1:]
+        self.bulk_set(dict(*args, **kwargs))
+
+    def bulk_set(self, items):
+        # Write a {key: value} dict, one upsert statement for the whole thing
+        if self.cached:
+            items = {key: str(value) for key, value in items.items()}
+            self._items().update(items)
+            self._pending_set.update(items)
+            self._pending_delete.difference_update(items)
+        else:
+            self.manager.bulk_set(items)
+
+    def bulk_delete(self, keys):
+        # Delete any number of keys with one statement. Keys that aren't set are ignored.
+        keys = set(keys)
+        if self.cached:
+            cache = self._items()
+            for key in keys:
+                cache.pop(key, None)
+                self._pending_set.pop(key, None)
+            self._pending_delete.update(keys)
+        else:
+            self.manager.bulk_delete(keys)
+
+    def _items(self):
+        if self._cache is None:
+            self._cache = {kv.key: kv.value for kv in self.manager.all()}
+        return self._cache
+
+    def flush(self):
+        # Write buffered changes for cached mappings, one upsert for all of the
+        # new and changed keys, and one delete for all of the deleted keys
+        if self._pending_set:
+            self.manager.bulk_set(self._pending_set)
+        if self._pending_delete:
+            self.manager.bulk_delete(self._pending_delete)
+        self._pending_set = {}
+        self._pending_delete = set()
+
+    def refresh(self):
+        # Drop the cache (and any unflushed changes) so it's loaded again on next access
+        self._cache = None
+        self._pending_set = {}
+        self._pending_delete = set()
 
 
 class GenericKeyValueManager(models.Manager):
@@ -98,6 +306,60 @@ class GenericKeyValueManager(models.Manager):
     def mapping(self):
         return GenericKeyValueMutableMapping(self)
 
+    @property
+    def cached_mapping(self):
+        # A caching GenericKeyValueMutableMapping. Related managers (e.g. repository.notes)
+        # are created on every attribute access, so the mapping is kept on the related
+        # instance, which lets every access through that instance share the same cache.
+        instance = getattr(self, 'instance', None)
+        if instance is None:
+            return GenericKeyValueMutableMapping(self, cached=True)
+        mappings = instance.__dict__.setdefault('_cached_mappings', {})
+        if self.prefetch_cache_name not in mappings:
+            mappings[self.prefetch_cache_name] = GenericKeyValueMutableMapping(self, cached=True)
+        return mappings[self.prefetch_cache_name]
+
+    def bulk_set(self, items):
+        # Write a {key: value} dict for the related instance, inserting new keys and updating
+        # the values of existing ones. Each chunk of keys is one statement, and conflicts on the
+        # unique constraint are resolved by the database, so concurrent writers can't collide.
+        # Only works on related managers, which know the content type and object id to write.
+        if getattr(self, 'instance', None) is None:
+            raise TypeError('bulk_set needs a related manager, e.g. repository.notes')
+        for chunk in chunked(items.items(), BULK_CHUNK_SIZE):
+            self._upsert(chunk)
+
+    def bulk_delete(self, keys):
+        # Delete all of the given keys with one statement
+        keys = list(keys)
+        if keys:
+            self.filter(key__in=keys).delete()
+
+    def _upsert(self, items):
+        # items is a list of (key, value) pairs, with no repeated keys
+        opts = self.model._meta
+        key = opts.get_field('key').column
+        content_type = opts.get_field('content_type').column
+        object_id = opts.get_field('object_id').column
+        value = opts.get_field('value').column
+        sql = (
+            'INSERT INTO {table} ({key}, {value}, {content_type}, {object_id}) VALUES {values} '
+            'ON CONFLICT ({key}, {content_type}, {object_id}) '
+            'DO UPDATE SET {value} = EXCLUDED.{value}'
+        ).format(
+            table=opts.db_table,
+            key=key,
+            value=value,
+            content_type=content_type,
+            object_id=object_id,
+            values=', '.join(['(%s, %s, %s, %s)'] * len(items)),
+        )
+        params = []
+        for item_key, item_value in items:
+            params.extend((item_key, str(item_value), self.content_type.pk, self.pk_val))
+        with connections[self.db].cursor() as cursor:
+            cursor.execute(sql, params)
+
 
 class GenericKeyValueStore(GenericModel):
     key = models.CharField(max_length=255)
@@ -107,7 +369,7 @@ class GenericKeyValueStore(GenericModel):
     # have access to the mapping attr
     objects = GenericKeyValueManager()
 
-    class Meta:
+    class Meta(GenericModel.Meta):
         abstract = True
         unique_together = ('key', 'content_type', 'object_id')
 
@@ -129,6 +391,40 @@ class Scratchpad(GenericKeyValueStore):
     pass
 
 
+class RepositoryQuerySet(models.QuerySet):
+    def with_content_unit_counts(self):
+        # Annotate each repository with its content_unit_counts dict, read from the materialized
+        # counts by a correlated subquery, so that listing repositories with their counts is a
+        # single query. Repositories with no units are annotated with None.
+        repo_opts = self.model._meta
+        counts_opts = RepositoryContentUnitCount._meta
+        sql = (
+            'SELECT json_object_agg(counts.{content_type}, counts.{count}) '
+            'FROM {counts_table} AS counts '
+            'WHERE counts.{repository} = {repo_table}.{repo_pk} AND counts.{count} > 0'
+        ).format(
+            counts_table=counts_opts.db_table,
+            content_type=counts_opts.get_field('content_type').column,
+            count=counts_opts.get_field('count').column,
+            repository=counts_opts.get_field('repository').column,
+            repo_table=repo_opts.db_table,
+            repo_pk=repo_opts.pk.column,
+        )
+        # psycopg2 decodes the json into a dict, so the TextField output_field is just there
+        # to keep django from trying to convert it into anything else
+        return self.annotate(annotated_unit_counts=RawSQL(sql, (), output_field=models.TextField()))
+
+    def delete(self):
+        # Deleting repositories cascades to their unit associations, and each of those would
+        # otherwise try to update its repository's timestamps and log its removal on the way
+        # out, one tracker flush per association. In one tracker, all of that is written once,
+        # after the repositories are gone, so the removals are dropped along with them.
+        with RepositoryChangeTracker(using=self.db):
+            return super(RepositoryQuerySet, self).delete()
+    delete.alters_data = True
+    delete.queryset_only = True
+
+
 class Repository(UUIDModel, Slugged):
     # Mongo repo_id goes in the slug field
     display_name = models.CharField(max_length=255, blank=True, default='')
@@ -137,10 +433,13 @@ class Repository(UUIDModel, Slugged):
     units = models.ManyToManyField('ContentUnit', related_name='repositories',
                                    through='RepositoryContentUnit')
 
+    objects = RepositoryQuerySet.as_manager()
+
     notes = GenericRelation(Notes)
     _scratchpad = GenericRelation(Scratchpad)
 
-    # these get populated by signals attached to the units relation
+    # these get populated by signals attached to the units relation, and by the bulk
+    # association methods on RepositoryContentUnit.objects, by way of RepositoryChangeTracker
     last_unit_added = models.DateTimeField(blank=True, null=True)
     last_unit_removed = models.DateTimeField(blank=True, null=True)
 
@@ -155,19 +454,84 @@ class Repository(UUIDModel, Slugged):
 
     # Normally you'd just repo.units.add/.remove, but Django disables this when using
     # a through model, so these are here to help making units a little easier.
+    # Units can be ContentUnit instances (of any type) or their PKs. To associate the results
+    # of a query, pass the queryset to RepositoryContentUnit.objects.associate directly.
     def add_units(self, *units):
-        for unit in units:
-            RepositoryContentUnit.objects.get_or_create(repository=self, content_unit=unit)
+        return RepositoryContentUnit.objects.associate(self, units)
 
     def remove_units(self, *units):
-        RepositoryContentUnit.objects.filter(repository=self, content_unit__in=units).delete()
+        return RepositoryContentUnit.objects.disassociate(self, units)
+
+    # Shortcuts for the set operations on RepositoryContentUnit.objects, see those for details
+    def copy_units_to(self, target, units=None, content_types=None):
+        return RepositoryContentUnit.objects.copy(self, target, units, content_types)
+
+    def diff(self, other, content_types=None):
+        return RepositoryContentUnit.objects.diff(self, other, content_types)
+
+    def create_version(self):
+        # see RepositoryVersionManager.create_version
+        return RepositoryVersion.objects.create_version(self)
+
+    def changes_since(self, watermark=None):
+        # The repository's content changes since watermark, for incremental publishing, as
+        # RepositoryChanges:
+        #   changed: whether there's anything to do at all
+        #   added: ContentUnits added to (or re-saved in) the repository since watermark
+        #   removed: PKs of units removed since watermark that aren't in the repository now,
+        #     including units that have since been deleted entirely
+        #   watermark: what to pass as watermark next time
+        # With no watermark, everything in the repository is added. When nothing has changed,
+        # which is decided from the repository's last_unit_added and last_unit_removed without
+        # looking at the units at all, added and removed are empty querysets that don't query.
+        # Changes are timestamped before their transactions commit, so one can commit after a
+        # newer one that was already seen. The returned watermark is never less than CHANGES_LAG
+        # ago, so recent changes are returned again next time, along with any that committed
+        # late. Consumers need to be fine with seeing the same change more than once.
+        db = self._state.db
+        stamps = Repository.objects.using(db).filter(pk=self.pk).values_list(
+            'last_unit_added', 'last_unit_removed').get()
+        stamps = [stamp for stamp in stamps if stamp is not None]
+        latest = max(stamps) if stamps else None
+        units = ContentUnit.objects.using(db)
+        removals = RepositoryContentUnitRemoval.objects.using(db)
+        if latest is None or (watermark is not None and latest <= watermark):
+            return RepositoryChanges(False, units.none(),
+                                     removals.none().values_list('unit_pk', flat=True),
+                                     watermark if watermark is not None else latest)
+
+        associations = RepositoryContentUnit.objects.using(db).filter(repository=self)
+        changed = associations.filter(updated__lte=latest)
+        removals = removals.filter(repository=self, removed__lte=latest)
+        if watermark is None:
+            removals = removals.none()
+        else:
+            changed = changed.filter(updated__gt=watermark)
+            removals = removals.filter(removed__gt=watermark)
+        added = units.filter(pk__in=changed.values('content_unit'))
+        removed = removals.exclude(unit_pk__in=associations.values('content_unit')).values_list(
+            'unit_pk', flat=True).distinct()
+        # held back by CHANGES_LAG, but never moved back from the watermark given
+        next_watermark = min(latest, timezone.now() - CHANGES_LAG)
+        if watermark is not None:
+            next_watermark = max(next_watermark, watermark)
+        return RepositoryChanges(True, added, removed, next_watermark)
+
+    def delete(self, *args, **kwargs):
+        # Deleting a repository cascades to its unit associations, and each of those would
+        # otherwise try to update this repository's timestamps on the way out
+        with RepositoryChangeTracker(using=kwargs.get('using')):
+            return super(Repository, self).delete(*args, **kwargs)
 
     @property
     def content_unit_counts(self):
-        # This was a field in mongo, but through annotation can be derived by postgres
-        unit_counts = self.units.values('content_type').annotate(
-            count=models.Count('content_type'))
-        return {c['content_type']: c['count'] for c in unit_counts}
+        # This was a field in mongo, and is materialized again in RepositoryContentUnitCount,
+        # which is kept up to date as units are added and removed. When listing repositories,
+        # Repository.objects.with_content_unit_counts() gets them in the same query.
+        try:
+            return self.annotated_unit_counts or {}
+        except AttributeError:
+            return {c.content_type: c.count for c in self.unit_counts.all() if c.count}
 
     @classmethod
     def from_repository(cls, repository):
@@ -196,11 +560,113 @@ class Importer(UUIDModel):
 class ContentUnitQuerySet(models.QuerySet):
     # a normal django queryset, but adds the 'cast' method
     # to the DSL, which runs the cast method on the current queryset
-    def cast(self):
-        return (instance.cast() for instance in self)
-
-# Make a Manager based on the cast-aware queryset
-ContentUnitManager = models.Manager.from_queryset(ContentUnitQuerySet)
+    def cast(self, chunk_size=BULK_CHUNK_SIZE, stream=False):
+        # Rather than calling cast on each unit, which is a query per unit, units are cast in
+        # chunks: the units in each chunk are grouped by content type, and each detail type is
+        # fetched with one query. The cast units are yielded in the same order as the queryset.
+        # With stream=True, the queryset is read with a server-side cursor and only one chunk
+        # of units is in memory at a time, which is the way to go for very large repositories.
+        # Otherwise, the queryset is evaluated (and cached) as usual.
+        if stream:
+            rows = ((pk, content_type, None) for pk, content_type in
+                    stream_rows(self.values_list('pk', 'content_type'), chunk_size))
+        else:
+            rows = ((unit.pk, unit.content_type, unit) for unit in self)
+
+        for chunk in chunked(rows, chunk_size):
+            for unit in self._cast_chunk(chunk):
+                yield unit
+
+    def _cast_chunk(self, chunk):
+        # chunk is a list of (pk, content_type, unit) tuples, where unit is the uncast instance
+        # if it's been loaded already, or None if not.
+        pks_by_type = defaultdict(list)
+        for pk, content_type, unit in chunk:
+            if unit is None or unit._get_content_type() != content_type:
+                pks_by_type[content_type].append(pk)
+
+        cast_units = {}
+        for content_type, pks in pks_by_type.items():
+            # Unknown types come back as generic ContentUnits, same as ContentUnit.cast
+            model = ContentUnit.detail_model(content_type) or ContentUnit
+            cast_units.update(model._default_manager.using(self.db).in_bulk(pks))
+
+        for pk, content_type, unit in chunk:
+            unit = cast_units.get(pk, unit)
+            # unit can only be None here if it was deleted while streaming
+            if unit is not None:
+                yield unit
+
+    def delete(self):
+        # Deleting units cascades to their repository associations, so coalesce
+        # the resulting repository timestamp updates
+        with RepositoryChangeTracker(using=self.db):
+            return super(ContentUnitQuerySet, self).delete()
+    delete.alters_data = True
+    delete.queryset_only = True
+
+# Make a Manager based on the cast-aware queryset. Django 1.8 doesn't inherit managers from
+# concrete parents, so detail models need to declare objects = ContentUnitManager() themselves,
+# otherwise e.g. RPM.objects.filter(...).delete() skips ContentUnitQuerySet.delete.
+class ContentUnitManager(models.Manager.from_queryset(ContentUnitQuerySet)):
+    def bulk_ingest(self, units, chunk_size=BULK_CHUNK_SIZE):
+        # Save many new content units at once. units is an iterable of unsaved detail unit
+        # instances (RPM, SRPM, Distribution, etc), which can be a mix of types. For each chunk,
+        # the key digests are computed in python, the digests already in the DB are found with
+        # one query, and only the new units are inserted, with one bulk insert for the master
+        # ContentUnit rows plus one per detail type. Returns the PK of every unit in the same
+        # order as units, which is the PK of the existing unit for units that were already known.
+        # Like bulk_create, this skips save() and the save signals.
+        # XXX Two ingests racing to insert the same new unit will cause one of them to fail on the
+        #     key_digest unique constraint, so concurrent syncs need to be prepared to retry.
+        pks = []
+        with transaction.atomic(using=self.db):
+            for chunk in chunked(units, chunk_size):
+                pks.extend(self._ingest_chunk(chunk))
+        return pks
+
+    def _ingest_chunk(self, units):
+        for unit in units:
+            unit.content_type = unit._get_content_type()
+            if ContentUnit not in unit._meta.parents:
+                # the same as in ContentUnit.save, but also catches types that don't inherit
+                # directly from ContentUnit, which can't be inserted with a single detail row
+                raise Exception('bulk_ingest only works with direct ContentUnit subclasses.')
+            unit.prepare_fields()
+            unit.key_digest = unit.hash_key()
+
+        digests = set(unit.key_digest for unit in units)
+        known = dict(ContentUnit.objects.using(self.db).filter(
+            key_digest__in=digests).values_list('key_digest', 'pk'))
+
+        new_units = defaultdict(list)
+        for unit in units:
+            if unit.key_digest in known:
+                continue
+            # UUIDModel assigns the pk when the instance is created, so the new master and detail
+            # rows can be linked up before either one is inserted
+            parent_link = unit._meta.parents[ContentUnit]
+            setattr(unit, parent_link.attname, unit.uuid)
+            known[unit.key_digest] = unit.uuid
+            new_units[type(unit)].append(unit)
+
+        masters = []
+        for model_units in new_units.values():
+            masters.extend(ContentUnit(uuid=unit.uuid, content_type=unit.content_type,
+                                       key_digest=unit.key_digest) for unit in model_units)
+        ContentUnit.objects.using(self.db).bulk_create(masters)
+
+        # Django's bulk_create refuses multi-table inheritance models, since it can't get the
+        # parent PKs back from the DB. We already have them, so the detail rows can go in the
+        # same way bulk_create does it.
+        for model, model_units in new_units.items():
+            model._base_manager._insert(
+                model_units, fields=model._meta.local_concrete_fields, using=self.db)
+            for unit in model_units:
+                unit._state.adding = False
+                unit._state.db = self.db
+
+        return [known[unit.key_digest] for unit in units]
 
 
 class NamedTupleDescriptor:
@@ -227,11 +693,73 @@ class NamedTupleDescriptor:
     def __get__(self, obj, cls):
         if cls not in self.cache:
             name = cls.__name__ + self.name
-            value = getattr(obj, self.classattr)
+            # built from the class, never the instance: obj is None on class access, which
+            # is how UnitKeyDescriptor (and RPMBase.NEVRA_TUPLE users) look these up
+            value = getattr(cls, self.classattr)
             self.cache[cls] = namedtuple(name, value)
         return self.cache[cls]
 
 
+class UnitKey:
+    """Precompiled unit key extraction and digests for a content unit class
+
+    Building a unit key through the key_tuple/key_dict/hash_key properties does a lot of work
+    per call that only depends on the class, not the instance. A UnitKey does that work once
+    for a class's KEY_FIELDS, and can build key tuples and digests from unit instances, from
+    rows of values in KEY_FIELDS order (e.g. from values_list(*Model.KEY_FIELDS)), or from
+    dicts of field values (e.g. from parsed upstream metadata), so that digests can be computed
+    for candidate units without instantiating models, let alone querying for them.
+
+    Digests are identical to the ones generated by ContentUnit.hash_key using the default
+    algorithm, and are what gets stored in ContentUnit.key_digest.
+
+    """
+    def __init__(self, fields, key_tuple):
+        self.fields = tuple(fields)
+        self.key_tuple = key_tuple
+        getter = attrgetter(*self.fields)
+        if len(self.fields) == 1:
+            # attrgetter with one attr returns that value rather than a 1-tuple
+            self._getter = lambda obj: (getter(obj),)
+        else:
+            self._getter = getter
+        # hash_key hashes '{}{}'.format(key, value) for each key field in order, which hashes
+        # the same as formatting all the fields into one string and hashing that once
+        self._template = ''.join('{}{{}}'.format(field) for field in self.fields)
+
+    def values(self, unit):
+        return self._getter(unit)
+
+    def tuple(self, unit):
+        return self.key_tuple._make(self._getter(unit))
+
+    def digest(self, unit):
+        return self.digest_values(self._getter(unit))
+
+    def digest_values(self, values):
+        return sha256(self._template.format(*values).encode('utf8')).hexdigest()
+
+    def digest_dict(self, mapping):
+        return self.digest_values([mapping[field] for field in self.fields])
+
+
+class UnitKeyDescriptor:
+    # Lazily builds and caches a UnitKey per class, the same way NamedTupleDescriptor does for
+    # namedtuple types. As with NamedTupleDescriptor, bind these to LOOK_LIKE_CONSTANTS names.
+    def __init__(self, fields_attr, tuple_attr):
+        self.fields_attr = fields_attr
+        self.tuple_attr = tuple_attr
+        self.cache = {}
+
+    def __get__(self, obj, cls):
+        try:
+            return self.cache[cls]
+        except KeyError:
+            unit_key = UnitKey(getattr(cls, self.fields_attr), getattr(cls, self.tuple_attr))
+            self.cache[cls] = unit_key
+            return unit_key
+
+
 # ContentUnit is the "master" model for all content units, and tracks
 # the content unit repository relationships as well as the content unit
 # type, which is derived from its implementing subclass. For now, the best
@@ -250,23 +778,28 @@ class ContentUnit(UUIDModel):
     key_digest = models.CharField(max_length=64, db_index=True, unique=True)
 
     KEY_TUPLE = NamedTupleDescriptor('KEY_FIELDS', 'KeyTuple')
+    UNIT_KEY = UnitKeyDescriptor('KEY_FIELDS', 'KEY_TUPLE')
 
     KEY_FIELDS = ['pk']
 
     # Similar to the related methods on Repository
     def add_repos(self, *repos):
         for repo in repos:
-            RepositoryContentUnit.objects.get_or_create(repository=repo, content_unit=self)
+            RepositoryContentUnit.objects.associate(repo, [self])
 
     def remove_repos(self, *repos):
         RepositoryContentUnit.objects.filter(repository__in=repos, content_unit=self).delete()
 
+    def delete(self, *args, **kwargs):
+        # see ContentUnitQuerySet.delete
+        with RepositoryChangeTracker(using=kwargs.get('using')):
+            return super(ContentUnit, self).delete(*args, **kwargs)
+
     @property
     def key_tuple(self):
         # All other unit key representations are generated from this property.
-        obj = self.cast()
-        values = (getattr(obj, field) for field in obj.KEY_FIELDS)
-        return obj.KEY_TUPLE._make(values)
+        obj = self._key_unit()
+        return obj.UNIT_KEY.tuple(obj)
 
     @property
     def key_str(self):
@@ -278,17 +811,41 @@ class ContentUnit(UUIDModel):
         return self.key_tuple._asdict()
 
     def hash_key(self, algorithm=None):
-        _hash = algorithm or sha256()
+        if algorithm is None:
+            # fast path for the default algorithm, which is what's used for key_digest
+            obj = self._key_unit()
+            return obj.UNIT_KEY.digest(obj)
+        _hash = algorithm
         for key, value in self.key_dict.items():
             _hash.update('{}{}'.format(key, value).encode('utf8'))
         return _hash.hexdigest()
 
+    def _key_unit(self):
+        # Detail instances already have their key fields, so only generic
+        # ContentUnits need to be cast to get at them
+        if type(self) is ContentUnit:
+            return self.cast()
+        return self
+
     # really a derived class property, but we can make that work later if we really want to
     # get rid of the parenthesis when accessing this
     @classmethod
     def _get_content_type(cls):
         return cls._meta.model_name
 
+    @staticmethod
+    def detail_model(content_type):
+        # The ContentUnit subclass for a content_type value, found the same way cast finds
+        # the detail instance: by the reverse relation named after that type. Returns None
+        # for unknown types.
+        try:
+            model = ContentUnit._meta.get_field(content_type).related_model
+        except FieldDoesNotExist:
+            return None
+        if isinstance(model, type) and issubclass(model, ContentUnit):
+            return model
+        return None
+
     def save(self, *args, **kwargs):
         # instances of "detail" models that subclass ContentUnit are exposed
         # on instances of ContentUnit by a lowercase version of their model
@@ -310,6 +867,8 @@ class ContentUnit(UUIDModel):
             if self.content_type == ContentUnit._meta.model_name:
                 raise Exception('Do not save ContentUnit instances directly.')
 
+        self.prepare_fields()
+
         # Update the stored key digest representing the unit key
         # XXX Should probably be handled in a pre-save signal
         self.key_digest = self.hash_key()
@@ -318,6 +877,12 @@ class ContentUnit(UUIDModel):
         # or some other mechanism to prevent unknown types being saved to the db
         return super(ContentUnit, self).save(*args, **kwargs)
 
+    def prepare_fields(self):
+        # Hook for detail types to fill in fields that are derived from their other fields
+        # (e.g. sort indexes) before the unit is written. Called by both save and
+        # ContentUnit.objects.bulk_ingest, which doesn't call save.
+        pass
+
     def cast(self):
         if self._get_content_type() == self.content_type:
             # If the current instance is already cast, return it rather than instantating a new one
@@ -368,7 +933,9 @@ class ContentUnitFile(UUIDModel):
     # It also incorporates some of the discussion in https://pulp.plan.io/issues/1647
     # to stash the checksum of the unit file along with the file size name
     unit = models.ForeignKey(ContentUnit, related_name='files')
-    content = models.FileField(upload_to=content_unit_path, max_length=255)
+    # Stored by the sha256 of the file's contents, so units with identical files share one
+    # copy on disk; see pulp.storage.ContentAddressableStorage
+    content = models.FileField(storage=content_storage, max_length=255)
     downloaded = models.BooleanField(default=False)
 
     # suggested in 1647, but I'm not sure of the value unless the goal is for a quick
@@ -394,6 +961,16 @@ class ContentUnitFile(UUIDModel):
     sha384 = models.CharField(max_length=96, blank=True, null=True)
     sha512 = models.CharField(max_length=128, blank=True, null=True)
 
+    # Result of the last check of the stored file against file_size and best_checksum, and
+    # when that happened, see verify and the verify_content management command
+    VERIFY_STATUSES = (
+        (VERIFY_OK, 'OK'),
+        (VERIFY_MISSING, 'Missing'),
+        (VERIFY_CORRUPT, 'Corrupt'),
+    )
+    verified = models.DateTimeField(null=True, blank=True, db_index=True)
+    verify_status = models.CharField(max_length=15, choices=VERIFY_STATUSES, blank=True)
+
     @property
     def digests(self):
         # An example interface to get at the digest fields in one place
@@ -413,26 +990,61 @@ class ContentUnitFile(UUIDModel):
             # No hashes to sort, so the [0] index above exploded
             return None
 
-    def save(self, *args, **kwargs):
+    def save(self, *args, algorithms=None, trusted=False, threaded=False, **kwargs):
         # I'm not sure if we want to calculate all possible checksums on a file when saved, but
         # it's certainly possible to do so. Since the files we get often have checksums associated
         # with them, this seems like the sort of thing we'd want to do as an optional behavior in
         # plugin. It's here as another example of fun things we can do with Django.
+        # See compute_digests for the extra keyword arguments.
         if self.content:
-            hashers = {algo: getattr(hashlib, algo)() for algo in self._hash_field_generator()}
-
-            # this is remarkably inefficient! :)
-            for line in self.content.readlines():
-                for hasher in hashers.values():
-                    hasher.update(line.encode('utf8'))
-
-            for algo, hasher in hashers.items():
-                setattr(self, algo, hasher.hexdigest())
-
-            self.file_size = self.content.size
+            self.compute_digests(algorithms, trusted, threaded)
+            if self.file_size is None:
+                self.file_size = self.content.size
 
         super(ContentUnitFile, self).save(*args, **kwargs)
 
+    def compute_digests(self, algorithms=None, trusted=False, threaded=False):
+        # Hash the file contents for the given digest field names (all of them by default), reading
+        # the file once in fixed-size binary chunks no matter how many digests are computed.
+        # By default every digest is recomputed, along with file_size, since the contents may
+        # have been replaced since they were last hashed. Pass trusted=True to leave alone the
+        # digest fields that already have a value, e.g. when they were just set from checksums in
+        # the upstream repo metadata, so that only the missing ones are computed.
+        # threaded hashes each algorithm in its own thread; see pulp.utils.digest_chunks
+        fields = set(self._hash_field_generator())
+        algorithms = fields if algorithms is None else set(algorithms)
+        unknown = algorithms - fields
+        if unknown:
+            raise ValueError('Unknown digest fields: {}'.format(', '.join(sorted(unknown))))
+        if trusted:
+            algorithms = set(algo for algo in algorithms if not getattr(self, algo))
+        if not algorithms:
+            return
+
+        digests, size = digest_chunks(self.content.chunks(HASH_CHUNK_SIZE), algorithms, threaded)
+        for algo, digest in digests.items():
+            setattr(self, algo, digest)
+        self.file_size = size
+        if 'sha256' in digests and not self.content._committed:
+            # the storage names files by their sha256, so pass it along to save with the file
+            # rather than have the storage hash it again (see ContentAddressableStorage._save)
+            self.content.file.digest = digests['sha256']
+
+    def verify(self, save=True):
+        # Check the stored file, and record the result. Returns the verify_status.
+        checksum = self.best_checksum
+        if not self.content:
+            self.verify_status = VERIFY_MISSING
+        else:
+            self.verify_status, hashed = verify_file(
+                self.content.path, self.file_size, *(checksum or (None, None)))
+        self.verified = timezone.now()
+        if save:
+            # only these fields, since saving the whole thing would compute digests again
+            type(self).objects.filter(pk=self.pk).update(
+                verified=self.verified, verify_status=self.verify_status)
+        return self.verify_status
+
     def _hash_field_generator(self):
         for field in self._meta.fields:
             if field.name in hashlib.algorithms_guaranteed:
@@ -449,6 +1061,508 @@ class ContentUnitFile(UUIDModel):
         return '<{} "{}">'.format(type(self).__name__, self.content.name)
 
 
+def _pk(instance):
+    # a model instance's PK, or the PK itself
+    return getattr(instance, 'pk', instance)
+
+
+def _unit_pks(units):
+    # Normalize the things that can be passed to the bulk association methods into an
+    # iterator of ContentUnit PKs. Querysets are only asked for their PKs, so full unit
+    # instances are never loaded just to associate them.
+    if isinstance(units, models.QuerySet):
+        return units.values_list('pk', flat=True).iterator()
+    return (getattr(unit, 'pk', unit) for unit in units)
+
+
+class RepositoryChangeTracker:
+    """Collect changes to repository content and write their side effects once per repository
+
+    Every change to a repository's content used to update that repository's last_unit_added
+    or last_unit_removed timestamp immediately, which for large changes means many UPDATEs
+    to the same (hot) repository row, holding its row lock for the whole transaction. The same
+    goes for the materialized per-type unit counts in RepositoryContentUnitCount.
+
+    Inside a tracker, changes are recorded instead of written. The tracker runs its block in
+    a transaction, and when the block completes the recorded timestamps are written with one
+    UPDATE per repository, and the unit count changes with one upsert, as the last thing before
+    the transaction commits, followed by the repository_content_changed signal. Units removed
+    from repositories are written to the RepositoryContentUnitRemoval log at the same time,
+    in chunks, rather than one INSERT per association deleted. Trackers can be
+    nested; inner trackers pass their changes up to the outermost tracker to be written. If the
+    block raises, the transaction is rolled back and the recorded changes are discarded.
+
+    The tracker in use (if any) is available with RepositoryChangeTracker.current(), which is
+    how the RepositoryContentUnit signal handlers and bulk association methods find it.
+
+    """
+    # maps the actions passed to record to the Repository field they update,
+    # and to which direction they change the unit counts
+    ACTION_FIELDS = {
+        'save': 'last_unit_added',
+        'delete': 'last_unit_removed',
+    }
+    ACTION_SIGNS = {
+        'save': 1,
+        'delete': -1,
+    }
+
+    _local = threading.local()
+
+    def __init__(self, using=None):
+        self.using = using
+        # repository pk -> {timestamp field name: timestamp}
+        self.changes = {}
+        # repository pk -> repository instances whose attributes get updated when flushed
+        self.instances = defaultdict(list)
+        # (repository pk, content type) -> change in the number of units of that type
+        self.counts = defaultdict(int)
+        # repository pks with changes of unknown types, which need to be counted from scratch
+        self.recount = set()
+        # (repository pk, unit pk, timestamp) for the RepositoryContentUnitRemoval log
+        self.removals = []
+        # repository pk -> set of changed unit pks, or None if they're unknown
+        self.units = {}
+        # unit pk -> content type of units whose associations are being deleted, and the pks
+        # of those units whose types haven't been looked up yet, see unit_content_type
+        self.unit_types = {}
+        self.pending_types = set()
+
+    @classmethod
+    def _stack(cls):
+        # trackers are per-thread, just like the transactions they wrap
+        if not hasattr(cls._local, 'stack'):
+            cls._local.stack = []
+        return cls._local.stack
+
+    @classmethod
+    def current(cls):
+        stack = cls._stack()
+        return stack[-1] if stack else None
+
+    def record(self, repository, action, timestamp=None, counts=None, removed=None,
+               units=None):
+        # repository can be a Repository instance or a repository pk. If it's an instance,
+        # its timestamp attrs are updated along with the DB when the changes are written.
+        # counts is a {content_type: number of units} dict of the units that were added or
+        # removed. If not given, the types of the changed units are unknown (e.g. when a unit
+        # was deleted before its association), and the repository's units will be counted again.
+        # removed is an optional iterable of the pks of units removed, to be logged for
+        # Repository.changes_since; the set-based delete paths log their removals themselves.
+        # units is an optional iterable of the pks of the units added or removed, which defaults
+        # to removed. If neither is given, the changed units are unknown.
+        try:
+            field = self.ACTION_FIELDS[action]
+        except KeyError:
+            # unknown action
+            return
+        timestamp = timestamp or timezone.now()
+        pk = getattr(repository, 'pk', repository)
+        fields = self.changes.setdefault(pk, {})
+        if fields.get(field) is None or fields[field] < timestamp:
+            fields[field] = timestamp
+        if isinstance(repository, models.Model):
+            if not any(instance is repository for instance in self.instances[pk]):
+                self.instances[pk].append(repository)
+
+        if counts is None:
+            self.recount.add(pk)
+        else:
+            sign = self.ACTION_SIGNS[action]
+            for content_type, count in counts.items():
+                self.counts[(pk, content_type)] += sign * count
+
+        if removed is not None and action == 'delete':
+            removed = list(removed)
+            self.removals.extend((pk, unit_pk, timestamp) for unit_pk in removed)
+            if units is None:
+                units = removed
+        self._add_units(pk, units)
+
+    def _add_units(self, pk, units):
+        if units is None:
+            self.units[pk] = None
+            return
+        known = self.units.setdefault(pk, set())
+        if known is not None:
+            known.update(units)
+            if len(known) > TRACKED_UNITS_LIMIT:
+                self.units[pk] = None
+
+    def expect_delete(self, unit_pk):
+        # called from pre_delete for an association whose unit isn't loaded
+        if unit_pk not in self.unit_types:
+            self.pending_types.add(unit_pk)
+
+    def unit_content_type(self, unit_pk, using=None):
+        # The content type of a unit whose association was just deleted, or None if the unit
+        # is gone. The delete collector sends pre_delete for every row before deleting any of
+        # them, so the first lookup gets the types of all of the units seen in pre_delete
+        # at once, rather than running one query per deleted association.
+        if unit_pk not in self.unit_types:
+            self.pending_types.add(unit_pk)
+            pending = list(self.pending_types)
+            self.pending_types.clear()
+            self.unit_types.update(dict.fromkeys(pending))
+            units = ContentUnit.objects.using(using or self.using)
+            for chunk in chunked(pending, BULK_CHUNK_SIZE):
+                self.unit_types.update(
+                    units.filter(pk__in=chunk).values_list('pk', 'content_type'))
+        return self.unit_types.get(unit_pk)
+
+    def merge(self, other):
+        # fold another tracker's changes into this one
+        for pk, fields in other.changes.items():
+            for field, timestamp in fields.items():
+                current = self.changes.setdefault(pk, {})
+                if current.get(field) is None or current[field] < timestamp:
+                    current[field] = timestamp
+        for pk, instances in other.instances.items():
+            for instance in instances:
+                if not any(known is instance for known in self.instances[pk]):
+                    self.instances[pk].append(instance)
+        for key, delta in other.counts.items():
+            self.counts[key] += delta
+        self.recount.update(other.recount)
+        self.removals.extend(other.removals)
+        for pk, units in other.units.items():
+            self._add_units(pk, units)
+
+    def flush(self):
+        # write the recorded changes, one UPDATE per repository
+        for pk, fields in self.changes.items():
+            Repository.objects.using(self.using).filter(pk=pk).update(**fields)
+            for instance in self.instances.get(pk, ()):
+                for field, timestamp in fields.items():
+                    setattr(instance, field, timestamp)
+
+        # repositories being recounted don't need their deltas applied
+        deltas = dict((key, delta) for key, delta in self.counts.items()
+                      if delta and key[0] not in self.recount)
+        counts = RepositoryContentUnitCount.objects.db_manager(self.using)
+        counts.apply_deltas(deltas)
+        if self.recount:
+            counts.rebuild(self.recount)
+        RepositoryContentUnitRemoval.objects.db_manager(self.using).log(self.removals)
+
+        changed = defaultdict(set)
+        for pk, content_type in self.counts:
+            changed[pk].add(content_type)
+        for pk in self.recount:
+            changed[pk].add(None)
+        if changed:
+            units = dict((pk, self.units.get(pk)) for pk in changed)
+            repository_content_changed.send(sender=Repository, changed=dict(changed),
+                                            units=units, using=self.using)
+
+        self.changes.clear()
+        self.instances.clear()
+        self.counts.clear()
+        self.recount.clear()
+        del self.removals[:]
+        self.units.clear()
+        self.unit_types.clear()
+        self.pending_types.clear()
+
+    def __enter__(self):
+        self._atomic = transaction.atomic(using=self.using)
+        self._atomic.__enter__()
+        self._stack().append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._stack().pop()
+        try:
+            if exc_type is None:
+                parent = self.current()
+                if parent is None:
+                    self.flush()
+                else:
+                    parent.merge(self)
+        except:
+            # flushing failed, so roll back along with everything else
+            if not self._atomic.__exit__(*sys.exc_info()):
+                raise
+        else:
+            return self._atomic.__exit__(exc_type, exc_value, traceback)
+
+
+class RepositoryContentUnitQuerySet(models.QuerySet):
+    def delete(self):
+        # Deleting a queryset of associations normally loads every row so that post_delete can
+        # be sent for each one, which then updates the repository once per row. Delete them in
+        # one statement instead, and record the affected repositories with the change tracker.
+        # The same statement logs the removals for Repository.changes_since.
+        assert self.query.can_filter(), "Cannot use 'limit' or 'offset' with delete."
+        opts = self.model._meta
+        unit_opts = ContentUnit._meta
+        query, params = self.order_by().values('pk').query.sql_with_params()
+        now = timezone.now()
+        sql = (
+            'WITH deleted AS ('
+            'DELETE FROM {table} WHERE {pk} IN ({query}) RETURNING {repository}, {content_unit}'
+            '), {log} '
+            'SELECT deleted.{repository}, unit.{content_type}, count(*) '
+            'FROM deleted JOIN {unit_table} AS unit ON unit.{unit_pk} = deleted.{content_unit} '
+            'GROUP BY deleted.{repository}, unit.{content_type}'
+        ).format(
+            table=opts.db_table,
+            pk=opts.pk.column,
+            repository=opts.get_field('repository').column,
+            content_unit=opts.get_field('content_unit').column,
+            unit_table=unit_opts.db_table,
+            unit_pk=unit_opts.pk.column,
+            content_type=unit_opts.get_field('content_type').column,
+            query=query,
+            log=RepositoryContentUnitRemoval.objects.log_sql(
+                'deleted', opts.get_field('repository').column,
+                opts.get_field('content_unit').column),
+        )
+        counts = defaultdict(dict)
+        with RepositoryChangeTracker(using=self.db) as tracker:
+            with connections[self.db].cursor() as cursor:
+                cursor.execute(sql, tuple(params) + (now,))
+                for repository_pk, content_type, count in cursor.fetchall():
+                    counts[repository_pk][content_type] = count
+            for repository_pk, repository_counts in counts.items():
+                tracker.record(repository_pk, 'delete', now, repository_counts)
+        self._result_cache = None
+        return sum(sum(c.values()) for c in counts.values())
+    delete.alters_data = True
+    delete.queryset_only = True
+
+
+class RepositoryContentUnitManager(models.Manager.from_queryset(RepositoryContentUnitQuerySet)):
+    # Set-based versions of repository/unit association. Creating RepositoryContentUnit
+    # instances one at a time costs a get and an insert for every unit, plus a repository
+    # timestamp update for each one by way of the pre_save signal. These methods write
+    # a chunk of associations per statement instead, and touch each repository's timestamps
+    # and unit counts once per call (or once per RepositoryChangeTracker block, if one is in use).
+
+    def associate(self, repository, units, chunk_size=BULK_CHUNK_SIZE):
+        # units can be a queryset of ContentUnits (of any type), or an iterable of
+        # ContentUnits or their PKs. Units already in the repository are skipped,
+        # as are PKs that don't match any ContentUnit.
+        counts = defaultdict(int)
+        skipped = 0
+        now = timezone.now()
+        added = []
+        with RepositoryChangeTracker(using=self.db) as tracker:
+            for chunk in chunked(_unit_pks(units), chunk_size):
+                inserted = self._insert_chunk(repository.pk, chunk, now)
+                for unit_pk, content_type in inserted:
+                    counts[content_type] += 1
+                    if len(added) <= TRACKED_UNITS_LIMIT:
+                        added.append(unit_pk)
+                skipped += len(chunk) - len(inserted)
+            if counts:
+                tracker.record(repository, 'save', now, counts, units=(
+                    added if len(added) <= TRACKED_UNITS_LIMIT else None))
+        return Associated(sum(counts.values()), skipped)
+
+    def disassociate(self, repository, units, chunk_size=BULK_CHUNK_SIZE):
+        # Same arguments as associate; units not in the repository are skipped
+        counts = defaultdict(int)
+        skipped = 0
+        now = timezone.now()
+        removed = []
+        with RepositoryChangeTracker(using=self.db) as tracker:
+            for chunk in chunked(_unit_pks(units), chunk_size):
+                deleted = self._delete_chunk(repository.pk, chunk, now)
+                for unit_pk, content_type in deleted:
+                    counts[content_type] += 1
+                    if len(removed) <= TRACKED_UNITS_LIMIT:
+                        removed.append(unit_pk)
+                skipped += len(chunk) - len(deleted)
+            if counts:
+                # removals are already logged by _delete_chunk, so these are only passed on
+                tracker.record(repository, 'delete', now, counts, units=(
+                    removed if len(removed) <= TRACKED_UNITS_LIMIT else None))
+        return Disassociated(sum(counts.values()), skipped)
+
+    # Set operations between repositories. These run entirely in the database, as one
+    # INSERT ... SELECT from the associations of the source repositories, so no units are loaded
+    # into python however many are involved. Repositories can be instances or PKs. units is an
+    # optional ContentUnit queryset, and content_types an optional list of content types, to
+    # limit what's copied. Units already in the target are skipped. Like associate, these return
+    # Associated tuples, and update the target's timestamps and unit counts once per call.
+
+    def copy(self, source, target, units=None, content_types=None):
+        # Copy units in source to target, e.g. to promote content from testing to stable
+        return self._insert_from(target, [source], units, content_types)
+
+    def union(self, target, sources, units=None, content_types=None):
+        # Add every unit in any of the sources to target
+        return self._insert_from(target, sources, units, content_types)
+
+    def intersection(self, target, sources, units=None, content_types=None):
+        # Add the units that are in all of the sources to target
+        return self._insert_from(target, sources, units, content_types, intersect=True)
+
+    def difference(self, repository, other, content_types=None):
+        # The ContentUnits in repository that aren't in other, as a queryset; an anti-join
+        # on the repository/unit index rather than two full unit lists compared in python
+        units = ContentUnit.objects.using(self.db).filter(
+            repositories=_pk(repository)).exclude(repositories=_pk(other))
+        if content_types is not None:
+            units = units.filter(content_type__in=content_types)
+        return units
+
+    def diff(self, repository, other, content_types=None):
+        # What it would take to turn repository's content into other's, as a RepositoryDiff
+        # of per-type counts: units only in other are added, units only in repository removed.
+        # One grouped anti-join query each way.
+        def counts(units):
+            return dict(units.order_by().values_list('content_type').annotate(Count('pk')))
+        return RepositoryDiff(
+            added=counts(self.difference(other, repository, content_types)),
+            removed=counts(self.difference(repository, other, content_types)),
+        )
+
+    def _insert_from(self, target, sources, units, content_types, intersect=False):
+        sources = [_pk(source) for source in sources]
+        target_pk = _pk(target)
+        if not sources or sources == [target_pk]:
+            return Associated(0, 0)
+        opts = self.model._meta
+        unit_opts = ContentUnit._meta
+        repository = opts.get_field('repository').column
+        content_unit = opts.get_field('content_unit').column
+
+        where = ['source.{} IN ({})'.format(repository, ', '.join(['%s'] * len(sources)))]
+        params = list(sources)
+        if content_types is not None:
+            where.append('unit.{} IN ({})'.format(
+                unit_opts.get_field('content_type').column,
+                ', '.join(['%s'] * len(content_types)) or 'NULL'))
+            params.extend(content_types)
+        if units is not None:
+            units_sql, units_params = units.order_by().values('pk').query.sql_with_params()
+            where.append('source.{} IN ({})'.format(content_unit, units_sql))
+            params.extend(units_params)
+        if intersect:
+            # associations are unique per repository, so a unit in all of the sources has
+            # exactly one row per source
+            grouping = 'GROUP BY source.{} HAVING count(*) = %s'.format(content_unit)
+            select = 'SELECT'
+            params.append(len(set(sources)))
+        else:
+            grouping = ''
+            select = 'SELECT DISTINCT'
+
+        # The new association PKs are generated by postgres, see _uuid4_sql
+        now = timezone.now()
+        sql = (
+            'WITH candidate AS ('
+            '{select} source.{content_unit} AS unit_pk FROM {table} AS source '
+            'JOIN {unit_table} AS unit ON unit.{unit_pk} = source.{content_unit} '
+            'WHERE {where} {grouping}'
+            '), added AS ('
+            'INSERT INTO {table} ({pk}, {repository}, {content_unit}, {created}, {updated}) '
+            'SELECT {new_pk}, %s, candidate.unit_pk, %s, %s FROM candidate '
+            'ON CONFLICT ({repository}, {content_unit}) DO NOTHING '
+            'RETURNING {content_unit}'
+            ') SELECT unit.{content_type}, count(*) '
+            'FROM added JOIN {unit_table} AS unit ON unit.{unit_pk} = added.{content_unit} '
+            'GROUP BY unit.{content_type} '
+            'UNION ALL SELECT NULL, count(*) FROM candidate'
+        ).format(
+            select=select,
+            where=' AND '.join(where),
+            grouping=grouping,
+            new_pk=_uuid4_sql('candidate.unit_pk'),
+            table=opts.db_table,
+            pk=opts.pk.column,
+            repository=repository,
+            content_unit=content_unit,
+            created=opts.get_field('created').column,
+            updated=opts.get_field('updated').column,
+            unit_table=unit_opts.db_table,
+            unit_pk=unit_opts.pk.column,
+            content_type=unit_opts.get_field('content_type').column,
+        )
+        params.extend([target_pk, now, now])
+
+        counts = {}
+        candidates = 0
+        with RepositoryChangeTracker(using=self.db) as tracker:
+            with connections[self.db].cursor() as cursor:
+                cursor.execute(sql, params)
+                for content_type, count in cursor.fetchall():
+                    if content_type is None:
+                        candidates = count
+                    else:
+                        counts[content_type] = count
+            if counts:
+                tracker.record(target, 'save', now, counts)
+        added = sum(counts.values())
+        return Associated(added, candidates - added)
+
+    def _insert_chunk(self, repository_pk, unit_pks, now):
+        # Joining the candidate rows against the ContentUnit table drops any PKs that don't
+        # reference a real unit, and the ON CONFLICT clause skips units already in the repo
+        # (including duplicates within the chunk) without erroring out, so the rows returned
+        # are exactly the units added to the repository, as (unit pk, content type) tuples.
+        opts = self.model._meta
+        unit_opts = ContentUnit._meta
+        sql = (
+            'WITH added AS ('
+            'INSERT INTO {table} ({pk}, {repository}, {content_unit}, {created}, {updated}) '
+            'SELECT candidate.pk, %s, unit.{unit_pk}, %s, %s '
+            'FROM (VALUES {values}) AS candidate (pk, unit_pk), {unit_table} AS unit '
+            'WHERE unit.{unit_pk} = candidate.unit_pk '
+            'ON CONFLICT ({repository}, {content_unit}) DO NOTHING '
+            'RETURNING {content_unit}'
+            ') SELECT added.{content_unit}, unit.{content_type} '
+            'FROM added JOIN {unit_table} AS unit ON unit.{unit_pk} = added.{content_unit}'
+        ).format(
+            table=opts.db_table,
+            pk=opts.pk.column,
+            repository=opts.get_field('repository').column,
+            content_unit=opts.get_field('content_unit').column,
+            created=opts.get_field('created').column,
+            updated=opts.get_field('updated').column,
+            unit_table=unit_opts.db_table,
+            unit_pk=unit_opts.pk.column,
+            content_type=unit_opts.get_field('content_type').column,
+            values=', '.join(['(%s::uuid, %s::uuid)'] * len(unit_pks)),
+        )
+        params = [repository_pk, now, now]
+        for unit_pk in unit_pks:
+            params.extend((uuid.uuid4(), unit_pk))
+        with connections[self.db].cursor() as cursor:
+            cursor.execute(sql, params)
+            return cursor.fetchall()
+
+    def _delete_chunk(self, repository_pk, unit_pks, now):
+        # like _insert_chunk, the rows returned are exactly the units removed,
+        # which are logged in the same statement
+        opts = self.model._meta
+        unit_opts = ContentUnit._meta
+        sql = (
+            'WITH removed AS ('
+            'DELETE FROM {table} WHERE {repository} = %s AND {content_unit} IN ({values}) '
+            'RETURNING {repository}, {content_unit}'
+            '), {log} '
+            'SELECT removed.{content_unit}, unit.{content_type} '
+            'FROM removed JOIN {unit_table} AS unit ON unit.{unit_pk} = removed.{content_unit}'
+        ).format(
+            table=opts.db_table,
+            repository=opts.get_field('repository').column,
+            content_unit=opts.get_field('content_unit').column,
+            unit_table=unit_opts.db_table,
+            unit_pk=unit_opts.pk.column,
+            content_type=unit_opts.get_field('content_type').column,
+            values=', '.join(['%s::uuid'] * len(unit_pks)),
+            log=RepositoryContentUnitRemoval.objects.log_sql(
+                'removed', opts.get_field('repository').column,
+                opts.get_field('content_unit').column),
+        )
+        with connections[self.db].cursor() as cursor:
+            cursor.execute(sql, [repository_pk] + list(unit_pks) + [now])
+            return cursor.fetchall()
+
+
 # A through model representing the join table between repos and content units
 class RepositoryContentUnit(UUIDModel):
     # delete this RCU if either the related repo or contentunit are deleted
@@ -461,6 +1575,8 @@ class RepositoryContentUnit(UUIDModel):
     created = models.DateTimeField(auto_now_add=True)
     updated = models.DateTimeField(auto_now=True)
 
+    objects = RepositoryContentUnitManager()
+
     def __repr__(self):
         return '<{} "{}: {}">'.format(
             type(self).__name__, self.repository.slug, self.content_unit.pk)
@@ -469,6 +1585,326 @@ class RepositoryContentUnit(UUIDModel):
         ordering = ['updated']
         get_latest_by = 'updated'
         unique_together = [('repository', 'content_unit')]
+        # for Repository.changes_since
+        index_together = [('repository', 'updated')]
+
+
+class RepositoryContentUnitRemovalManager(models.Manager):
+    def log(self, removals, chunk_size=BULK_CHUNK_SIZE):
+        # removals is a list of (repository pk, unit pk, timestamp) tuples. Removals from
+        # repositories that no longer exist (e.g. when the removals are from deleting the
+        # repository) are dropped by the join.
+        opts = self.model._meta
+        repository_opts = Repository._meta
+        for chunk in chunked(removals, chunk_size):
+            sql = (
+                'INSERT INTO {table} ({pk}, {repository}, {unit_pk}, {removed}) '
+                'SELECT removal.pk, repository.{repository_pk}, removal.unit_pk, removal.removed '
+                'FROM (VALUES {values}) AS removal (pk, repository_pk, unit_pk, removed) '
+                'JOIN {repository_table} AS repository '
+                'ON repository.{repository_pk} = removal.repository_pk'
+            ).format(
+                table=opts.db_table,
+                pk=opts.pk.column,
+                repository=opts.get_field('repository').column,
+                unit_pk=opts.get_field('unit_pk').column,
+                removed=opts.get_field('removed').column,
+                repository_table=repository_opts.db_table,
+                repository_pk=repository_opts.pk.column,
+                values=', '.join(['(%s::uuid, %s::uuid, %s::uuid, %s::timestamptz)'] *
+                                 len(chunk)),
+            )
+            params = []
+            for repository_pk, unit_pk, removed in chunk:
+                params.extend((uuid.uuid4(), repository_pk, unit_pk, removed))
+            with connections[self.db].cursor() as cursor:
+                cursor.execute(sql, params)
+
+    def log_sql(self, source, repository, content_unit):
+        # A data-modifying CTE for the set-based deletes, which logs every (repository, content
+        # unit) row RETURNING from the CTE named source. Takes one param, the removal timestamp.
+        opts = self.model._meta
+        return (
+            'logged AS ('
+            'INSERT INTO {table} ({pk}, {repository_column}, {unit_pk}, {removed}) '
+            'SELECT {new_pk}, {source}.{repository}, {source}.{content_unit}, %s FROM {source})'
+        ).format(
+            new_pk=_uuid4_sql('{}.{}'.format(source, content_unit)),
+            table=opts.db_table,
+            pk=opts.pk.column,
+            repository_column=opts.get_field('repository').column,
+            unit_pk=opts.get_field('unit_pk').column,
+            removed=opts.get_field('removed').column,
+            source=source,
+            repository=repository,
+            content_unit=content_unit,
+        )
+
+
+class RepositoryContentUnitRemoval(UUIDModel):
+    # A log of units removed from repositories, which would otherwise be lost along with their
+    # RepositoryContentUnit, for Repository.changes_since. unit_pk isn't a foreign key, so that
+    # the log outlives the units themselves. Nothing ever reads entries older than the oldest
+    # watermark a publisher still holds, so those can be deleted whenever.
+    repository = models.ForeignKey(Repository, related_name='unit_removals',
+                                   on_delete=models.CASCADE)
+    unit_pk = models.UUIDField()
+    removed = models.DateTimeField()
+
+    objects = RepositoryContentUnitRemovalManager()
+
+    class Meta:
+        index_together = [('repository', 'removed')]
+
+
+class RepositoryContentUnitCountManager(models.Manager):
+    def apply_deltas(self, deltas):
+        # deltas is a {(repository pk, content type): change in count} dict, written with
+        # a single upsert statement. As with RepositoryContentUnitRemoval.objects.log, deltas
+        # for repositories that no longer exist (e.g. when the changes are from deleting the
+        # repository) are dropped by the join, rather than failing the deferred foreign key.
+        if not deltas:
+            return
+        opts = self.model._meta
+        repository_opts = Repository._meta
+        repository = opts.get_field('repository').column
+        content_type = opts.get_field('content_type').column
+        count = opts.get_field('count').column
+        sql = (
+            'INSERT INTO {table} AS counts ({pk}, {repository}, {content_type}, {count}) '
+            'SELECT delta.pk, repository.{repository_pk}, delta.content_type, delta.count '
+            'FROM (VALUES {values}) AS delta (pk, repository_pk, content_type, count) '
+            'JOIN {repository_table} AS repository '
+            'ON repository.{repository_pk} = delta.repository_pk '
+            'ON CONFLICT ({repository}, {content_type}) '
+            'DO UPDATE SET {count} = counts.{count} + EXCLUDED.{count}'
+        ).format(
+            table=opts.db_table,
+            pk=opts.pk.column,
+            repository=repository,
+            content_type=content_type,
+            count=count,
+            repository_table=repository_opts.db_table,
+            repository_pk=repository_opts.pk.column,
+            values=', '.join(['(%s::uuid, %s::uuid, %s, %s::integer)'] * len(deltas)),
+        )
+        params = []
+        for (repository_pk, unit_type), delta in deltas.items():
+            params.extend((uuid.uuid4(), repository_pk, unit_type, delta))
+        with connections[self.db].cursor() as cursor:
+            cursor.execute(sql, params)
+
+    def rebuild(self, repositories=None):
+        # Count the units in the given repositories (a queryset, or an iterable of repositories
+        # or their pks), or in all repositories if not given, and replace their stored counts.
+        # Normally the counts are kept up to date as units are added and removed, so this is for
+        # repairing drift, e.g. after changing associations with raw SQL.
+        associations = RepositoryContentUnit.objects.using(self.db).order_by()
+        stale = self.all()
+        if repositories is not None:
+            associations = associations.filter(repository__in=repositories)
+            stale = stale.filter(repository__in=repositories)
+        counts = associations.values_list('repository', 'content_unit__content_type').annotate(
+            count=models.Count('pk'))
+        with transaction.atomic(using=self.db):
+            stale.delete()
+            self.bulk_create(
+                self.model(repository_id=repository_pk, content_type=content_type, count=count)
+                for repository_pk, content_type, count in counts)
+
+
+class RepositoryContentUnitCount(UUIDModel):
+    # The number of units of each type in each repository, maintained by RepositoryChangeTracker
+    # as units are added to and removed from repositories, so that Repository.content_unit_counts
+    # doesn't have to count the units in a repository every time it's accessed. Use the
+    # rebuild_unit_counts management command to recount them if they've drifted.
+    repository = models.ForeignKey(Repository, related_name='unit_counts',
+                                   on_delete=models.CASCADE)
+    content_type = models.CharField(max_length=15)
+    count = models.IntegerField(default=0)
+
+    objects = RepositoryContentUnitCountManager()
+
+    class Meta:
+        unique_together = [('repository', 'content_type')]
+
+    def __repr__(self):
+        return '<{} "{}: {} {}">'.format(
+            type(self).__name__, self.repository_id, self.count, self.content_type)
+
+
+class RepositoryVersionManager(models.Manager):
+    def create_version(self, repository):
+        # Snapshot the repository's current content as its next version. Only the changes since
+        # the last version are written: units that left the repository have their open
+        # RepositoryVersionContent row closed with one UPDATE, and units that joined get a new
+        # row with one INSERT ... SELECT. Both are anti-joins between the repository's current
+        # associations and its open version rows, done by the database.
+        content_opts = RepositoryVersionContent._meta
+        rcu_opts = RepositoryContentUnit._meta
+        with transaction.atomic(using=self.db):
+            # lock the repository so concurrent snapshots get consecutive numbers
+            Repository.objects.using(self.db).select_for_update().filter(
+                pk=repository.pk).exists()
+            latest = self.filter(repository=repository).order_by('-number').first()
+            number = latest.number + 1 if latest is not None else 1
+
+            current_units = RepositoryContentUnit.objects.using(self.db).filter(
+                repository=repository).values('content_unit')
+            removed = RepositoryVersionContent.objects.using(self.db).filter(
+                repository=repository, version_removed__isnull=True).exclude(
+                unit_pk__in=current_units).update(version_removed=number)
+
+            sql = (
+                'INSERT INTO {table} ({pk}, {repository}, {unit_pk}, {version_added}) '
+                'SELECT {new_pk}, %s, rcu.{rcu_content_unit}, %s '
+                'FROM {rcu_table} AS rcu WHERE rcu.{rcu_repository} = %s AND NOT EXISTS ('
+                'SELECT 1 FROM {table} AS version_content '
+                'WHERE version_content.{repository} = %s '
+                'AND version_content.{unit_pk} = rcu.{rcu_content_unit} '
+                'AND version_content.{version_removed} IS NULL)'
+            ).format(
+                new_pk=_uuid4_sql('rcu.{}'.format(rcu_opts.get_field('content_unit').column)),
+                table=content_opts.db_table,
+                pk=content_opts.pk.column,
+                repository=content_opts.get_field('repository').column,
+                unit_pk=content_opts.get_field('unit_pk').column,
+                version_added=content_opts.get_field('version_added').column,
+                version_removed=content_opts.get_field('version_removed').column,
+                rcu_table=rcu_opts.db_table,
+                rcu_repository=rcu_opts.get_field('repository').column,
+                rcu_content_unit=rcu_opts.get_field('content_unit').column,
+            )
+            with connections[self.db].cursor() as cursor:
+                cursor.execute(sql, [repository.pk, number, repository.pk, repository.pk])
+                added = cursor.rowcount
+
+            return self.create(repository=repository, number=number,
+                               units_added=added, units_removed=removed)
+
+
+class RepositoryVersion(UUIDModel):
+    # An immutable snapshot of a repository's content. Rather than a copy of the repository's
+    # associations for every version, the content of all versions is stored as membership
+    # ranges in RepositoryVersionContent, so a version costs one row per unit added or removed
+    # since the version before it, and it's just as cheap to diff two versions.
+    repository = models.ForeignKey(Repository, related_name='versions', on_delete=models.CASCADE)
+    number = models.PositiveIntegerField()
+    created = models.DateTimeField(auto_now_add=True)
+    # how many units were added and removed since the previous version
+    units_added = models.IntegerField(default=0)
+    units_removed = models.IntegerField(default=0)
+
+    objects = RepositoryVersionManager()
+
+    class Meta:
+        ordering = ['repository', 'number']
+        unique_together = [('repository', 'number')]
+
+    def __repr__(self):
+        return '<{} "{}: {}">'.format(type(self).__name__, self.repository_id, self.number)
+
+    def _content(self):
+        return RepositoryVersionContent.objects.using(self._state.db).filter(
+            repository_id=self.repository_id)
+
+    def _live_at(self, number):
+        # the version content rows for the units in version number
+        return self._content().filter(
+            models.Q(version_removed__isnull=True) | models.Q(version_removed__gt=number),
+            version_added__lte=number)
+
+    def _not_live_at(self, content, number):
+        # The rows in content whose units aren't in version number. This is a correlated NOT
+        # EXISTS, so it's one probe of the (repository, unit_pk) index per row in content, rather
+        # than the NOT IN that exclude(unit_pk__in=...) would make, which hashes every unit in
+        # version number, and so takes as long as the repository is big.
+        opts = RepositoryVersionContent._meta
+        sql = (
+            'NOT EXISTS (SELECT 1 FROM {table} AS other '
+            'WHERE other.{repository} = {table}.{repository} '
+            'AND other.{unit_pk} = {table}.{unit_pk} '
+            'AND other.{version_added} <= %s '
+            'AND (other.{version_removed} IS NULL OR other.{version_removed} > %s))'
+        ).format(
+            table=opts.db_table,
+            repository=opts.get_field('repository').column,
+            unit_pk=opts.get_field('unit_pk').column,
+            version_added=opts.get_field('version_added').column,
+            version_removed=opts.get_field('version_removed').column,
+        )
+        return content.extra(where=[sql], params=[number, number])
+
+    def _units(self, content):
+        # content is compiled on its own rather than nested as a queryset, since django relabels
+        # the tables of nested querysets, but not the ones in _not_live_at's extra SQL
+        sql, params = content.values('unit_pk').query.sql_with_params()
+        return ContentUnit.objects.using(self._state.db).filter(pk__in=RawSQL(sql, params))
+
+    def units(self):
+        # The ContentUnits in this version, using the version content index
+        # on (repository, version_added)
+        return self._units(self._live_at(self.number))
+
+    def units_added_since(self, version):
+        # ContentUnits in this version that weren't in the given (earlier) version. Only
+        # looks at the rows for the versions in between, so this is proportional to the number
+        # of changes, not the size of the repository. A unit that was removed and added again
+        # in between has a new row, but if it was also in the given version it hasn't been
+        # added since, which is an anti-join on the (repository, unit_pk) index.
+        version = getattr(version, 'number', version)
+        content = self._live_at(self.number).filter(version_added__gt=version)
+        return self._units(self._not_live_at(content, version))
+
+    def units_removed_since(self, version):
+        # ContentUnits in the given (earlier) version that aren't in this one, the same way
+        version = getattr(version, 'number', version)
+        content = self._live_at(version).filter(version_removed__lte=self.number)
+        return self._units(self._not_live_at(content, self.number))
+
+    def diff(self, version):
+        # Per-type counts of what changed between the given (earlier) version and this one,
+        # as a RepositoryDiff
+        def counts(units):
+            return dict(units.order_by().values_list('content_type').annotate(Count('pk')))
+        return RepositoryDiff(added=counts(self.units_added_since(version)),
+                              removed=counts(self.units_removed_since(version)))
+
+    def restore(self):
+        # Make the repository's content the same as this version's, by removing the units
+        # that weren't in it with one DELETE, and adding the ones that are missing, in one
+        # RepositoryChangeTracker. The restored content is recorded as a new version, which is
+        # returned, so the history of versions is never rewritten.
+        repository = self.repository
+        version_units = self.units().values('pk')
+        with RepositoryChangeTracker(using=self._state.db):
+            RepositoryContentUnit.objects.using(self._state.db).filter(
+                repository=repository).exclude(content_unit__in=version_units).delete()
+            missing = self.units().exclude(repositories=repository)
+            RepositoryContentUnit.objects.db_manager(self._state.db).associate(
+                repository, missing)
+            return RepositoryVersion.objects.db_manager(self._state.db).create_version(
+                repository)
+
+
+class RepositoryVersionContent(UUIDModel):
+    # A unit's membership in a range of a repository's versions: it was added in version_added,
+    # and removed in version_removed, or is still in the latest version if that's null. A unit
+    # that's removed and later added again gets a new row. Like RepositoryContentUnitRemoval,
+    # unit_pk isn't a foreign key, so deleting a unit doesn't rewrite the history of versions;
+    # deleted units just aren't found by the version's queries anymore.
+    repository = models.ForeignKey(Repository, related_name='version_content',
+                                   on_delete=models.CASCADE)
+    unit_pk = models.UUIDField()
+    version_added = models.PositiveIntegerField()
+    version_removed = models.PositiveIntegerField(null=True)
+
+    class Meta:
+        index_together = [
+            ('repository', 'version_added', 'version_removed'),
+            ('repository', 'version_removed'),
+            ('repository', 'unit_pk'),
+        ]
 
 
 class DataTypesDemo(UUIDModel):
@@ -487,30 +1923,72 @@ class DataTypesDemo(UUIDModel):
     boolean = models.BooleanField()
 
 
-def units_changed(repository, action):
-    # update repo last_changed_* timestamps based on the action taken
+def units_changed(repository, action, timestamp=None, removed=None, counts=None, units=None):
+    # update repo last_changed_* timestamps based on the action taken. repository can be
+    # a Repository instance or pk. Inside a RepositoryChangeTracker, this only records the
+    # change, to be written once for the whole block; otherwise it's written immediately.
+    # See RepositoryChangeTracker.record for removed, counts, and units.
     # XXX: It seems like this would be pretty slow and not very useful,
     # so figure out what this is for and if we can get rid of it
-    now = timezone.now()
-    if action == 'save':
-        update = {'last_unit_added': now}
-    elif action == 'delete':
-        update = {'last_unit_removed': now}
+    tracker = RepositoryChangeTracker.current()
+    if tracker is not None:
+        tracker.record(repository, action, timestamp, counts, removed, units)
     else:
-        # unknown action
-        return
+        with RepositoryChangeTracker() as tracker:
+            tracker.record(repository, action, timestamp, counts, removed, units)
+
 
-    for k, v in update.items():
-        setattr(repository, k, v)
-    repository.save(update_fields=update.keys())
+def _instance_repository(instance):
+    # The RepositoryContentUnit's repository instance if it's already loaded, so that its
+    # timestamp attrs are kept up to date, otherwise just the pk to avoid a query per row
+    cache_name = instance._meta.get_field('repository').get_cache_name()
+    return getattr(instance, cache_name, None) or instance.repository_id
+
+
+def _instance_unit(instance):
+    cache_name = instance._meta.get_field('content_unit').get_cache_name()
+    return getattr(instance, cache_name, None)
+
+
+def _instance_counts(instance):
+    # The unit count change for one association, {content type of its unit: 1}, so that the
+    # repository's counts get a delta rather than being counted from scratch. The unit is
+    # looked up by PK if it isn't loaded, in one batch per delete when there's a tracker (see
+    # RepositoryChangeTracker.unit_content_type). If it's gone, returns None for a recount.
+    unit = _instance_unit(instance)
+    tracker = RepositoryChangeTracker.current()
+    if unit is not None:
+        content_type = unit.content_type
+    elif tracker is not None:
+        content_type = tracker.unit_content_type(instance.content_unit_id, instance._state.db)
+    else:
+        content_type = ContentUnit.objects.using(instance._state.db).filter(
+            pk=instance.content_unit_id).values_list('content_type', flat=True).first()
+    if content_type is None:
+        return None
+    return {content_type: 1}
+
+
+def units_saved(sender, instance, created, **kwargs):
+    # Saving an existing association doesn't change the repository's content. New ones are
+    # recorded after the save, so that last_unit_added is never older than the association's
+    # updated timestamp, which Repository.changes_since relies on.
+    if not created:
+        return
+    units_changed(_instance_repository(instance), 'save', instance.updated,
+                  counts=_instance_counts(instance), units=[instance.content_unit_id])
 
 
-def units_saved(sender, instance, **kwargs):
-    units_changed(instance.repository, 'save')
+def units_deleting(sender, instance, **kwargs):
+    tracker = RepositoryChangeTracker.current()
+    if tracker is not None and _instance_unit(instance) is None:
+        tracker.expect_delete(instance.content_unit_id)
 
 
 def units_deleted(sender, instance, **kwargs):
-    units_changed(instance.repository, 'delete')
+    units_changed(_instance_repository(instance), 'delete', removed=[instance.content_unit_id],
+                  counts=_instance_counts(instance))
 
-signals.pre_save.connect(units_saved, sender=RepositoryContentUnit)
+signals.post_save.connect(units_saved, sender=RepositoryContentUnit)
+signals.pre_delete.connect(units_deleting, sender=RepositoryContentUnit)
 signals.post_delete.connect(units_deleted, sender=RepositoryContentUnit)
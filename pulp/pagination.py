@@ -0,0 +1,100 @@
+import base64
+import json
+from collections import OrderedDict
+
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+class KeysetPagination(BasePagination):
+    """Cursor pagination that seeks to the next page using the values of the last row on a page
+
+    DRF's CursorPagination only seeks on the first ordering field, then falls back to offsets
+    for rows that share a value in that field. This pagination orders by all of the fields in
+    ordering, which together must uniquely identify a row, and the cursor for the next page is
+    the values of those fields in the last row of the current page. The next page is found with
+    a row comparison against those values, which an index on the ordering fields can satisfy
+    directly, so every page costs the same no matter how deep into the results it is.
+
+    """
+    # Field names to order by, ascending. Subclasses must set this.
+    ordering = ()
+    page_size = 100
+    page_size_query_param = 'page_size'
+    max_page_size = 1000
+    cursor_query_param = 'cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        page_size = self.get_page_size(request)
+        queryset = queryset.order_by(*self.ordering)
+
+        cursor = request.query_params.get(self.cursor_query_param)
+        if cursor:
+            queryset = self.seek(queryset, self.decode_cursor(cursor))
+
+        # fetch one extra row to find out if there's another page
+        rows = list(queryset[:page_size + 1])
+        self.has_next = len(rows) > page_size
+        rows = rows[:page_size]
+        self.last_values = self.row_values(rows[-1]) if rows else None
+        return rows
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('results', data),
+        ]))
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param,
+                                   self.encode_cursor(self.last_values))
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return max(1, min(page_size, self.max_page_size))
+
+    def row_values(self, row):
+        return [getattr(row, self.get_field(row._meta.model, name).attname)
+                for name in self.ordering]
+
+    def seek(self, queryset, values):
+        # rows that sort after values, e.g. (a, b) > (%s, %s)
+        if len(self.ordering) == 1:
+            return queryset.filter(**{'{}__gt'.format(self.ordering[0]): values[0]})
+        columns = []
+        for name in self.ordering:
+            field = self.get_field(queryset.model, name)
+            columns.append('{}.{}'.format(field.model._meta.db_table, field.column))
+        where = '({}) > ({})'.format(', '.join(columns), ', '.join(['%s'] * len(values)))
+        return queryset.extra(where=[where], params=values)
+
+    @staticmethod
+    def get_field(model, name):
+        if name == 'pk':
+            return model._meta.pk
+        return model._meta.get_field(name)
+
+    @staticmethod
+    def encode_cursor(values):
+        # values that JSON doesn't know about (UUIDs, datetimes) are sent as strings,
+        # which postgres will happily compare with the original column types
+        data = json.dumps(values, default=str).encode('utf8')
+        return base64.urlsafe_b64encode(data).decode('ascii')
+
+    def decode_cursor(self, cursor):
+        try:
+            values = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf8'))
+        except (TypeError, ValueError, UnicodeError):
+            values = None
+        if not isinstance(values, list) or len(values) != len(self.ordering):
+            raise NotFound('Invalid cursor')
+        return values
@@ -23,13 +23,39 @@ class ContentUnitRelatedField(serializers.HyperlinkedRelatedField):
         model = models.ContentUnit
 
 
-class RepositorySerializer(serializers.HyperlinkedModelSerializer):
+class SparseFieldsMixin:
+    """Serializer mixin that only renders the fields named in the 'fields' query param
+
+    e.g. ?fields=slug,last_unit_added. Views can use requested_fields to skip the work of
+    loading the data for fields that weren't asked for.
+    """
+    fields_query_param = 'fields'
+
+    def __init__(self, *args, **kwargs):
+        super(SparseFieldsMixin, self).__init__(*args, **kwargs)
+        requested = self.requested_fields(self.context.get('request'))
+        if requested is not None:
+            for name in set(self.fields) - requested:
+                self.fields.pop(name)
+
+    @classmethod
+    def requested_fields(cls, request):
+        # The set of requested field names, or None if all fields should be rendered
+        if request is None:
+            return None
+        value = request.query_params.get(cls.fields_query_param)
+        if not value:
+            return None
+        return set(name.strip() for name in value.split(',') if name.strip())
+
+
+class RepositorySerializer(SparseFieldsMixin, serializers.HyperlinkedModelSerializer):
     _href = serializers.HyperlinkedIdentityField(
         view_name='repository-detail',
         lookup_field='slug',
     )
 
-    content_unit_counts = serializers.DictField()
+    content_unit_counts = serializers.DictField(read_only=True)
 
     class Meta:
         model = models.Repository
@@ -47,3 +73,4 @@ class ContentUnitSerializer(serializers.HyperlinkedModelSerializer):
 
     class Meta:
         model = models.ContentUnit
+        fields = '__all__'
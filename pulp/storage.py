@@ -1,10 +1,249 @@
+import errno
+import hashlib
 import os
+import shutil
+import tempfile
+import time
 
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage
 
-def content_unit_path(content_unit_file, filename):
-    # This is basically pulp.server.content.storage.get_path, but only needs to return the unit
-    # type and unit key digest path components
-    unit = content_unit_file.unit
-    content_type = unit.content_type
-    digest = unit.key_digest
-    return os.path.join('units', content_type, digest[0:2], digest[2:], filename)
+from pulp.utils import HASH_CHUNK_SIZE
+
+try:
+    import fcntl
+except ImportError:
+    # not on linux (or any other unix), so no reflinks
+    fcntl = None
+
+# ioctl request to make dst a copy-on-write clone of src on filesystems that support it
+# (btrfs, xfs with reflink=1), from linux/fs.h
+FICLONE = 0x40049409
+
+# Seconds before a prune that a blob has to have been saved, for prune to consider removing it
+PRUNE_GRACE = 60 * 60
+
+
+class StagedFile(File):
+    # A new file in a ContentAddressableStorage staging area, e.g. for a downloader to write
+    # into. Assign it to a ContentUnitFile's content field once it's written, and when that's
+    # saved the staged file is linked into the blob store, rather than copied.
+    # If the writer already hashed what it wrote, it can set digest to the sha256 hexdigest of
+    # the contents, and the storage uses that rather than reading the file again to hash it.
+    def __init__(self, storage=None):
+        storage = storage or content_storage
+        os.makedirs(storage.staging_path(), exist_ok=True)
+        fd, path = tempfile.mkstemp(dir=storage.staging_path())
+        super(StagedFile, self).__init__(os.fdopen(fd, 'w+b'), name=os.path.basename(path))
+        self.path = path
+        self.digest = None
+        self._size = None
+
+    @property
+    def size(self):
+        if self.closed:
+            return self._size
+        self.file.flush()
+        return os.fstat(self.file.fileno()).st_size
+
+    def close(self):
+        # Saving moves the file out of staging before closing it, so its size is recorded from
+        # the still-open file, for anything that wants it after the save
+        if not self.closed:
+            self._size = self.size
+        super(StagedFile, self).close()
+
+    def temporary_file_path(self):
+        # same as django's TemporaryUploadedFile, so storage can tell this is already on disk
+        return self.path
+
+    def discard(self):
+        # throw away a staged file that isn't going to be saved
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class ContentAddressableStorage(FileSystemStorage):
+    """File storage where every file is stored once, named by the sha256 of its contents
+
+    Files are stored as blobs/sha256/<first 2 digest chars>/<rest of the digest>, regardless of
+    the name they're saved with, so any number of ContentUnitFiles with the same contents point
+    at the same blob, and saving contents that are already stored doesn't write anything.
+
+    New files are written to a staging directory next to the blobs (on the same filesystem),
+    hashed as they're written, and then hard linked to their blob name. Linking is atomic, so a
+    blob is never seen half-written, and if two saves of the same contents race, one of them
+    finds the blob already there and throws its copy away. Files that are already on disk
+    (StagedFiles, or django's uploaded temporary files) are hashed in place and then linked, or
+    reflinked if they're on another filesystem, and only copied if neither is possible.
+
+    Blobs are shared, so deleting a file through the storage (or the FileField) doesn't remove
+    the blob; use prune to remove the ones that nothing uses anymore. Every save touches the
+    blob it's stored as, even if it was already there, so that prune can leave recently saved
+    blobs alone.
+
+    """
+    BLOB_DIR = 'blobs'
+    STAGING_DIR = 'staging'
+
+    def blob_name(self, digest):
+        return os.path.join(self.BLOB_DIR, 'sha256', digest[0:2], digest[2:])
+
+    def staging_path(self):
+        return self.path(self.STAGING_DIR)
+
+    def get_available_name(self, name, max_length=None):
+        # names are decided by _save, and an existing blob is what we want, not a conflict
+        return name
+
+    def _save(self, name, content):
+        # FileField saves the FieldFile wrapping what was assigned to it, which doesn't proxy
+        # temporary_file_path, so look inside it for a file that's already on disk
+        inner = getattr(content, 'file', None)
+        if hasattr(inner, 'temporary_file_path'):
+            content = inner
+        if not hasattr(content, 'temporary_file_path'):
+            return self._save_stream(content)
+        source = content.temporary_file_path()
+        if not content.closed:
+            # anything written to it but still buffered needs to be on disk to be hashed
+            content.flush()
+        try:
+            # files hashed as they were written, or by ContentUnitFile.compute_digests,
+            # aren't read again here
+            digest = getattr(content, 'digest', None) or _file_digest(source)
+            if os.path.dirname(os.path.abspath(source)) == os.path.abspath(self.staging_path()):
+                # our own staged file, which is moved into place
+                return self._commit(source, digest)
+            return self._commit_external(source, digest)
+        finally:
+            content.close()
+
+    def _save_stream(self, content):
+        # write the content to the staging area, hashing it on the way
+        os.makedirs(self.staging_path(), exist_ok=True)
+        fd, staged = tempfile.mkstemp(dir=self.staging_path())
+        hasher = hashlib.sha256()
+        try:
+            with os.fdopen(fd, 'wb') as staged_file:
+                for chunk in content.chunks(HASH_CHUNK_SIZE):
+                    if isinstance(chunk, str):
+                        chunk = chunk.encode('utf8')
+                    hasher.update(chunk)
+                    staged_file.write(chunk)
+            return self._commit(staged, hasher.hexdigest())
+        finally:
+            if os.path.exists(staged):
+                os.remove(staged)
+
+    def _commit(self, staged, digest):
+        # link a file from the staging area to its blob name, and remove it from staging
+        name = self.blob_name(digest)
+        path = self.path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if self.file_permissions_mode is not None:
+            os.chmod(staged, self.file_permissions_mode)
+        try:
+            os.link(staged, path)
+        except FileExistsError:
+            # already stored
+            _touch(path)
+        except OSError:
+            # no hard links on this filesystem; renames are atomic too
+            if not os.path.exists(path):
+                os.rename(staged, path)
+        if os.path.exists(staged):
+            os.remove(staged)
+        return name
+
+    def _commit_external(self, source, digest):
+        # source isn't ours to move, so link straight to it if possible, or
+        # otherwise reflink (or copy) it into the staging area and commit that
+        name = self.blob_name(digest)
+        path = self.path(name)
+        if os.path.exists(path):
+            _touch(path)
+            return name
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            os.link(source, path)
+            return name
+        except FileExistsError:
+            _touch(path)
+            return name
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP):
+                raise
+
+        os.makedirs(self.staging_path(), exist_ok=True)
+        fd, staged = tempfile.mkstemp(dir=self.staging_path())
+        os.close(fd)
+        try:
+            if not _reflink(source, staged):
+                shutil.copyfile(source, staged)
+            return self._commit(staged, digest)
+        finally:
+            if os.path.exists(staged):
+                os.remove(staged)
+
+    def delete(self, name):
+        # Blobs can be shared by any number of files, so they're only ever removed by prune
+        pass
+
+    def prune(self, in_use, grace=PRUNE_GRACE):
+        # Remove every blob that isn't named in in_use, an iterable of the names (e.g.
+        # ContentUnitFile content values) still using blobs. Returns the number removed.
+        # Blobs saved less than grace seconds before the prune started are kept, since the
+        # ContentUnitFile of a save that hasn't committed yet can't be in in_use. Linking and
+        # touching both update a file's ctime, so that's when a blob was last saved.
+        # So in_use can be read by this (e.g. a lazy iterator), or up to grace seconds before.
+        cutoff = time.time() - grace
+        in_use = set(in_use)
+        removed = 0
+        for directory, subdirectories, filenames in os.walk(self.path(self.BLOB_DIR)):
+            for filename in filenames:
+                path = os.path.join(directory, filename)
+                if os.path.relpath(path, self.location) in in_use:
+                    continue
+                try:
+                    if os.stat(path).st_ctime >= cutoff:
+                        continue
+                    os.remove(path)
+                except FileNotFoundError:
+                    continue
+                removed += 1
+        return removed
+
+
+def _file_digest(path):
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def _touch(path):
+    # mark an existing blob as just saved, for prune
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+
+
+def _reflink(source, destination):
+    # Make destination a copy-on-write clone of source, returning False if the
+    # filesystem (or OS) doesn't support that
+    if fcntl is None:
+        return False
+    try:
+        with open(source, 'rb') as src, open(destination, 'wb') as dst:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        return True
+    except OSError:
+        return False
+
+
+# The storage used by ContentUnitFile
+content_storage = ContentAddressableStorage()
@@ -0,0 +1,64 @@
+import os
+import shutil
+import tempfile
+from datetime import timedelta
+from io import StringIO
+
+from django.core.files.base import ContentFile
+from django.core.management import call_command
+from django.test import TestCase
+from django.utils import timezone
+
+from pulp.models import ContentUnitFile
+from pulp.storage import content_storage
+from pulp.utils import VERIFY_CORRUPT, VERIFY_MISSING, VERIFY_OK
+from pulp_rpm.tests.test_models import make_rpm
+
+
+class VerifyContentTests(TestCase):
+    def setUp(self):
+        location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, location)
+        self.addCleanup(setattr, content_storage, 'location', content_storage.location)
+        content_storage.location = location
+
+        self.unit = make_rpm()
+        self.ok = self.unit_file(b'ok')
+        self.corrupt = self.unit_file(b'corrupt')
+        self.missing = self.unit_file(b'missing')
+        with open(self.corrupt.content.path, 'wb') as f:
+            f.write(b'CORRUPT')
+        os.remove(self.missing.content.path)
+
+    def unit_file(self, data):
+        unit_file = ContentUnitFile(unit=self.unit, content=ContentFile(data, name='file'))
+        unit_file.save(algorithms=['sha256'])
+        return unit_file
+
+    def verify(self, *args):
+        out = StringIO()
+        call_command('verify_content', *args, workers=2, batch_size=2, stdout=out)
+        return out.getvalue()
+
+    def statuses(self):
+        return dict((unit_file.pk, unit_file.verify_status)
+                    for unit_file in ContentUnitFile.objects.all())
+
+    def test_verify(self):
+        out = self.verify()
+        self.assertEqual(self.statuses(), {
+            self.ok.pk: VERIFY_OK,
+            self.corrupt.pk: VERIFY_CORRUPT,
+            self.missing.pk: VERIFY_MISSING,
+        })
+        self.assertIn('Verified 3 files', out)
+        self.assertFalse(ContentUnitFile.objects.filter(verified__isnull=True).exists())
+
+    def test_resume(self):
+        # files that were already verified are skipped, unless they're old enough
+        self.verify()
+        self.assertIn('Verified 0 files', self.verify())
+        ContentUnitFile.objects.filter(pk=self.ok.pk).update(
+            verified=timezone.now() - timedelta(hours=2))
+        self.assertIn('Verified 1 files', self.verify('--older-than', '1'))
+        self.assertIn('Verified 3 files', self.verify('--all'))
@@ -0,0 +1,255 @@
+import hashlib
+
+from django.apps import apps
+from django.contrib.contenttypes.models import ContentType
+from django.core.files.base import ContentFile
+from django.db import connection
+from django.test import SimpleTestCase, TestCase
+from django.test.utils import CaptureQueriesContext
+
+from pulp import models
+from pulp.models import (Checksum, ContentUnitFile, GenericModel, Importer, NamedTupleDescriptor,
+                         Notes, Repository, UnitKeyDescriptor, get_content_type,
+                         prefetch_generic)
+
+
+class KeyedThing(object):
+    KEY_FIELDS = ('name', 'version')
+    KEY_TUPLE = NamedTupleDescriptor('KEY_FIELDS', 'KeyTuple')
+    UNIT_KEY = UnitKeyDescriptor('KEY_FIELDS', 'KEY_TUPLE')
+
+    def __init__(self, name, version):
+        self.name = name
+        self.version = version
+
+
+class OtherKeyedThing(KeyedThing):
+    KEY_FIELDS = ('name',)
+
+
+class NamedTupleDescriptorTests(SimpleTestCase):
+    def test_class_access(self):
+        # UnitKeyDescriptor looks KEY_TUPLE up on the class, so it must work without an instance
+        key_tuple = KeyedThing.KEY_TUPLE
+        self.assertEqual(key_tuple.__name__, 'KeyedThingKeyTuple')
+        self.assertEqual(key_tuple._fields, ('name', 'version'))
+
+    def test_instance_access(self):
+        self.assertIs(KeyedThing('a', '1').KEY_TUPLE, KeyedThing.KEY_TUPLE)
+
+    def test_cached_per_class(self):
+        self.assertIsNot(KeyedThing.KEY_TUPLE, OtherKeyedThing.KEY_TUPLE)
+        self.assertEqual(OtherKeyedThing.KEY_TUPLE._fields, ('name',))
+
+    def test_unit_key_fresh_class(self):
+        # first access to UNIT_KEY, before anything has touched KEY_TUPLE for this class
+        class FreshThing(KeyedThing):
+            pass
+        thing = FreshThing('a', '1')
+        self.assertEqual(FreshThing.UNIT_KEY.tuple(thing), ('a', '1'))
+        self.assertEqual(FreshThing.UNIT_KEY.digest(thing),
+                         FreshThing.UNIT_KEY.digest_values(['a', '1']))
+
+
+class ComputeDigestsTests(SimpleTestCase):
+    data = b'contents' * 1000
+
+    def unit_file(self, **fields):
+        return ContentUnitFile(content=ContentFile(self.data, name='contents'), **fields)
+
+    def digest(self, algorithm):
+        return hashlib.new(algorithm, self.data).hexdigest()
+
+    def test_all(self):
+        unit_file = self.unit_file()
+        unit_file.compute_digests()
+        for algorithm in ('md5', 'sha1', 'sha224', 'sha256', 'sha384', 'sha512'):
+            self.assertEqual(getattr(unit_file, algorithm), self.digest(algorithm))
+        self.assertEqual(unit_file.file_size, len(self.data))
+        self.assertEqual(unit_file.best_checksum, Checksum('sha512', self.digest('sha512')))
+
+    def test_algorithms(self):
+        unit_file = self.unit_file()
+        unit_file.compute_digests(['sha256'], threaded=True)
+        self.assertEqual(unit_file.digests, {'sha256': self.digest('sha256')})
+        # passed along so that the storage doesn't hash the file again when it's saved
+        self.assertEqual(unit_file.content.file.digest, self.digest('sha256'))
+
+    def test_trusted(self):
+        unit_file = self.unit_file(sha256='from upstream')
+        unit_file.compute_digests(['sha1', 'sha256'], trusted=True)
+        self.assertEqual(unit_file.sha256, 'from upstream')
+        self.assertEqual(unit_file.sha1, self.digest('sha1'))
+
+    def test_unknown(self):
+        with self.assertRaises(ValueError):
+            self.unit_file().compute_digests(['crc32'])
+
+
+class CachedMappingTests(TestCase):
+    def setUp(self):
+        self.repository = Repository.objects.create(slug='notes')
+        self.repository.notes.mapping.update({'a': '1', 'b': '2'})
+
+    def test_reads_one_query(self):
+        mapping = self.repository.notes.cached_mapping
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(mapping['a'], '1')
+            self.assertEqual(mapping['b'], '2')
+            self.assertEqual(sorted(mapping), ['a', 'b'])
+            self.assertEqual(len(mapping), 2)
+            with self.assertRaises(KeyError):
+                mapping['c']
+        self.assertEqual(len(queries), 1)
+
+    def test_shared_cache(self):
+        # every access through the same instance uses the same mapping
+        self.assertIs(self.repository.notes.cached_mapping, self.repository.notes.cached_mapping)
+
+    def test_buffered_writes(self):
+        with self.repository.notes.cached_mapping as mapping:
+            mapping['a'] = 10
+            mapping['c'] = '3'
+            del mapping['b']
+            self.assertEqual(dict(mapping), {'a': '10', 'c': '3'})
+            # nothing is written until the block exits
+            self.assertEqual(self.stored(), {'a': '1', 'b': '2'})
+        self.assertEqual(self.stored(), {'a': '10', 'c': '3'})
+
+    def test_error_discards_writes(self):
+        with self.assertRaises(ValueError):
+            with self.repository.notes.cached_mapping as mapping:
+                mapping['a'] = 'changed'
+                raise ValueError
+        self.assertEqual(self.stored(), {'a': '1', 'b': '2'})
+
+    def test_prefetched(self):
+        Repository.objects.create(slug='other').notes.mapping['x'] = 'y'
+        repositories = list(Repository.objects.order_by('slug').prefetch_related('notes'))
+        with CaptureQueriesContext(connection) as queries:
+            contents = [dict(r.notes.cached_mapping) for r in repositories]
+        self.assertEqual(contents, [{'a': '1', 'b': '2'}, {'x': 'y'}])
+        self.assertEqual(len(queries), 0)
+
+    def test_refresh(self):
+        mapping = self.repository.notes.cached_mapping
+        self.assertEqual(mapping['a'], '1')
+        self.repository.notes.mapping['a'] = 'changed'
+        self.assertEqual(mapping['a'], '1')
+        mapping.refresh()
+        self.assertEqual(mapping['a'], 'changed')
+
+    def stored(self):
+        return dict(Notes.objects.filter(object_id=self.repository.pk).values_list('key', 'value'))
+
+
+class KeyValueWriteTests(TestCase):
+    def setUp(self):
+        self.repository = Repository.objects.create(slug='scratch')
+        self.other = Repository.objects.create(slug='other')
+        self.other.notes.mapping['a'] = 'other'
+
+    def stored(self, repository=None):
+        repository = repository or self.repository
+        return dict(Notes.objects.filter(object_id=repository.pk).values_list('key', 'value'))
+
+    def test_setitem(self):
+        mapping = self.repository.notes.mapping
+        mapping['a'] = 1
+        mapping['a'] = 2
+        self.assertEqual(mapping['a'], '2')
+        self.assertEqual(Notes.objects.filter(object_id=self.repository.pk).count(), 1)
+
+    def test_update(self):
+        mapping = self.repository.notes.mapping
+        mapping['a'] = 'old'
+        with CaptureQueriesContext(connection) as queries:
+            mapping.update({'a': 'new', 'b': 'b'}, c='c')
+        inserts = [query for query in queries if query['sql'].startswith('INSERT')]
+        self.assertEqual(len(inserts), 1)
+        self.assertEqual(self.stored(), {'a': 'new', 'b': 'b', 'c': 'c'})
+        # other objects' keys are left alone
+        self.assertEqual(self.stored(self.other), {'a': 'other'})
+
+    def test_bulk_delete(self):
+        mapping = self.repository.notes.mapping
+        mapping.update({'a': '1', 'b': '2', 'c': '3'})
+        mapping.bulk_delete(['a', 'b', 'missing'])
+        self.assertEqual(self.stored(), {'c': '3'})
+        self.assertEqual(self.stored(self.other), {'a': 'other'})
+        del mapping['c']
+        self.assertEqual(self.stored(), {})
+
+    def test_manager_needs_instance(self):
+        with self.assertRaises(TypeError):
+            Notes.objects.bulk_set({'a': 'b'})
+
+
+class ContentTypeTests(TestCase):
+    def setUp(self):
+        # start cold, as if in a new process
+        ContentType.objects.clear_cache()
+        models._content_types_warmed.discard('default')
+
+    def test_one_query(self):
+        with CaptureQueriesContext(connection) as queries:
+            repository_type = get_content_type(Repository)
+            importer_type = get_content_type(Importer)
+            get_content_type(Notes)
+        self.assertEqual(len(queries), 1)
+        self.assertEqual(repository_type, ContentType.objects.get_for_model(Repository))
+        self.assertEqual(importer_type.model, 'importer')
+
+    def test_generic_indexes(self):
+        # every generic table is indexed for lookups through its GenericRelations
+        for model in apps.get_models():
+            if issubclass(model, GenericModel):
+                self.assertIn(('content_type', 'object_id'), model._meta.index_together,
+                              model._meta.object_name)
+
+
+class PrefetchGenericTests(TestCase):
+    def setUp(self):
+        self.repositories = []
+        self.importers = []
+        for i in range(3):
+            repository = Repository.objects.create(slug='repo{}'.format(i))
+            repository.notes.mapping['note'] = str(i)
+            repository._scratchpad.mapping['scratch'] = str(i)
+            importer = Importer.objects.create(repository=repository, importer_type_id='yum')
+            importer.config.mapping['feed'] = str(i)
+            importer._scratchpad.mapping['scratch'] = 'importer{}'.format(i)
+            self.repositories.append(repository)
+            self.importers.append(importer)
+        # fresh instances, with nothing cached
+        self.repositories = list(Repository.objects.order_by('slug'))
+        self.importers = list(Importer.objects.order_by('repository__slug'))
+        get_content_type(Repository)
+
+    def test_mixed_parents(self):
+        parents = self.repositories + self.importers
+        with CaptureQueriesContext(connection) as queries:
+            prefetch_generic(parents, 'notes', 'config', '_scratchpad')
+        # one query for each of Notes, Config, and Scratchpad
+        self.assertEqual(len(queries), 3)
+
+        with CaptureQueriesContext(connection) as queries:
+            for i, (repository, importer) in enumerate(zip(self.repositories, self.importers)):
+                self.assertEqual(dict(repository.notes.cached_mapping), {'note': str(i)})
+                self.assertEqual(dict(repository._scratchpad.cached_mapping),
+                                 {'scratch': str(i)})
+                self.assertEqual(dict(importer.config.cached_mapping), {'feed': str(i)})
+                self.assertEqual(dict(importer._scratchpad.cached_mapping),
+                                 {'scratch': 'importer{}'.format(i)})
+        self.assertEqual(len(queries), 0)
+
+    def test_empty(self):
+        repository = Repository.objects.create(slug='empty')
+        prefetch_generic([repository], 'notes')
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(list(repository.notes.all()), [])
+        self.assertEqual(len(queries), 0)
+
+    def test_not_generic(self):
+        with self.assertRaises(ValueError):
+            prefetch_generic(self.importers, 'repository')
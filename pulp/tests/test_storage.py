@@ -0,0 +1,73 @@
+import hashlib
+import os
+import shutil
+import tempfile
+from unittest import mock
+
+from django.core.files.base import ContentFile
+from django.test import SimpleTestCase
+
+from pulp import storage
+
+
+class ContentAddressableStorageTests(SimpleTestCase):
+    def setUp(self):
+        location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, location)
+        self.storage = storage.ContentAddressableStorage(location=location)
+
+    def staged(self, data):
+        staged = storage.StagedFile(self.storage)
+        staged.write(data)
+        return staged
+
+    def test_blob_name(self):
+        name = self.storage.save('anything', ContentFile(b'stream'))
+        self.assertEqual(name, self.storage.blob_name(hashlib.sha256(b'stream').hexdigest()))
+        with self.storage.open(name) as f:
+            self.assertEqual(f.read(), b'stream')
+
+    def test_staged(self):
+        staged = self.staged(b'staged')
+        name = self.storage.save('anything', staged)
+        self.assertEqual(name, self.storage.blob_name(hashlib.sha256(b'staged').hexdigest()))
+        # moved out of staging, not copied
+        self.assertFalse(os.path.exists(staged.path))
+        self.assertEqual(os.listdir(self.storage.staging_path()), [])
+
+    def test_staged_size(self):
+        staged = self.staged(b'staged')
+        self.assertEqual(staged.size, 6)
+        self.storage.save('anything', staged)
+        # closed and moved by the save, but still knows its size
+        self.assertTrue(staged.closed)
+        self.assertEqual(staged.size, 6)
+
+    def test_staged_digest(self):
+        staged = self.staged(b'staged')
+        staged.digest = hashlib.sha256(b'staged').hexdigest()
+        with mock.patch.object(storage, '_file_digest') as file_digest:
+            name = self.storage.save('anything', staged)
+        self.assertFalse(file_digest.called)
+        self.assertEqual(name, self.storage.blob_name(staged.digest))
+
+    def test_deduplicated(self):
+        first = self.storage.save('first', self.staged(b'same'))
+        second = self.storage.save('second', ContentFile(b'same'))
+        self.assertEqual(first, second)
+        self.storage.delete(first)
+        self.assertTrue(self.storage.exists(first))
+
+    def test_discard(self):
+        staged = self.staged(b'discarded')
+        staged.discard()
+        self.assertFalse(os.path.exists(staged.path))
+
+    def test_prune(self):
+        kept = self.storage.save('kept', ContentFile(b'kept'))
+        unused = self.storage.save('unused', ContentFile(b'unused'))
+        # both were just saved, so neither is old enough to prune
+        self.assertEqual(self.storage.prune([kept]), 0)
+        self.assertEqual(self.storage.prune([kept], grace=-60), 1)
+        self.assertTrue(self.storage.exists(kept))
+        self.assertFalse(self.storage.exists(unused))
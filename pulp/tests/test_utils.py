@@ -0,0 +1,108 @@
+import hashlib
+import os
+import shutil
+import tempfile
+
+from django.db import connection, transaction
+from django.test import SimpleTestCase, TransactionTestCase
+
+from pulp.utils import (VERIFY_CORRUPT, VERIFY_MISSING, VERIFY_OK, chunked, digest_chunks,
+                        stream_sql, verify_file)
+
+SERIES = 'SELECT generate_series(1, %s)'
+
+
+class ChunkedTests(SimpleTestCase):
+    def test_chunked(self):
+        self.assertEqual(list(chunked(range(5), 2)), [[0, 1], [2, 3], [4]])
+        self.assertEqual(list(chunked([], 2)), [])
+
+
+class DigestChunksTests(SimpleTestCase):
+    chunks = [b'one', 'two', b'three']
+    data = b'onetwothree'
+
+    def expected(self, algorithms):
+        return dict((algorithm, hashlib.new(algorithm, self.data).hexdigest())
+                    for algorithm in algorithms), len(self.data)
+
+    def test_digests(self):
+        algorithms = ['md5', 'sha1', 'sha256']
+        self.assertEqual(digest_chunks(self.chunks, algorithms), self.expected(algorithms))
+
+    def test_threaded(self):
+        algorithms = ['sha256', 'sha512']
+        self.assertEqual(digest_chunks(self.chunks, algorithms, threaded=True),
+                         self.expected(algorithms))
+
+    def test_no_algorithms(self):
+        self.assertEqual(digest_chunks(iter(self.chunks), []), ({}, len(self.data)))
+
+
+class StreamSQLTests(TransactionTestCase):
+    # outside of the test case transaction, to see the transactions stream_sql opens
+
+    def test_stream(self):
+        rows = stream_sql(SERIES, [5], chunk_size=2)
+        self.assertEqual(next(rows), (1,))
+        # the cursor is read in a transaction that lasts as long as the rows are being read
+        self.assertTrue(connection.in_atomic_block)
+        self.assertEqual(list(rows), [(2,), (3,), (4,), (5,)])
+        self.assertFalse(connection.in_atomic_block)
+
+    def test_close(self):
+        rows = stream_sql(SERIES, [5], chunk_size=2)
+        next(rows)
+        rows.close()
+        self.assertFalse(connection.in_atomic_block)
+
+    def test_in_transaction(self):
+        with transaction.atomic():
+            savepoints = list(connection.savepoint_ids)
+            rows = stream_sql(SERIES, [3])
+            self.assertEqual(next(rows), (1,))
+            # the transaction that's already open is used, rather than nesting another
+            self.assertEqual(connection.savepoint_ids, savepoints)
+            self.assertEqual(list(rows), [(2,), (3,)])
+
+    def test_hold(self):
+        rows = stream_sql(SERIES, [3], hold=True)
+        self.assertEqual(next(rows), (1,))
+        self.assertFalse(connection.in_atomic_block)
+        self.assertEqual(list(rows), [(2,), (3,)])
+
+
+class VerifyFileTests(SimpleTestCase):
+    data = b'contents' * 1000
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, 'file')
+        with open(self.path, 'wb') as f:
+            f.write(self.data)
+        self.sha256 = hashlib.sha256(self.data).hexdigest()
+
+    def test_ok(self):
+        self.assertEqual(verify_file(self.path, len(self.data), 'sha256', self.sha256),
+                         (VERIFY_OK, len(self.data)))
+        # digests are compared without regard to case
+        self.assertEqual(verify_file(self.path, None, 'sha256', self.sha256.upper())[0],
+                         VERIFY_OK)
+
+    def test_no_digest(self):
+        # only the size is checked, so nothing is hashed
+        self.assertEqual(verify_file(self.path, len(self.data)), (VERIFY_OK, 0))
+
+    def test_missing(self):
+        self.assertEqual(verify_file(self.path + 'missing', 1, 'sha256', self.sha256),
+                         (VERIFY_MISSING, 0))
+
+    def test_wrong_size(self):
+        # the size is checked first, so the file isn't read
+        self.assertEqual(verify_file(self.path, len(self.data) + 1, 'sha256', self.sha256),
+                         (VERIFY_CORRUPT, 0))
+
+    def test_wrong_digest(self):
+        self.assertEqual(verify_file(self.path, len(self.data), 'sha256', '0' * 64),
+                         (VERIFY_CORRUPT, len(self.data)))
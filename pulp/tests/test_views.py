@@ -0,0 +1,84 @@
+from django.db import connection
+from django.test import SimpleTestCase, TestCase
+from django.test.utils import CaptureQueriesContext
+from rest_framework.exceptions import NotFound
+from rest_framework.test import APIClient
+
+from pulp.models import Repository
+from pulp.pagination import KeysetPagination
+from pulp_rpm.tests.test_models import make_rpm
+
+REPOSITORIES = '/api/v3/repositories/'
+
+
+class KeysetPaginationTests(SimpleTestCase):
+    def test_cursor_round_trip(self):
+        pagination = KeysetPagination()
+        pagination.ordering = ('name', 'pk')
+        cursor = pagination.encode_cursor(['foo', 3])
+        self.assertEqual(pagination.decode_cursor(cursor), ['foo', 3])
+
+    def test_invalid_cursor(self):
+        pagination = KeysetPagination()
+        pagination.ordering = ('name', 'pk')
+        for cursor in ('garbage', pagination.encode_cursor(['foo']),
+                       pagination.encode_cursor({'name': 'foo'})):
+            with self.assertRaises(NotFound):
+                pagination.decode_cursor(cursor)
+
+
+class RepositoryListTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+
+    def create(self, number):
+        repositories = [Repository.objects.create(slug='repo{}'.format(i)) for i in range(number)]
+        rpm = make_rpm()
+        for repository in repositories:
+            repository.add_units(rpm)
+        return repositories
+
+    def list_queries(self, url=REPOSITORIES):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return response, len(queries)
+
+    def test_counts(self):
+        self.create(1)
+        Repository.objects.create(slug='empty')
+        response, queries = self.list_queries()
+        results = dict((r['slug'], r['content_unit_counts']) for r in response.data['results'])
+        self.assertEqual(results, {'repo0': {'rpm': 1}, 'empty': {}})
+
+    def test_queries(self):
+        # the number of queries doesn't grow with the number of repositories listed
+        self.create(1)
+        response, one = self.list_queries()
+        self.create(5)
+        response, six = self.list_queries()
+        self.assertEqual(len(response.data['results']), 6)
+        self.assertEqual(one, six)
+
+    def test_pages(self):
+        self.create(5)
+        url = REPOSITORIES + '?page_size=2'
+        slugs = []
+        while url:
+            response = self.client.get(url)
+            slugs.extend(r['slug'] for r in response.data['results'])
+            url = response.data['next']
+        self.assertEqual(slugs, ['repo{}'.format(i) for i in range(5)])
+
+    def test_sparse_fields(self):
+        self.create(1)
+        response = self.client.get(REPOSITORIES + '?fields=slug,last_unit_added')
+        self.assertEqual(set(response.data['results'][0]), {'slug', 'last_unit_added'})
+        # counts weren't asked for, so they weren't read
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(REPOSITORIES + '?fields=slug,last_unit_added')
+        self.assertFalse(any('json_object_agg' in query['sql'] for query in queries))
+
+    def test_bad_cursor(self):
+        response = self.client.get(REPOSITORIES + '?cursor=garbage')
+        self.assertEqual(response.status_code, 404)
@@ -0,0 +1,129 @@
+import hashlib
+import os
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+from django.db import connections, transaction
+
+
+def chunked(iterable, size):
+    # Break an iterable up into lists of at most size items, without
+    # needing to know how long the iterable is ahead of time
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+# Read size used when hashing files. Big enough that the per-chunk python overhead is noise
+# next to the hashing itself, small enough that memory use doesn't depend on the file size.
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def digest_chunks(chunks, algorithms, threaded=False):
+    # Compute the hexdigests of several hashlib algorithms in a single pass over an iterable of
+    # bytes chunks (e.g. File.chunks()). Returns a tuple of ({algorithm: hexdigest}, total bytes).
+    # hashlib releases the GIL while hashing large buffers, so with threaded=True each algorithm
+    # gets its own thread, and the next chunk is read while the current one is being hashed.
+    hashers = {algorithm: hashlib.new(algorithm) for algorithm in algorithms}
+    size = 0
+
+    if threaded and len(hashers) > 1:
+        with ThreadPoolExecutor(max_workers=len(hashers)) as executor:
+            pending = []
+            for chunk in chunks:
+                chunk = _as_bytes(chunk)
+                size += len(chunk)
+                for future in pending:
+                    future.result()
+                pending = [executor.submit(hasher.update, chunk) for hasher in hashers.values()]
+            for future in pending:
+                future.result()
+    else:
+        for chunk in chunks:
+            chunk = _as_bytes(chunk)
+            size += len(chunk)
+            for hasher in hashers.values():
+                hasher.update(chunk)
+
+    return {algorithm: hasher.hexdigest() for algorithm, hasher in hashers.items()}, size
+
+
+# Results of verify_file
+VERIFY_OK = 'ok'
+VERIFY_MISSING = 'missing'
+VERIFY_CORRUPT = 'corrupt'
+
+
+def verify_file(path, size=None, algorithm=None, digest=None):
+    # Check a stored file against what we expect of it, returning a (status, bytes hashed) tuple.
+    # The size is checked first, since a stat is much cheaper than reading the file, and the
+    # file is only hashed if the size matches and there's a digest to compare. This is a plain
+    # module-level function so that it can be run by a process pool as well as a thread pool.
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return VERIFY_MISSING, 0
+    if size is not None and stat.st_size != size:
+        return VERIFY_CORRUPT, 0
+    if not (algorithm and digest):
+        return VERIFY_OK, 0
+    with open(path, 'rb') as f:
+        digests, hashed = digest_chunks(iter(lambda: f.read(HASH_CHUNK_SIZE), b''), [algorithm])
+    if digests[algorithm] != digest.lower():
+        return VERIFY_CORRUPT, hashed
+    return VERIFY_OK, hashed
+
+
+def _as_bytes(chunk):
+    # Files opened in text mode (or wrapping a StringIO) give us str chunks,
+    # which get hashed as their utf8 encoding
+    if isinstance(chunk, str):
+        return chunk.encode('utf8')
+    return chunk
+
+
+def stream_rows(queryset, chunk_size=2000, hold=False):
+    # Iterate over the rows of a values_list queryset with a server-side cursor, fetching
+    # chunk_size rows from the database at a time, so that result sets of any size can be
+    # processed without holding them all in memory. (QuerySet.iterator in Django 1.8 still
+    # has psycopg2 fetch the entire result set before iterating over it.) Rows are tuples,
+    # and no field conversion is done beyond what psycopg2 does on its own.
+    # See stream_sql for the transaction the rows are read in, and hold.
+    sql, params = queryset.query.sql_with_params()
+    return stream_sql(sql, params, queryset.db, chunk_size, hold)
+
+
+def stream_sql(sql, params=(), using='default', chunk_size=2000, hold=False):
+    # Same as stream_rows, for raw SQL, e.g. queries the ORM can't express.
+    # Server-side cursors only live as long as the transaction that declared them, so the rows
+    # are read in the transaction that's already open, or else in one that lasts until the
+    # rows are all read or the generator is closed (so close it when stopping early).
+    # hold=True declares the cursor WITH HOLD instead, for callers that commit as they go,
+    # e.g. to keep their progress if they're interrupted. Postgres materializes the whole
+    # result of a held cursor when its transaction commits, which in autocommit is right away,
+    # so the first row only comes once the whole query has run.
+    connection = connections[using]
+    if hold or connection.in_atomic_block:
+        for row in _stream_cursor(connection, sql, params, chunk_size, hold):
+            yield row
+    else:
+        with transaction.atomic(using=using):
+            for row in _stream_cursor(connection, sql, params, chunk_size, hold):
+                yield row
+
+
+def _stream_cursor(connection, sql, params, chunk_size, hold):
+    connection.ensure_connection()
+    cursor = connection.connection.cursor(
+        name='pulp_stream_{}'.format(uuid.uuid4().hex), withhold=hold)
+    try:
+        cursor.itersize = chunk_size
+        cursor.execute(sql, params)
+        for row in cursor:
+            yield row
+    finally:
+        cursor.close()
@@ -1,12 +1,70 @@
+import uuid
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Prefetch
+from django.http import StreamingHttpResponse
+
 from pulp import models, serializers
+from pulp.pagination import KeysetPagination
+from pulp.utils import chunked
 
 from rest_framework import routers, viewsets
+from rest_framework.decorators import detail_route
+
+# Number of units rendered into each chunk of a streaming export response
+EXPORT_CHUNK_SIZE = 500
+
+
+class UnitJSONEncoder(DjangoJSONEncoder):
+    def default(self, o):
+        if isinstance(o, uuid.UUID):
+            return str(o)
+        return super(UnitJSONEncoder, self).default(o)
+
+
+def unit_fields(unit):
+    # All of a unit's DB field values, including its detail fields, as a dict.
+    # The parent link is skipped, since it's just the uuid again.
+    parent_links = set(field.attname for field in unit._meta.parents.values())
+    return dict((field.attname, field.value_from_object(unit))
+                for field in unit._meta.concrete_fields if field.attname not in parent_links)
+
+
+def ndjson_units(units):
+    # Render units as newline-delimited JSON, one object per unit, a chunk of units at a time
+    encoder = UnitJSONEncoder(separators=(',', ':'))
+    for chunk in chunked(units, EXPORT_CHUNK_SIZE):
+        yield ''.join(encoder.encode(unit_fields(unit)) + '\n' for unit in chunk)
+
+
+class RepositoryPagination(KeysetPagination):
+    ordering = ('slug',)
 
 
 class RepositoryViewSet(viewsets.ModelViewSet):
     lookup_field = 'slug'
     queryset = models.Repository.objects.all()
     serializer_class = serializers.RepositorySerializer
+    pagination_class = RepositoryPagination
+
+    def get_queryset(self):
+        # Unit counts come along in the same query as the repositories, unless the client
+        # asked for a set of fields (e.g. ?fields=slug,last_unit_added) that doesn't need them
+        queryset = super(RepositoryViewSet, self).get_queryset()
+        requested = self.get_serializer_class().requested_fields(self.request)
+        if requested is None or 'content_unit_counts' in requested:
+            queryset = queryset.with_content_unit_counts()
+        return queryset
+
+    @detail_route(methods=['get'])
+    def export(self, request, slug=None):
+        # Every unit in the repository, cast to its detail type, as newline-delimited JSON.
+        # Units are read with a server-side cursor and rendered as the response is sent, so
+        # this starts responding right away and uses the same memory for any repository size.
+        # Units aren't sorted, so the DB doesn't need to sort the whole repository first.
+        repository = self.get_object()
+        units = repository.units.order_by().cast(stream=True)
+        return StreamingHttpResponse(ndjson_units(units), content_type='application/x-ndjson')
 
 
 # XXX DO NOT register ContentUnitViewSet with the router.
@@ -16,5 +74,23 @@ class RepositoryViewSet(viewsets.ModelViewSet):
 class ContentUnitViewSet(viewsets.ModelViewSet):
     serializer_class = serializers.ContentUnitSerializer
 
+    # Unit fields that can be used to filter the list with query params, e.g. ?name=foo.
+    # Units can always be filtered by the slug of a repository that contains them,
+    # e.g. ?repository=repo0
+    filter_fields = ()
+
+    def get_queryset(self):
+        queryset = super(ContentUnitViewSet, self).get_queryset()
+        params = self.request.query_params
+        if 'repository' in params:
+            queryset = queryset.filter(repositories__slug=params['repository'])
+        filters = dict((field, params[field]) for field in self.filter_fields if field in params)
+        if filters:
+            queryset = queryset.filter(**filters)
+        # The serializer links to each unit's repositories by slug, so get
+        # the slugs for all of the units being serialized in one query
+        repositories = Prefetch('repositories', queryset=models.Repository.objects.only('slug'))
+        return queryset.prefetch_related(repositories)
+
 router = routers.DefaultRouter()
 router.register(r'repositories', RepositoryViewSet)
@@ -0,0 +1,286 @@
+from collections import OrderedDict
+from io import StringIO
+from operator import attrgetter
+from xml.etree import ElementTree
+from xml.sax.saxutils import XMLGenerator
+
+from django.db import transaction
+
+from pulp.models import BULK_CHUNK_SIZE, get_content_type, prefetch_generic
+from pulp_rpm import models
+from pulp_rpm.xmlgen import drain, write_text
+
+XML_LANG = '{http://www.w3.org/XML/1998/namespace}lang'
+
+COMPS_DOCTYPE = '<!DOCTYPE comps PUBLIC "-//Red Hat, Inc.//DTD Comps info//EN" "comps.dtd">\n'
+
+# What yum uses for elements that don't have a display_order
+DEFAULT_DISPLAY_ORDER = 1024
+
+# langpacks elements don't have an id, and there's only one of them per comps document
+LANGPACKS_SLUG = 'langpacks'
+
+# Every model written by load_comps, in insert order, parents before children
+LOAD_ORDER = (
+    models.CompsGroup,
+    models.CompsCategory,
+    models.CompsEnvironment,
+    models.CompsLangpacks,
+    models.CompsLangpacksMatch,
+    models.CompsPackageReq,
+    models.CompsGroupID,
+    models.CompsOptionGroupID,
+    models.CompsTranslatedName,
+    models.CompsTranslatedDescription,
+)
+
+# Generic relations on groups, categories, and environments, for prefetch_generic
+GENERIC_RELATIONS = (
+    'packagelist', 'grouplist', 'optionlist', 'translated_name', 'translated_description',
+)
+
+
+class BulkWriter(object):
+    # Collects unsaved model instances, and writes them with one bulk_create per model every
+    # chunk_size instances. Models are always written in LOAD_ORDER, so parents are inserted
+    # before their children.
+    def __init__(self, chunk_size=BULK_CHUNK_SIZE):
+        self.chunk_size = chunk_size
+        self.pending = OrderedDict((model, []) for model in LOAD_ORDER)
+        self.pending_count = 0
+
+    def add(self, instances):
+        for instance in instances:
+            self.pending[type(instance)].append(instance)
+        self.pending_count += len(instances)
+        if self.pending_count >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        for model, instances in self.pending.items():
+            if instances:
+                model.objects.bulk_create(instances)
+                del instances[:]
+        self.pending_count = 0
+
+
+def load_comps(repository, source, chunk_size=BULK_CHUNK_SIZE):
+    # Replace the comps for repository with the comps.xml in source (a filename or file object).
+    # Top-level elements are parsed one at a time and thrown away as soon as they've been turned
+    # into (unsaved) model instances, which BulkWriter inserts chunk_size at a time, so memory
+    # use doesn't grow with the size of the document. It all happens in one transaction, so the
+    # repository's comps are either entirely replaced or left alone.
+    with transaction.atomic():
+        models.Comps.objects.filter(repository_id=repository.pk).delete()
+        comps = models.Comps.objects.create(repository_id=repository.pk)
+        writer = BulkWriter(chunk_size)
+
+        depth = 0
+        root = None
+        for event, element in ElementTree.iterparse(source, events=('start', 'end')):
+            if event == 'start':
+                if root is None:
+                    root = element
+                depth += 1
+                continue
+            depth -= 1
+            if depth == 1:
+                parser = ELEMENT_PARSERS.get(element.tag)
+                if parser is not None:
+                    writer.add(parser(comps, element))
+                # drop the element that was just handled (and any before it)
+                root.clear()
+        writer.flush()
+    return comps
+
+
+def _text(element, tag, default=''):
+    child = element.find(tag)
+    if child is None or child.text is None:
+        return default
+    return child.text.strip()
+
+
+def _bool(element, tag, default):
+    text = _text(element, tag, None)
+    if text is None:
+        return default
+    return text.lower() == 'true'
+
+
+def _int(element, tag, default):
+    text = _text(element, tag, None)
+    if text is None:
+        return default
+    return int(text)
+
+
+def _translations(parent, element, tag, model):
+    # Returns the text of the untranslated tag (e.g. name), and model instances for all
+    # of the translations of it (e.g. <name xml:lang="de">)
+    content_type = get_content_type(type(parent))
+    text = ''
+    translations = []
+    for child in element.findall(tag):
+        lang = child.get(XML_LANG)
+        value = (child.text or '').strip()
+        if lang is None:
+            text = value
+        else:
+            translations.append(model(content_type_id=content_type.pk, object_id=parent.pk,
+                                      lang=lang, value=value))
+    return text, translations
+
+
+def _group_ids(parent, element, path, model):
+    content_type = get_content_type(type(parent))
+    return [model(content_type_id=content_type.pk, object_id=parent.pk,
+                  name=(child.text or '').strip())
+            for child in element.iterfind(path)]
+
+
+def _described(model, comps, element):
+    # Groups, categories, and environments all start out the same way, with an id, name(s),
+    # description(s), and display_order. Returns the new instance, and its translations.
+    instance = model(parent=comps, slug=_text(element, 'id'),
+                     display_order=_int(element, 'display_order', DEFAULT_DISPLAY_ORDER))
+    instance.name, names = _translations(
+        instance, element, 'name', models.CompsTranslatedName)
+    instance.description, descriptions = _translations(
+        instance, element, 'description', models.CompsTranslatedDescription)
+    return instance, names + descriptions
+
+
+def _parse_group(comps, element):
+    group, instances = _described(models.CompsGroup, comps, element)
+    group.default = _bool(element, 'default', False)
+    group.user_visible = _bool(element, 'uservisible', True)
+    group.langonly = _text(element, 'langonly')
+    # comps calls this biarchonly
+    group.basearchonly = _bool(element, 'biarchonly', None)
+    content_type = get_content_type(models.CompsGroup)
+    # XXX packagereq can also have "requires" and "basearchonly" attrs, which
+    # CompsPackageReq doesn't have fields for, so they're dropped
+    for child in element.iterfind('packagelist/packagereq'):
+        instances.append(models.CompsPackageReq(
+            content_type_id=content_type.pk, object_id=group.pk,
+            name=(child.text or '').strip(), type=child.get('type', 'mandatory')))
+    return [group] + instances
+
+
+def _parse_category(comps, element):
+    category, instances = _described(models.CompsCategory, comps, element)
+    instances.extend(_group_ids(category, element, 'grouplist/groupid', models.CompsGroupID))
+    return [category] + instances
+
+
+def _parse_environment(comps, element):
+    environment, instances = _described(models.CompsEnvironment, comps, element)
+    instances.extend(_group_ids(environment, element, 'grouplist/groupid', models.CompsGroupID))
+    instances.extend(
+        _group_ids(environment, element, 'optionlist/groupid', models.CompsOptionGroupID))
+    return [environment] + instances
+
+
+def _parse_langpacks(comps, element):
+    langpacks = models.CompsLangpacks(parent=comps, slug=LANGPACKS_SLUG)
+    # langpacks isn't saved yet, which Django won't allow for FK assignment, so set the id
+    matches = [models.CompsLangpacksMatch(langpack_id=langpacks.pk, name=child.get('name'),
+                                          install=child.get('install'))
+               for child in element.iterfind('match')]
+    return [langpacks] + matches
+
+
+ELEMENT_PARSERS = {
+    'group': _parse_group,
+    'category': _parse_category,
+    'environment': _parse_environment,
+    'langpacks': _parse_langpacks,
+}
+
+
+def render_comps(repository):
+    # Generate the comps.xml for repository as text, a chunk per top-level element, e.g. to
+    # write to a file or hand to a StreamingHttpResponse. The number of queries is the same
+    # regardless of how big the comps are: one per element table, one for langpack matches,
+    # and one per generic table, which prefetch_generic loads for all of the elements at once.
+    comps = models.Comps.objects.get(repository_id=repository.pk)
+    groups = list(comps.groups.order_by('display_order', 'slug'))
+    categories = list(comps.categories.order_by('display_order', 'slug'))
+    environments = list(comps.environments.order_by('display_order', 'slug'))
+    langpacks = list(comps.langpacks.prefetch_related('matches'))
+    prefetch_generic(groups + categories + environments, *GENERIC_RELATIONS)
+
+    out = StringIO()
+    xml = XMLGenerator(out, encoding='utf-8', short_empty_elements=True)
+    xml.startDocument()
+    out.write(COMPS_DOCTYPE)
+    xml.startElement('comps', {})
+    xml.ignorableWhitespace('\n')
+    yield drain(out)
+
+    for group in groups:
+        _write_group(xml, group)
+        yield drain(out)
+    for category in categories:
+        _write_described(xml, 'category', category, [('grouplist', category.grouplist)])
+        yield drain(out)
+    for environment in environments:
+        _write_described(xml, 'environment', environment, [
+            ('grouplist', environment.grouplist), ('optionlist', environment.optionlist)])
+        yield drain(out)
+    for langpack in langpacks:
+        xml.startElement('langpacks', {})
+        for match in langpack.matches.all():
+            xml.startElement('match', {'name': match.name, 'install': match.install})
+            xml.endElement('match')
+        xml.endElement('langpacks')
+        xml.ignorableWhitespace('\n')
+        yield drain(out)
+
+    xml.endElement('comps')
+    xml.ignorableWhitespace('\n')
+    xml.endDocument()
+    yield drain(out)
+
+
+def _write_heading(xml, instance):
+    write_text(xml, 'id', instance.slug)
+    write_text(xml, 'name', instance.name)
+    for translation in sorted(instance.translated_name.all(), key=attrgetter('lang')):
+        write_text(xml, 'name', translation.value, {'xml:lang': translation.lang})
+    write_text(xml, 'description', instance.description)
+    for translation in sorted(instance.translated_description.all(), key=attrgetter('lang')):
+        write_text(xml, 'description', translation.value, {'xml:lang': translation.lang})
+
+
+def _write_described(xml, tag, instance, group_lists):
+    # categories and environments: the heading, display_order, then lists of group ids
+    xml.startElement(tag, {})
+    _write_heading(xml, instance)
+    write_text(xml, 'display_order', str(instance.display_order))
+    for list_tag, manager in group_lists:
+        xml.startElement(list_tag, {})
+        for group_id in sorted(manager.all(), key=attrgetter('name')):
+            write_text(xml, 'groupid', group_id.name)
+        xml.endElement(list_tag)
+    xml.endElement(tag)
+    xml.ignorableWhitespace('\n')
+
+
+def _write_group(xml, group):
+    xml.startElement('group', {})
+    _write_heading(xml, group)
+    write_text(xml, 'default', str(group.default).lower())
+    write_text(xml, 'uservisible', str(group.user_visible).lower())
+    write_text(xml, 'display_order', str(group.display_order))
+    if group.langonly:
+        write_text(xml, 'langonly', group.langonly)
+    if group.basearchonly is not None:
+        write_text(xml, 'biarchonly', str(group.basearchonly).lower())
+    xml.startElement('packagelist', {})
+    for package in sorted(group.packagelist.all(), key=attrgetter('type', 'name')):
+        write_text(xml, 'packagereq', package.name, {'type': package.type})
+    xml.endElement('packagelist')
+    xml.endElement('group')
+    xml.ignorableWhitespace('\n')
@@ -0,0 +1,79 @@
+from collections import OrderedDict
+
+from django.core.exceptions import FieldDoesNotExist
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from pulp.models import BULK_CHUNK_SIZE
+from pulp.utils import chunked, stream_rows
+from pulp_rpm import models
+from pulp_rpm.version import sort_index
+
+# Models with sort indexes, and for each sort index, the field it encodes
+# and the value used when that field is blank
+SORT_INDEX_MODELS = (models.RPM, models.SRPM, models.DRPM, models.ErrataPackage)
+SORT_INDEX_SOURCES = OrderedDict([
+    ('epoch_sort_index', ('epoch', '0')),
+    ('version_sort_index', ('version', '')),
+    ('release_sort_index', ('release', '')),
+])
+
+
+class Command(BaseCommand):
+    help = ('Fill in the version sort indexes of packages and errata packages, '
+            'e.g. for ones saved before sort indexes were populated automatically')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=BULK_CHUNK_SIZE,
+                            help='Number of rows written by each UPDATE')
+
+    def handle(self, *args, **options):
+        for model in SORT_INDEX_MODELS:
+            updated = self.rebuild(model, options['chunk_size'])
+            self.stdout.write('Updated sort indexes for {} {} rows'.format(
+                updated, model._meta.model_name))
+
+    def rebuild(self, model, chunk_size):
+        # Every row is read with a server-side cursor, and only rows with a sort index that
+        # doesn't match its field are written, chunk_size rows per UPDATE as they're found
+        opts = model._meta
+        indexes = []
+        for index_field in SORT_INDEX_SOURCES:
+            try:
+                opts.get_field(index_field)
+            except FieldDoesNotExist:
+                continue
+            indexes.append(index_field)
+        sources = [SORT_INDEX_SOURCES[index_field] for index_field in indexes]
+
+        queryset = model._base_manager.order_by().values_list(
+            'pk', *(indexes + [field for field, blank in sources]))
+
+        def stale_rows():
+            # held, since every chunk of updates is committed as it's written (see stream_sql)
+            for row in stream_rows(queryset, hold=True):
+                pk, current, values = row[0], row[1:len(indexes) + 1], row[len(indexes) + 1:]
+                rebuilt = tuple(sort_index(value or blank)
+                                for value, (field, blank) in zip(values, sources))
+                if rebuilt != tuple(current):
+                    yield (pk,) + rebuilt
+
+        sql = (
+            'UPDATE {table} AS target SET {assignments} '
+            'FROM (VALUES {{values}}) AS rebuilt (pk, {columns}) '
+            'WHERE target.{pk} = rebuilt.pk'
+        ).format(
+            table=opts.db_table,
+            pk=opts.pk.column,
+            assignments=', '.join('{0} = rebuilt.{0}'.format(opts.get_field(field).column)
+                                  for field in indexes),
+            columns=', '.join(opts.get_field(field).column for field in indexes),
+        )
+        row_sql = '(%s::uuid{})'.format(', %s' * len(indexes))
+        updated = 0
+        with connection.cursor() as cursor:
+            for chunk in chunked(stale_rows(), chunk_size):
+                params = [value for row in chunk for value in row]
+                cursor.execute(sql.format(values=', '.join([row_sql] * len(chunk))), params)
+                updated += len(chunk)
+        return updated
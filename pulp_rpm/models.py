@@ -1,11 +1,120 @@
 from __future__ import unicode_literals
 
-from django.db import models
+from collections import namedtuple
+
+from django.db import connections, models
 from django.contrib.contenttypes.fields import GenericRelation
 
 from pulp.fields import ChecksumTypeCharField
-from pulp.models import (UUIDModel, Slugged, Repository, ContentUnit,
-                         NamedTupleDescriptor, GenericModel, GenericKeyValueStore)
+from pulp.models import (UUIDModel, Slugged, Repository, RepositoryQuerySet, ContentUnit,
+                         ContentUnitManager, RepositoryContentUnit, RepositoryChangeTracker,
+                         NamedTupleDescriptor, GenericModel, GenericKeyValueStore,
+                         repository_content_changed)
+from pulp_rpm.version import evr_sort_index, sort_index
+
+# One row in the report generated by remove_duplicate_nevra(dry_run=True)
+DuplicateNevra = namedtuple('DuplicateNevra', ('repository', 'content_unit', 'nevra'))
+
+# One row in the report generated by keep_latest(dry_run=True)
+ExpiredVersion = namedtuple('ExpiredVersion', ('repository', 'content_unit', 'nevra'))
+
+
+class RPMRepositoryQuerySet(RepositoryQuerySet):
+    def remove_duplicate_nevra(self, unit_models=None, dry_run=False):
+        # In every repository in this queryset, find the RPMBase units (RPMs and SRPMs by default,
+        # or the RPMBase subclasses in unit_models) that share a NEVRA with another unit of the same
+        # type in that repository. The unit most recently associated with the repository is kept,
+        # and all of the others are removed from it with a single DELETE per unit type.
+        # Returns the number of units removed, or with dry_run, a list of DuplicateNevra tuples
+        # describing the units that would be removed, without removing anything.
+        removed = 0
+        report = []
+        for model in unit_models or (RPM, SRPM):
+            duplicates = self._ranked_out(model, model.NEVRA_FIELDS, 'row_number', (), 1)
+            if dry_run:
+                report.extend(self._report(duplicates, model, DuplicateNevra))
+            else:
+                removed += duplicates.delete()
+        return report if dry_run else removed
+
+    def keep_latest(self, policies, dry_run=False):
+        # In every repository in this queryset, keep only the newest versions of each package
+        # name and arch, and remove all of the older ones. policies is a {unit model: number of
+        # versions to keep} dict (e.g. {RPM: 3, SRPM: 1}), or just a number of versions to keep
+        # for RPMs and SRPMs. Versions are compared by EVR using the RPMBase sort indexes, so
+        # units with the same EVR (e.g. rebuilt with different checksums) are one version.
+        # The old versions are found and removed by the database, one DELETE per unit type, all
+        # in one transaction. Returns the number of units removed, or with dry_run, a list of
+        # ExpiredVersion tuples describing the units that would be removed.
+        if not isinstance(policies, dict):
+            policies = {RPM: policies, SRPM: policies}
+        for model, keep in policies.items():
+            if not issubclass(model, RPMBase):
+                # DRPMs don't have names or arches to group versions by
+                raise ValueError('Retention policies need an RPMBase subclass, not {}'.format(
+                    model.__name__))
+            if keep < 1:
+                raise ValueError('Retention policies must keep at least one version')
+
+        removed = 0
+        report = []
+        with RepositoryChangeTracker(using=self.db):
+            for model, keep in policies.items():
+                expired = self._ranked_out(
+                    model, ('name', 'arch'), 'dense_rank', RPMBase.EVR_SORT_FIELDS, keep)
+                if dry_run:
+                    report.extend(self._report(expired, model, ExpiredVersion))
+                else:
+                    removed += expired.delete()
+        return report if dry_run else removed
+
+    def _report(self, associations, model, row_type):
+        # dry_run output for RepositoryContentUnits of model
+        model_name = model._meta.model_name
+        fields = ['content_unit__{}__{}'.format(model_name, field) for field in model.NEVRA_FIELDS]
+        return [row_type(row[0], row[1], model.NEVRA_TUPLE._make(row[2:]))
+                for row in associations.values_list('repository__slug', 'content_unit', *fields)]
+
+    def _ranked_out(self, model, partition, rank_function, ordering, keep):
+        # RepositoryContentUnits of model in these repositories that rank below the first keep
+        # ranks of their partition (the repository, plus the model fields in partition). Units
+        # are ranked by the model fields in ordering, descending, then by how recently they were
+        # associated with the repository, using the rank_function window function (row_number
+        # to keep exactly keep units, dense_rank to keep units tied on ordering together).
+        opts = model._meta
+        rcu_opts = RepositoryContentUnit._meta
+        rcu_table = rcu_opts.db_table
+        rcu_pk = rcu_opts.pk.column
+        repository = rcu_opts.get_field('repository').column
+        order_by = ['pkg.{} DESC'.format(opts.get_field(field).column) for field in ordering]
+        if rank_function == 'row_number':
+            order_by.extend(['rcu.{} DESC'.format(rcu_opts.get_field('updated').column),
+                             'rcu.{} DESC'.format(rcu_pk)])
+        repositories, params = self.order_by().values('pk').query.sql_with_params()
+        ranked = (
+            'SELECT ranked.rcu_pk FROM ('
+            'SELECT rcu.{rcu_pk} AS rcu_pk, {rank_function}() OVER ('
+            'PARTITION BY rcu.{repository}, {partition} '
+            'ORDER BY {order_by}) AS rank '
+            'FROM {rcu_table} AS rcu JOIN {table} AS pkg ON pkg.{ptr} = rcu.{content_unit} '
+            'WHERE rcu.{repository} IN ({repositories})'
+            ') AS ranked WHERE ranked.rank > %s'
+        ).format(
+            rcu_table=rcu_table,
+            rcu_pk=rcu_pk,
+            rank_function=rank_function,
+            repository=repository,
+            content_unit=rcu_opts.get_field('content_unit').column,
+            order_by=', '.join(order_by),
+            table=opts.db_table,
+            ptr=opts.pk.column,
+            partition=', '.join('pkg.{}'.format(opts.get_field(field).column)
+                                for field in partition),
+            repositories=repositories,
+        )
+        where = '{}.{} IN ({})'.format(rcu_table, rcu_pk, ranked)
+        return RepositoryContentUnit.objects.using(self.db).extra(
+            where=[where], params=tuple(params) + (keep,))
 
 
 class RPMRepositoryProxy(Repository):
@@ -13,17 +122,87 @@ class RPMRepositoryProxy(Repository):
     # yum-specific models as ForeignKey targets without adding a bunch of reverse relations
     # to generic Repository instances. This distinction only exists in software; anything
     # related to this proxy is, at the DB level, still related to Repository
+    objects = RPMRepositoryQuerySet.as_manager()
+
     class Meta:
         proxy = True
 
-
-class Errata(UUIDModel, Slugged):
-    # slug (formerly errata_id) should be the "id" field in updateinfo.xml
+    def newest_units(self, unit_model=None):
+        # The newest unit of each name and arch in this repository, RPMs by default,
+        # or the RPMBase subclass unit_model. One DISTINCT ON query.
+        unit_model = unit_model or RPM
+        ordering = ('name', 'arch') + tuple('-' + field for field in RPMBase.EVR_SORT_FIELDS)
+        return unit_model.objects.filter(repositories=self).order_by(
+            *ordering).distinct('name', 'arch')
+
+    def remove_duplicate_nevra(self, unit_models=None, dry_run=False):
+        # see RPMRepositoryQuerySet.remove_duplicate_nevra; to do this for all
+        # repositories at once, use RPMRepositoryProxy.objects.remove_duplicate_nevra()
+        queryset = type(self).objects.using(self._state.db).filter(pk=self.pk)
+        return queryset.remove_duplicate_nevra(unit_models, dry_run)
+
+    def keep_latest(self, policies, dry_run=False):
+        # see RPMRepositoryQuerySet.keep_latest; to do this for all
+        # repositories at once, use RPMRepositoryProxy.objects.keep_latest()
+        queryset = type(self).objects.using(self._state.db).filter(pk=self.pk)
+        return queryset.keep_latest(policies, dry_run)
+
+
+class ErrataQuerySet(models.QuerySet):
+    def applicable_to(self, nevras, linked_only=False):
+        # Errata that update any of the installed packages in nevras, an iterable of
+        # (name, epoch, version, release, arch) tuples (e.g. RPM.nevra_tuple). An errata applies
+        # if one of its packages has the same name and arch as an installed package, and a newer
+        # EVR, compared with the ErrataPackage sort indexes, so this is one query on the
+        # ErrataPackage NEVRA index however many packages are installed. With linked_only, only
+        # errata packages linked to an RPM in the errata's repository count.
+        installed = []
+        for name, epoch, version, release, arch in nevras:
+            installed.extend((name, arch) + evr_sort_index(epoch, version, release))
+        if not installed:
+            return self.none()
+
+        package_opts = ErrataPackage._meta
+        collection_opts = ErrataCollection._meta
+        sql = (
+            '{errata}.{errata_pk} IN ('
+            'SELECT collection.{collection_errata} FROM {package} AS package '
+            'JOIN {collection} AS collection '
+            'ON collection.{collection_pk} = package.{package_collection} '
+            'JOIN (VALUES {values}) AS installed (name, arch, epoch, version, release) '
+            'ON package.{name} = installed.name AND package.{arch} = installed.arch '
+            'AND (package.{epoch}, package.{version}, package.{release}) > '
+            '(installed.epoch, installed.version, installed.release){linked})'
+        ).format(
+            errata=Errata._meta.db_table,
+            errata_pk=Errata._meta.pk.column,
+            package=package_opts.db_table,
+            collection=collection_opts.db_table,
+            collection_pk=collection_opts.pk.column,
+            collection_errata=collection_opts.get_field('errata').column,
+            package_collection=package_opts.get_field('collection').column,
+            name=package_opts.get_field('name').column,
+            arch=package_opts.get_field('arch').column,
+            epoch=package_opts.get_field('epoch_sort_index').column,
+            version=package_opts.get_field('version_sort_index').column,
+            release=package_opts.get_field('release_sort_index').column,
+            values=', '.join(['(%s, %s, %s, %s, %s)'] * (len(installed) // 5)),
+            linked=' AND package.{} IS NOT NULL'.format(
+                package_opts.get_field('unit').column) if linked_only else '',
+        )
+        return self.extra(where=[sql], params=installed)
+
+
+class Errata(UUIDModel):
+    # slug (formerly errata_id) should be the "id" field in updateinfo.xml. The same errata
+    # shows up in many repositories, so unlike Slugged, it's only unique per repository.
+    slug = models.SlugField(max_length=255)
     repository = models.ForeignKey(RPMRepositoryProxy, related_name='errata')
 
-    # XXX These are StringFields in mongo, but are obviously datetime stamps
-    issued = models.DateTimeField()
-    updated = models.DateTimeField()
+    # XXX These are StringFields in mongo, but are obviously datetime stamps.
+    # Both are optional in updateinfo.xml; updated defaults to issued when loading.
+    issued = models.DateTimeField(null=True, blank=True)
+    updated = models.DateTimeField(null=True, blank=True)
     description = models.TextField()
     solution = models.TextField()
     summary = models.TextField()
@@ -38,6 +217,11 @@ class Errata(UUIDModel, Slugged):
     type = models.CharField(max_length=255)
     title = models.CharField(max_length=255)
 
+    objects = ErrataQuerySet.as_manager()
+
+    class Meta:
+        unique_together = [('repository', 'slug')]
+
 
 class ErrataReferenceAttributes(GenericKeyValueStore):
     # Used by ErrataReference to store XML attributes that are
@@ -63,6 +247,97 @@ class ErrataCollection(UUIDModel):
     name = models.CharField(max_length=255)
 
 
+class ErrataPackageManager(models.Manager):
+    def link_units(self, repositories=None, units=None, unlinked=False):
+        # Link errata packages to the RPM with the same NEVRA in their errata's repository (or
+        # unlink them, if there isn't one anymore), for all errata in repositories (an iterable
+        # of Repository instances or pks), or in every repository. One UPDATE, which only
+        # writes the rows whose link changed. This is kept up to date automatically when RPMs
+        # are added to or removed from repositories, see relink_errata_packages.
+        # units is an optional iterable of the pks of units that were added or removed, to
+        # only relink the packages that could have been affected by them: the ones with the
+        # NEVRA of one of those units, and the ones linked to one of them. With unlinked, the
+        # packages that aren't linked to anything are relinked too, which is how packages that
+        # were linked to units that have since been deleted are found (see
+        # relink_errata_packages).
+        opts = self.model._meta
+        collection_opts = ErrataCollection._meta
+        errata_opts = Errata._meta
+        rpm_opts = RPM._meta
+        rcu_opts = RepositoryContentUnit._meta
+        nevra_match = ' AND '.join(
+            'rpm.{0} = package.{1}'.format(rpm_opts.get_field(field).column,
+                                           opts.get_field(field).column)
+            for field in RPMBase.NEVRA_FIELDS)
+
+        params = []
+        where = []
+        if repositories is not None:
+            params = [getattr(repository, 'pk', repository) for repository in repositories]
+            if not params:
+                return
+            where.append('errata.{} IN ({})'.format(
+                errata_opts.get_field('repository').column, ', '.join(['%s'] * len(params))))
+        if units is not None:
+            units = list(units)
+            if not units:
+                return
+            values = ', '.join(['%s::uuid'] * len(units))
+            where.append(
+                '(package.{unit} IN ({values}) OR ({package_nevra}) IN ('
+                'SELECT {rpm_nevra} FROM {rpm} AS changed '
+                'WHERE changed.{rpm_pk} IN ({values})){unlinked})'.format(
+                    unit=opts.get_field('unit').column,
+                    values=values,
+                    package_nevra=', '.join('package.{}'.format(opts.get_field(field).column)
+                                            for field in RPMBase.NEVRA_FIELDS),
+                    rpm_nevra=', '.join('changed.{}'.format(rpm_opts.get_field(field).column)
+                                        for field in RPMBase.NEVRA_FIELDS),
+                    rpm=rpm_opts.db_table,
+                    rpm_pk=rpm_opts.pk.column,
+                    unlinked=' OR package.{} IS NULL'.format(opts.get_field('unit').column)
+                    if unlinked else '',
+                ))
+            params.extend(units + units)
+        where = 'WHERE ' + ' AND '.join(where) if where else ''
+
+        sql = (
+            'UPDATE {package} AS target SET {unit} = linked.unit FROM ('
+            'SELECT package.{package_pk} AS package, ('
+            'SELECT rpm.{rpm_pk} FROM {rpm} AS rpm '
+            'JOIN {rcu} AS rcu ON rcu.{rcu_unit} = rpm.{rpm_pk} '
+            'WHERE rcu.{rcu_repository} = errata.{errata_repository} AND {nevra_match} '
+            'ORDER BY rpm.{rpm_pk} LIMIT 1) AS unit '
+            'FROM {package} AS package '
+            'JOIN {collection} AS collection '
+            'ON collection.{collection_pk} = package.{package_collection} '
+            'JOIN {errata} AS errata ON errata.{errata_pk} = collection.{collection_errata} '
+            '{where}) AS linked '
+            'WHERE target.{package_pk} = linked.package '
+            'AND target.{unit} IS DISTINCT FROM linked.unit'
+        ).format(
+            package=opts.db_table,
+            package_pk=opts.pk.column,
+            package_collection=opts.get_field('collection').column,
+            unit=opts.get_field('unit').column,
+            rpm=rpm_opts.db_table,
+            rpm_pk=rpm_opts.pk.column,
+            rcu=rcu_opts.db_table,
+            rcu_unit=rcu_opts.get_field('content_unit').column,
+            rcu_repository=rcu_opts.get_field('repository').column,
+            collection=collection_opts.db_table,
+            collection_pk=collection_opts.pk.column,
+            collection_errata=collection_opts.get_field('errata').column,
+            errata=errata_opts.db_table,
+            errata_pk=errata_opts.pk.column,
+            errata_repository=errata_opts.get_field('repository').column,
+            nevra_match=nevra_match,
+            where=where,
+        )
+        with connections[self.db].cursor() as cursor:
+            cursor.execute(sql, params)
+
+
 class ErrataPackage(UUIDModel):
     collection = models.ForeignKey(ErrataCollection, related_name='packages')
     name = models.CharField(max_length=255)
@@ -78,6 +353,30 @@ class ErrataPackage(UUIDModel):
     sum = models.CharField(max_length=255)
     sum_type = models.CharField(max_length=255)
 
+    # pulp_rpm.version sort indexes of the EVR, for finding errata that update installed
+    # packages, see ErrataQuerySet.applicable_to
+    epoch_sort_index = models.CharField(max_length=255)
+    version_sort_index = models.CharField(max_length=255)
+    release_sort_index = models.CharField(max_length=255)
+
+    # The RPM with this NEVRA in the errata's repository, if there is one
+    unit = models.ForeignKey('RPM', null=True, on_delete=models.SET_NULL,
+                             related_name='errata_packages')
+
+    objects = ErrataPackageManager()
+
+    class Meta:
+        index_together = [('name', 'arch', 'epoch_sort_index', 'version_sort_index',
+                           'release_sort_index')]
+
+    def set_sort_indexes(self):
+        (self.epoch_sort_index, self.version_sort_index,
+         self.release_sort_index) = evr_sort_index(self.epoch, self.version, self.release)
+
+    def save(self, *args, **kwargs):
+        self.set_sort_indexes()
+        return super(ErrataPackage, self).save(*args, **kwargs)
+
 
 # XXX Something that knows the comps stuff we should definitely double check this.
 # I'm not 100% sure that I brought all the right fields over.
@@ -118,7 +417,18 @@ class Comps(UUIDModel):
     repository = models.OneToOneField(RPMRepositoryProxy, related_name='comps')
 
 
-class CompsGroup(UUIDModel, Slugged):
+class CompsElement(UUIDModel):
+    # Base for the top-level elements of a comps document. Their ids are only unique within
+    # one document (every Fedora repository has a "core" group), so unlike Slugged, slug
+    # only has to be unique for each parent Comps.
+    slug = models.SlugField(max_length=255)
+
+    class Meta:
+        abstract = True
+        unique_together = [('parent', 'slug')]
+
+
+class CompsGroup(CompsElement):
     # slug should be the 'id' XML tag value for this group element
     parent = models.ForeignKey(Comps, related_name='groups')
 
@@ -136,7 +446,7 @@ class CompsGroup(UUIDModel, Slugged):
     langonly = models.CharField(max_length=63)
 
 
-class CompsCategory(UUIDModel, Slugged):
+class CompsCategory(CompsElement):
     # slug should be the 'id' XML tag value for this category element
     parent = models.ForeignKey(Comps, related_name='categories')
 
@@ -148,7 +458,7 @@ class CompsCategory(UUIDModel, Slugged):
     grouplist = GenericRelation(CompsGroupID)
 
 
-class CompsEnvironment(UUIDModel, Slugged):
+class CompsEnvironment(CompsElement):
     # slug should be the 'id' XML tag value for this environment element
     parent = models.ForeignKey(Comps, related_name='environments')
 
@@ -161,8 +471,9 @@ class CompsEnvironment(UUIDModel, Slugged):
     translated_description = GenericRelation(CompsTranslatedDescription)
 
 
-class CompsLangpacks(UUIDModel, Slugged):
-    # slug should be the 'id' XML tag value for this langpacks element
+class CompsLangpacks(CompsElement):
+    # langpacks elements don't have an id; there's only one per comps document,
+    # so the slug is always 'langpacks' (see pulp_rpm.comps)
     parent = models.ForeignKey(Comps, related_name='langpacks')
 
 
@@ -190,6 +501,8 @@ class Distribution(ContentUnit, Slugged):
     timestamp = models.FloatField()
     packagedir = models.CharField(max_length=255)
 
+    objects = ContentUnitManager()
+
 
 class ISO(ContentUnit):
     # XXX This whole model is likely to go away in favor of platform support
@@ -199,6 +512,8 @@ class ISO(ContentUnit):
     # the built-in relationship to ContentUnitFile.
     name = models.CharField(max_length=255)
 
+    objects = ContentUnitManager()
+
 
 class YumMetadataFile(ContentUnit):
     # A file entry in repomd.
@@ -207,6 +522,14 @@ class YumMetadataFile(ContentUnit):
     # or through the Checksum generic relation. For now, this is a ContentUnit,
     # related to ContentUnitFiles, which have checksum fields.
     data_type = models.CharField(max_length=255)
+    # The checksum of the file, which is what makes two files of the same type different units.
+    # Published metadata gets this from the checksum computed while writing it, before saving.
+    checksum = models.CharField(max_length=255)
+    checksumtype = ChecksumTypeCharField(max_length=63)
+
+    objects = ContentUnitManager()
+
+    KEY_FIELDS = ('data_type', 'checksum', 'checksumtype')
 
 
 class PackageBase(ContentUnit):
@@ -217,6 +540,9 @@ class PackageBase(ContentUnit):
     version = models.CharField(max_length=63)
     release = models.CharField(max_length=63)
 
+    # see ContentUnitManager; inherited by DRPM, SRPM, and RPM, since this class is abstract
+    objects = ContentUnitManager()
+
     # We already have a model for checksums; this specifically represents the checksum provided
     # by the source repo, which should be included in a yum unit's key fields to account, e.g.
     # for different RPMs with the same NEVRA. I might hate this, but don't understand yum repo
@@ -227,17 +553,25 @@ class PackageBase(ContentUnit):
     # We generate these two for sorting, but we could possibly
     # store the sortable value for each of these in the "normal"
     # DB field using a special Django field that converts them
-    # back and forth. For now, they're being left blank, but we'll
-    # need a way to update these when a package version is added or
-    # changed. I'd love to see them go away, since there are other
+    # back and forth. They're pulp_rpm.version sort indexes, set
+    # by prepare_fields whenever a package is saved or ingested,
+    # and filled in for existing packages by the rebuild_sort_indexes
+    # command. I'd love to see them go away, since there are other
     # ways we can do this without custom fields or storing duplicate
     # data, like annotation or better modeling of the data
-    version_sort_index = models.CharField(max_length=63)
-    release_sort_index = models.CharField(max_length=63)
+    # Sort indexes are about three times the length of what they
+    # encode, hence the longer max_length.
+    version_sort_index = models.CharField(max_length=255)
+    release_sort_index = models.CharField(max_length=255)
 
     class Meta:
         abstract = True
 
+    def prepare_fields(self):
+        super(PackageBase, self).prepare_fields()
+        self.version_sort_index = sort_index(self.version)
+        self.release_sort_index = sort_index(self.release)
+
 
 class DRPM(PackageBase):
     pass
@@ -247,10 +581,13 @@ class RPMBase(PackageBase):
     # More specific version of PackageBase for SRPM and RPM types
     NEVRA_FIELDS = ('name', 'epoch', 'version', 'release', 'arch')
     KEY_FIELDS = NEVRA_FIELDS + ('checksum', 'checksumtype')
+    # Sorting by these sorts by EVR, the same way rpm does
+    EVR_SORT_FIELDS = ('epoch_sort_index', 'version_sort_index', 'release_sort_index')
 
     name = models.CharField(max_length=127)
     epoch = models.CharField(max_length=63)
     arch = models.CharField(max_length=63)
+    epoch_sort_index = models.CharField(max_length=255)
 
     NEVRA_TUPLE = NamedTupleDescriptor('NEVRA_FIELDS', 'NevraTuple')
 
@@ -261,6 +598,19 @@ class RPMBase(PackageBase):
 
     class Meta:
         abstract = True
+        index_together = [
+            # NEVRA_FIELDS plus the PK, for looking up and paging through units by NEVRA.
+            # contentunit_ptr is the PK, added to the concrete subclasses by Django.
+            ('name', 'epoch', 'version', 'release', 'arch', 'contentunit_ptr'),
+            # For finding the newest versions of each package, see
+            # RPMRepositoryProxy.newest_units
+            ('name', 'arch', 'epoch_sort_index', 'version_sort_index', 'release_sort_index'),
+        ]
+
+    def prepare_fields(self):
+        super(RPMBase, self).prepare_fields()
+        # an empty epoch is epoch 0
+        self.epoch_sort_index = sort_index(self.epoch or '0')
 
 
 class RPM(RPMBase):
@@ -269,3 +619,27 @@ class RPM(RPMBase):
 
 class SRPM(RPMBase):
     pass
+
+
+def relink_errata_packages(sender, changed, using, units=None, **kwargs):
+    # RPMs were added to or removed from repositories, so update the links from those
+    # repositories' errata packages to their RPMs. When the changed units are known, only the
+    # packages they could affect are relinked, otherwise every package in the repository is.
+    # RPMs that were deleted outright are gone by now, NEVRA and all, and their errata packages
+    # were unlinked by SET_NULL, so when any of the changed units are gone, the unlinked packages
+    # are relinked too, in case another RPM in the repository has a deleted one's NEVRA.
+    content_type = RPM._get_content_type()
+    units = units or {}
+    repositories = [pk for pk, content_types in changed.items()
+                    if content_type in content_types or None in content_types]
+    unknown = [pk for pk in repositories if units.get(pk) is None]
+    known = [pk for pk in repositories if units.get(pk) is not None]
+    manager = ErrataPackage.objects.db_manager(using)
+    if unknown:
+        manager.link_units(unknown)
+    if known:
+        changed_units = list(set().union(*(units[pk] for pk in known)))
+        remaining = ContentUnit.objects.using(using).filter(pk__in=changed_units).count()
+        manager.link_units(known, changed_units, unlinked=remaining < len(changed_units))
+
+repository_content_changed.connect(relink_errata_packages)
@@ -0,0 +1,267 @@
+import gzip
+import hashlib
+import time
+from collections import OrderedDict
+from itertools import chain
+from xml.sax.saxutils import escape, quoteattr
+
+from django.db import transaction
+
+from pulp.models import BULK_CHUNK_SIZE, ContentUnitFile, RepositoryContentUnit
+from pulp.storage import StagedFile
+from pulp.utils import chunked, stream_sql
+from pulp_rpm import models
+
+# Checksum type of the metadata files, both in repomd and on their ContentUnitFiles
+CHECKSUM_TYPE = 'sha256'
+
+# zlib's default, which is much faster than gzip's default of 9 for nearly the same size
+COMPRESS_LEVEL = 6
+
+# The gzipped metadata files, in the order they're listed in repomd
+DATA_TYPES = ('primary', 'filelists', 'other')
+REPOMD = 'repomd'
+
+XML_DECLARATION = '<?xml version="1.0" encoding="UTF-8"?>\n'
+HEADERS = {
+    'primary': '<metadata xmlns="http://linux.duke.edu/metadata/common" '
+               'xmlns:rpm="http://linux.duke.edu/metadata/rpm" packages="{}">\n',
+    'filelists': '<filelists xmlns="http://linux.duke.edu/metadata/filelists" packages="{}">\n',
+    'other': '<otherdata xmlns="http://linux.duke.edu/metadata/other" packages="{}">\n',
+}
+FOOTERS = {
+    'primary': '</metadata>\n',
+    'filelists': '</filelists>\n',
+    'other': '</otherdata>\n',
+}
+
+
+class _HashedFile(object):
+    # Write-only file-like that hashes and counts the bytes written through it
+    def __init__(self, f):
+        self.file = f
+        self.hasher = hashlib.new(CHECKSUM_TYPE)
+        self.size = 0
+
+    def write(self, data):
+        self.hasher.update(data)
+        self.size += len(data)
+        return self.file.write(data)
+
+    def flush(self):
+        self.file.flush()
+
+
+class MetadataWriter(object):
+    # Writes one metadata file into a StagedFile, gzipped unless compress is False. The
+    # checksum and size of both the written file and its uncompressed contents (repomd's
+    # open-checksum and open-size) are computed as it's written, so it's never read back.
+    def __init__(self, data_type, compress=True):
+        self.data_type = data_type
+        self.staged = StagedFile()
+        self.out = _HashedFile(self.staged.file)
+        if compress:
+            self.compressed = gzip.GzipFile(
+                fileobj=self.out, mode='wb', compresslevel=COMPRESS_LEVEL, mtime=0)
+        else:
+            self.compressed = None
+        self.open_hasher = hashlib.new(CHECKSUM_TYPE)
+        self.open_size = 0
+
+    def write(self, text):
+        data = text.encode('utf8')
+        self.open_hasher.update(data)
+        self.open_size += len(data)
+        (self.compressed or self.out).write(data)
+
+    def close(self):
+        if self.compressed is not None:
+            self.compressed.close()
+        self.out.flush()
+
+    @property
+    def checksum(self):
+        return self.out.hasher.hexdigest()
+
+    @property
+    def size(self):
+        return self.out.size
+
+    @property
+    def open_checksum(self):
+        return self.open_hasher.hexdigest()
+
+    @property
+    def location(self):
+        # where the file goes in a published repo, named by checksum like createrepo does
+        if self.data_type == REPOMD:
+            return 'repodata/repomd.xml'
+        return 'repodata/{}-{}.xml.gz'.format(self.checksum, self.data_type)
+
+    def save(self):
+        # Store the written file as a new YumMetadataFile, and return it. The checksum was
+        # already computed while writing, so no other digests are computed on save. Metadata
+        # files are keyed by that checksum, so if an identical file is already stored (e.g. the
+        # primary from the last publish of an unchanged repository), that unit is returned.
+        unit = models.YumMetadataFile(data_type=self.data_type, checksum=self.checksum,
+                                      checksumtype=CHECKSUM_TYPE)
+        existing = models.YumMetadataFile.objects.filter(key_digest=unit.hash_key()).first()
+        if existing is not None:
+            return existing
+        unit.save()
+        unit_file = ContentUnitFile(unit=unit, content=self.staged, downloaded=True,
+                                    file_size=self.size)
+        setattr(unit_file, CHECKSUM_TYPE, self.checksum)
+        if CHECKSUM_TYPE == 'sha256':
+            # which is also what the storage names files by, so it doesn't hash them again
+            self.staged.digest = self.checksum
+        unit_file.save(algorithms=())
+        return unit
+
+
+def publish_metadata(repository, chunk_size=BULK_CHUNK_SIZE):
+    # Generate primary, filelists, other, and repomd for the RPMs and SRPMs in repository, and
+    # store them as YumMetadataFile units in the repository, replacing the ones from the last
+    # publish, which are deleted (with their files) unless another repository has them too.
+    # Files identical to ones already stored keep using those units, see MetadataWriter.save.
+    # Returns the new units, in repomd order, then repomd itself.
+    #
+    # Packages are read with one ordered server-side cursor (see _package_rows), chunk_size
+    # rows at a time, and written to all three files as they come in, so memory use doesn't
+    # grow with the size of the repository and no package is loaded as a model instance.
+    #
+    # XXX RPM doesn't model most of what primary has for a package (summary, description,
+    # build times, dependencies, ...), or anything at all for filelists or other, so those are
+    # written with what there is: every package, with its name, arch, EVR, and checksum.
+    # DRPMs belong in prestodelta, which DRPM doesn't have the fields for either.
+    timestamp = int(time.time())
+    writers = OrderedDict((data_type, MetadataWriter(data_type)) for data_type in DATA_TYPES)
+    repomd = MetadataWriter(REPOMD, compress=False)
+    try:
+        rows = _package_rows(repository, chunk_size)
+        try:
+            first = next(rows, None)
+            # every row carries the total number of packages, which the headers need up front
+            count = first[-1] if first is not None else 0
+            for data_type, writer in writers.items():
+                writer.write(XML_DECLARATION + HEADERS[data_type].format(count))
+            if first is not None:
+                for chunk in chunked(chain([first], rows), chunk_size):
+                    _write_packages(writers, chunk)
+        finally:
+            # ends the transaction the rows are read in, if writing them failed (see stream_sql)
+            rows.close()
+        for data_type, writer in writers.items():
+            writer.write(FOOTERS[data_type])
+            writer.close()
+        repomd.write(_render_repomd(writers.values(), timestamp))
+        repomd.close()
+
+        with transaction.atomic():
+            units = [writer.save() for writer in chain(writers.values(), [repomd])]
+            previous = list(models.YumMetadataFile.objects.filter(
+                repositories=repository, data_type__in=DATA_TYPES + (REPOMD,)).exclude(
+                pk__in=[unit.pk for unit in units]).values_list('pk', flat=True))
+            RepositoryContentUnit.objects.disassociate(repository, previous)
+            models.YumMetadataFile.objects.filter(
+                pk__in=previous, repositories__isnull=True).delete()
+            RepositoryContentUnit.objects.associate(repository, units)
+    finally:
+        # saving links each staged file into storage and removes it from staging (see
+        # ContentAddressableStorage._save), so this only cleans up after errors
+        for writer in chain(writers.values(), [repomd]):
+            writer.staged.discard()
+    return units
+
+
+def _package_rows(repository, chunk_size):
+    # (name, epoch, version, release, arch, checksum, checksumtype, size, total) for every
+    # RPM and SRPM in repository, sorted by name, arch, and EVR, from a server-side cursor.
+    # size is that of the package's file, if it has one.
+    rcu_opts = RepositoryContentUnit._meta
+    file_opts = ContentUnitFile._meta
+    columns = ('name', 'epoch', 'version', 'release', 'arch', 'checksum', 'checksumtype',
+               'epoch_sort_index', 'version_sort_index', 'release_sort_index')
+    selects = []
+    for model in (models.RPM, models.SRPM):
+        opts = model._meta
+        selects.append(
+            'SELECT package.{pk} AS pk, {columns} FROM {table} AS package '
+            'JOIN {rcu_table} AS rcu ON rcu.{rcu_content_unit} = package.{pk} '
+            'WHERE rcu.{rcu_repository} = %s'.format(
+                pk=opts.pk.column,
+                columns=', '.join('package.{} AS {}'.format(opts.get_field(name).column, name)
+                                  for name in columns),
+                table=opts.db_table,
+                rcu_table=rcu_opts.db_table,
+                rcu_content_unit=rcu_opts.get_field('content_unit').column,
+                rcu_repository=rcu_opts.get_field('repository').column,
+            ))
+    sql = (
+        'SELECT package.name, package.epoch, package.version, package.release, package.arch, '
+        'package.checksum, package.checksumtype, '
+        '(SELECT max(unit_file.{file_size}) FROM {file_table} AS unit_file '
+        'WHERE unit_file.{file_unit} = package.pk), '
+        'count(*) OVER () '
+        'FROM ({packages}) AS package '
+        'ORDER BY package.name, package.arch, package.epoch_sort_index, '
+        'package.version_sort_index, package.release_sort_index'
+    ).format(
+        file_size=file_opts.get_field('file_size').column,
+        file_table=file_opts.db_table,
+        file_unit=file_opts.get_field('unit').column,
+        packages=' UNION ALL '.join(selects),
+    )
+    return stream_sql(sql, [repository.pk] * len(selects), repository._state.db or 'default',
+                      chunk_size)
+
+
+def _write_packages(writers, rows):
+    # Format a chunk of package rows for each file, and write each file's chunk in one go
+    primary = []
+    filelists = []
+    other = []
+    for name, epoch, version, release, arch, checksum, checksumtype, size, total in rows:
+        version_element = '<version epoch={} ver={} rel={}/>'.format(
+            quoteattr(epoch or '0'), quoteattr(version), quoteattr(release))
+        filename = '{}-{}-{}.{}.rpm'.format(name, version, release, arch)
+        primary.append(
+            '<package type="rpm"><name>{name}</name><arch>{arch}</arch>{version}'
+            '<checksum type={checksumtype} pkgid="YES">{checksum}</checksum>'
+            '<size package="{size}"/><location href={href}/></package>\n'.format(
+                name=escape(name), arch=escape(arch), version=version_element,
+                checksumtype=quoteattr(checksumtype), checksum=escape(checksum),
+                size=size or 0, href=quoteattr('Packages/' + filename)))
+        package = '<package pkgid={} name={} arch={}>{}</package>\n'.format(
+            quoteattr(checksum), quoteattr(name), quoteattr(arch), version_element)
+        filelists.append(package)
+        other.append(package)
+    writers['primary'].write(''.join(primary))
+    writers['filelists'].write(''.join(filelists))
+    writers['other'].write(''.join(other))
+
+
+def _render_repomd(writers, timestamp):
+    data = []
+    for writer in writers:
+        data.append(
+            '<data type={data_type}>'
+            '<checksum type="{checksumtype}">{checksum}</checksum>'
+            '<open-checksum type="{checksumtype}">{open_checksum}</open-checksum>'
+            '<location href={location}/>'
+            '<timestamp>{timestamp}</timestamp>'
+            '<size>{size}</size>'
+            '<open-size>{open_size}</open-size>'
+            '</data>\n'.format(
+                data_type=quoteattr(writer.data_type), checksumtype=CHECKSUM_TYPE,
+                checksum=writer.checksum, open_checksum=writer.open_checksum,
+                location=quoteattr(writer.location), timestamp=timestamp, size=writer.size,
+                open_size=writer.open_size))
+    return (
+        XML_DECLARATION +
+        '<repomd xmlns="http://linux.duke.edu/metadata/repo" '
+        'xmlns:rpm="http://linux.duke.edu/metadata/rpm">\n'
+        '<revision>{}</revision>\n'.format(timestamp) +
+        ''.join(data) +
+        '</repomd>\n'
+    )
@@ -0,0 +1,65 @@
+from io import BytesIO
+
+from django.test import TestCase
+
+from pulp.models import Repository
+from pulp_rpm import models
+from pulp_rpm.comps import load_comps, render_comps
+
+COMPS = b'''<?xml version="1.0" encoding="UTF-8"?>
+<comps>
+  <group>
+    <id>core</id>
+    <name>Core</name>
+    <name xml:lang="de">Kern</name>
+    <description>Smallest possible installation</description>
+    <uservisible>false</uservisible>
+    <packagelist>
+      <packagereq type="mandatory">bash</packagereq>
+      <packagereq type="optional">zsh</packagereq>
+      <packagereq/>
+    </packagelist>
+  </group>
+  <category>
+    <id>base</id>
+    <name>Base</name>
+    <display_order>10</display_order>
+    <grouplist>
+      <groupid>core</groupid>
+      <groupid/>
+    </grouplist>
+  </category>
+  <langpacks>
+    <match name="firefox" install="firefox-langpack-%s"/>
+  </langpacks>
+</comps>
+'''
+
+
+class CompsTests(TestCase):
+    def setUp(self):
+        self.repository = Repository.objects.create(slug='comps')
+        load_comps(self.repository, BytesIO(COMPS))
+
+    def test_load(self):
+        group = models.CompsGroup.objects.get(slug='core')
+        self.assertEqual(group.name, 'Core')
+        self.assertFalse(group.user_visible)
+        self.assertEqual(sorted(group.packagelist.values_list('name', flat=True)),
+                         ['', 'bash', 'zsh'])
+        category = models.CompsCategory.objects.get(slug='base')
+        self.assertEqual(category.display_order, 10)
+        self.assertEqual(sorted(category.grouplist.values_list('name', flat=True)),
+                         ['', 'core'])
+
+    def test_reload(self):
+        # loading again replaces the repository's comps
+        load_comps(self.repository, BytesIO(COMPS))
+        self.assertEqual(models.CompsGroup.objects.count(), 1)
+
+    def test_round_trip(self):
+        rendered = ''.join(render_comps(self.repository)).encode('utf8')
+        load_comps(self.repository, BytesIO(rendered))
+        self.assertEqual(''.join(render_comps(self.repository)).encode('utf8'), rendered)
+        self.assertIn(b'<name xml:lang="de">Kern</name>', rendered)
+        self.assertIn(b'<packagereq type="mandatory">bash</packagereq>', rendered)
@@ -0,0 +1,325 @@
+from datetime import timedelta
+from unittest import mock
+
+from django.db import connection
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from pulp.models import CHANGES_LAG, ContentUnit, Repository, RepositoryContentUnitCount
+from pulp_rpm.models import (ISO, RPM, SRPM, DuplicateNevra, Errata, ErrataCollection,
+                             ErrataPackage, ExpiredVersion, RPMRepositoryProxy)
+from pulp_rpm.version import sort_index
+
+
+def make_rpm(name='pulp', version='1.0', release='1', arch='noarch', checksum=None, **fields):
+    return RPM.objects.create(
+        name=name, epoch='0', version=version, release=release, arch=arch,
+        checksum=checksum or '{}-{}-{}.{}'.format(name, version, release, arch),
+        checksumtype='sha256', **fields)
+
+
+class FreshClassStateTests(TestCase):
+    def setUp(self):
+        # Forget the namedtuple and unit key types built for RPM so far, as if this were the
+        # first unit saved in a new process
+        for attr in ('KEY_TUPLE', 'UNIT_KEY', 'NEVRA_TUPLE'):
+            for cls in RPM.__mro__:
+                if attr in vars(cls):
+                    vars(cls)[attr].cache.clear()
+                    break
+
+    def test_save(self):
+        rpm = make_rpm()
+        self.assertEqual(rpm.key_digest, rpm.hash_key())
+        self.assertEqual(ContentUnit.objects.get(pk=rpm.pk).cast(), rpm)
+
+    def test_nevra_tuple(self):
+        nevra = RPM.NEVRA_TUPLE._make(('pulp', '0', '1.0', '1', 'noarch'))
+        self.assertEqual(nevra.name, 'pulp')
+
+
+class RemoveDuplicateNevraTests(TestCase):
+    def setUp(self):
+        self.repository = RPMRepositoryProxy.objects.create(slug='duplicates')
+        self.old = make_rpm(checksum='old')
+        self.new = make_rpm(checksum='new')
+        self.other = make_rpm(name='other')
+        # associated separately, so that new is the most recently associated
+        self.repository.add_units(self.old, self.other)
+        self.repository.add_units(self.new)
+
+    def test_dry_run(self):
+        report = self.repository.remove_duplicate_nevra(dry_run=True)
+        self.assertEqual(report, [DuplicateNevra(
+            'duplicates', self.old.pk, RPM.NEVRA_TUPLE('pulp', '0', '1.0', '1', 'noarch'))])
+        # nothing was removed
+        self.assertEqual(self.repository.units.count(), 3)
+
+    def test_remove(self):
+        self.assertEqual(self.repository.remove_duplicate_nevra(), 1)
+        self.assertEqual(set(self.repository.units.values_list('pk', flat=True)),
+                         {self.new.pk, self.other.pk})
+
+
+class KeepLatestTests(TestCase):
+    def setUp(self):
+        self.repository = RPMRepositoryProxy.objects.create(slug='latest')
+        self.versions = [make_rpm(version=version) for version in ('1.0', '1.10', '1.9')]
+        self.other = make_rpm(name='other')
+        self.repository.add_units(self.other, *self.versions)
+
+    def test_dry_run(self):
+        report = self.repository.keep_latest(2, dry_run=True)
+        self.assertEqual(report, [ExpiredVersion(
+            'latest', self.versions[0].pk, RPM.NEVRA_TUPLE('pulp', '0', '1.0', '1', 'noarch'))])
+        self.assertEqual(self.repository.units.count(), 4)
+
+    def test_keep_latest(self):
+        self.assertEqual(self.repository.keep_latest({RPM: 1}), 2)
+        self.assertEqual(set(self.repository.units.values_list('pk', flat=True)),
+                         {self.versions[1].pk, self.other.pk})
+
+    def test_policy_validation(self):
+        with self.assertRaises(ValueError):
+            self.repository.keep_latest(0)
+
+
+class UnitCountTests(TestCase):
+    def setUp(self):
+        self.repository = Repository.objects.create(slug='counts')
+
+    def count(self):
+        return dict(self.repository.unit_counts.values_list('content_type', 'count'))
+
+    def delete_queries(self, number):
+        rpms = [make_rpm(version=str(version)) for version in range(number)]
+        self.repository.add_units(*rpms)
+        with CaptureQueriesContext(connection) as queries:
+            RPM.objects.filter(pk__in=[rpm.pk for rpm in rpms]).delete()
+        return len(queries)
+
+    def test_counts(self):
+        rpms = [make_rpm(version=str(version)) for version in range(3)]
+        self.repository.add_units(*rpms)
+        self.assertEqual(self.count(), {'rpm': 3})
+        self.repository.remove_units(rpms[0])
+        self.assertEqual(self.count(), {'rpm': 2})
+        rpms[1].delete()
+        self.assertEqual(self.count(), {'rpm': 1})
+
+    def test_delete_queries(self):
+        # the number of queries to delete units doesn't grow with the number of units
+        self.assertEqual(self.delete_queries(2), self.delete_queries(20))
+        self.assertEqual(self.count(), {'rpm': 0})
+
+
+class RepositoryDeleteTests(TransactionTestCase):
+    # committed for real, so that deferred foreign keys are checked
+
+    def test_delete_with_units(self):
+        repository = Repository.objects.create(slug='deleted')
+        repository.add_units(make_rpm(), make_rpm(name='other'))
+        repository.delete()
+        self.assertFalse(Repository.objects.filter(slug='deleted').exists())
+        self.assertFalse(RepositoryContentUnitCount.objects.exists())
+
+
+class RepositoryVersionTests(TestCase):
+    def setUp(self):
+        self.repository = Repository.objects.create(slug='versioned')
+        self.a, self.b, self.c = [make_rpm(name=name) for name in ('a', 'b', 'c')]
+        self.repository.add_units(self.a, self.b)
+        self.v1 = self.repository.create_version()
+        self.repository.remove_units(self.b)
+        self.repository.add_units(self.c)
+        self.v2 = self.repository.create_version()
+        # b comes back, with a new version content row
+        self.repository.add_units(self.b)
+        self.v3 = self.repository.create_version()
+
+    def pks(self, units):
+        return set(units.values_list('pk', flat=True))
+
+    def test_units(self):
+        self.assertEqual(self.pks(self.v1.units()), {self.a.pk, self.b.pk})
+        self.assertEqual(self.pks(self.v2.units()), {self.a.pk, self.c.pk})
+        self.assertEqual(self.pks(self.v3.units()), {self.a.pk, self.b.pk, self.c.pk})
+
+    def test_units_added_since(self):
+        self.assertEqual(self.pks(self.v2.units_added_since(self.v1)), {self.c.pk})
+        # b was re-added, but it was in v1 too
+        self.assertEqual(self.pks(self.v3.units_added_since(self.v1)), {self.c.pk})
+        self.assertEqual(self.pks(self.v3.units_added_since(self.v2)), {self.b.pk})
+
+    def test_units_removed_since(self):
+        self.assertEqual(self.pks(self.v2.units_removed_since(self.v1)), {self.b.pk})
+        self.assertEqual(self.pks(self.v3.units_removed_since(self.v1)), set())
+
+    def test_diff(self):
+        diff = self.v3.diff(self.v1)
+        self.assertEqual(diff.added, {'rpm': 1})
+        self.assertEqual(diff.removed, {})
+
+    def test_nested(self):
+        # the version queries still work as subqueries of other querysets
+        added = self.v3.units_added_since(self.v1).values('pk')
+        self.assertEqual(self.pks(ContentUnit.objects.filter(pk__in=added)), {self.c.pk})
+
+
+class ChangesSinceTests(TestCase):
+    def setUp(self):
+        self.repository = Repository.objects.create(slug='changes')
+        self.a, self.b = make_rpm(name='a'), make_rpm(name='b')
+
+    def pks(self, units):
+        return set(units.values_list('pk', flat=True))
+
+    def test_nothing(self):
+        changes = self.repository.changes_since()
+        self.assertFalse(changes.changed)
+        self.assertIsNone(changes.watermark)
+
+    def test_incremental(self):
+        with mock.patch('pulp.models.CHANGES_LAG', timedelta(0)):
+            self.repository.add_units(self.a)
+            first = self.repository.changes_since()
+            self.assertEqual(self.pks(first.added), {self.a.pk})
+
+            self.repository.add_units(self.b)
+            self.repository.remove_units(self.a)
+            second = self.repository.changes_since(first.watermark)
+            self.assertEqual(self.pks(second.added), {self.b.pk})
+            self.assertEqual(set(second.removed), {self.a.pk})
+
+            third = self.repository.changes_since(second.watermark)
+            self.assertFalse(third.changed)
+
+    def test_lag(self):
+        # the watermark is held back, so changes that might not have all committed yet
+        # are returned again next time
+        self.repository.add_units(self.a)
+        first = self.repository.changes_since()
+        self.assertLessEqual(first.watermark, timezone.now() - CHANGES_LAG)
+        second = self.repository.changes_since(first.watermark)
+        self.assertTrue(second.changed)
+        self.assertEqual(self.pks(second.added), {self.a.pk})
+        self.assertGreaterEqual(second.watermark, first.watermark)
+
+
+def make_errata(repository, slug='RHSA-2016:0001', **fields):
+    now = timezone.now()
+    defaults = dict(issued=now, updated=now, description='', solution='', summary='',
+                    pushcount=1, errata_from='', severity='', rights='', version='1',
+                    release='', type='security', title=slug)
+    defaults.update(fields)
+    return Errata.objects.create(repository_id=repository.pk, slug=slug, **defaults)
+
+
+def make_errata_package(errata, name='pulp', version='1.0', release='1', arch='noarch'):
+    collection = ErrataCollection.objects.create(errata=errata, short='', name='')
+    return ErrataPackage.objects.create(
+        collection=collection, name=name, epoch='0', version=version, release=release,
+        arch=arch, src='', filename='', sum='', sum_type='')
+
+
+class ErrataPackageLinkTests(TestCase):
+    def setUp(self):
+        self.repository = Repository.objects.create(slug='errata')
+        self.package = make_errata_package(make_errata(self.repository))
+
+    def linked(self):
+        return ErrataPackage.objects.get(pk=self.package.pk).unit_id
+
+    def test_add_remove(self):
+        rpm = make_rpm()
+        self.repository.add_units(rpm, make_rpm(name='other'))
+        self.assertEqual(self.linked(), rpm.pk)
+        self.repository.remove_units(rpm)
+        self.assertIsNone(self.linked())
+
+    def test_delete_relinks_same_nevra(self):
+        # two builds of the same NEVRA; the package links to one of them, and when that one is
+        # deleted, it has to be linked to the other even though the other didn't change
+        rpms = [make_rpm(checksum='first'), make_rpm(checksum='second')]
+        self.repository.add_units(*rpms)
+        linked = self.linked()
+        self.assertIn(linked, [rpm.pk for rpm in rpms])
+        RPM.objects.filter(pk=linked).delete()
+        remaining, = [rpm.pk for rpm in rpms if rpm.pk != linked]
+        self.assertEqual(self.linked(), remaining)
+
+    def test_link_units(self):
+        rpm = make_rpm()
+        self.repository.add_units(rpm)
+        ErrataPackage.objects.filter(pk=self.package.pk).update(unit=None)
+        ErrataPackage.objects.link_units([self.repository])
+        self.assertEqual(self.linked(), rpm.pk)
+
+
+class CastTests(TestCase):
+    def setUp(self):
+        self.units = [make_rpm(name='a'), ISO.objects.create(name='b.iso'), make_rpm(name='c'),
+                      SRPM.objects.create(name='d', epoch='0', version='1', release='1',
+                                          arch='src', checksum='d', checksumtype='sha256')]
+        self.queryset = ContentUnit.objects.filter(
+            pk__in=[unit.pk for unit in self.units]).order_by('key_digest')
+
+    def expected(self):
+        return sorted(self.units, key=lambda unit: unit.key_digest)
+
+    def test_cast(self):
+        # one query for the units, then one per detail type, however many units there are
+        with self.assertNumQueries(4):
+            units = list(self.queryset.cast())
+        self.assertEqual(units, self.expected())
+        self.assertEqual([type(unit) for unit in units],
+                         [type(unit) for unit in self.expected()])
+
+    def test_cast_chunks(self):
+        self.assertEqual(list(self.queryset.cast(chunk_size=1)), self.expected())
+
+    def test_cast_stream(self):
+        self.assertEqual(list(self.queryset.cast(stream=True)), self.expected())
+
+    def test_detail_model(self):
+        self.assertIs(ContentUnit.detail_model('rpm'), RPM)
+        self.assertIsNone(ContentUnit.detail_model('unknown'))
+
+
+class BulkIngestTests(TestCase):
+    def rpm(self, name, **fields):
+        defaults = dict(epoch='0', version='1.0', release='1', arch='noarch', checksum=name,
+                        checksumtype='sha256')
+        defaults.update(fields)
+        return RPM(name=name, **defaults)
+
+    def test_ingest(self):
+        units = [self.rpm('a'), SRPM(name='b', epoch='0', version='1', release='1', arch='src',
+                                      checksum='b', checksumtype='sha256'), self.rpm('c')]
+        with CaptureQueriesContext(connection) as queries:
+            pks = RPM.objects.bulk_ingest(units)
+        # one insert for the master rows, then one per detail type
+        inserts = [query for query in queries.captured_queries
+                   if query['sql'].startswith('INSERT')]
+        self.assertEqual(len(inserts), 3)
+        self.assertEqual(pks, [unit.pk for unit in units])
+        self.assertEqual(list(ContentUnit.objects.filter(pk__in=pks).order_by('content_type')
+                              .values_list('content_type', flat=True)), ['rpm', 'rpm', 'srpm'])
+        rpm = RPM.objects.get(name='a')
+        # same as what save would have done
+        self.assertEqual(rpm.key_digest, rpm.hash_key())
+        self.assertEqual(rpm.version_sort_index, sort_index('1.0'))
+
+    def test_known(self):
+        existing = make_rpm(name='a', version='1.0', checksum='a')
+        pks = RPM.objects.bulk_ingest([self.rpm('a'), self.rpm('b'), self.rpm('b')])
+        # the existing unit's pk for a, and b only inserted once
+        self.assertEqual(pks[0], existing.pk)
+        self.assertEqual(pks[1], pks[2])
+        self.assertEqual(RPM.objects.count(), 2)
+
+    def test_chunks(self):
+        pks = RPM.objects.bulk_ingest((self.rpm(name) for name in 'abcde'), chunk_size=2)
+        self.assertEqual(len(set(pks)), 5)
+        self.assertEqual(RPM.objects.count(), 5)
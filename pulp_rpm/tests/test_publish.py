@@ -0,0 +1,70 @@
+import gzip
+import shutil
+import tempfile
+
+from django.test import TransactionTestCase
+
+from pulp.models import Repository
+from pulp.storage import content_storage
+from pulp_rpm.models import YumMetadataFile
+from pulp_rpm.publish import DATA_TYPES, REPOMD, publish_metadata
+from pulp_rpm.tests.test_models import make_rpm
+
+
+class PublishMetadataTests(TransactionTestCase):
+    # publish_metadata streams packages from a server-side cursor, which is only
+    # worth testing outside of the test case transaction
+
+    def setUp(self):
+        location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, location)
+        self.addCleanup(setattr, content_storage, 'location', content_storage.location)
+        content_storage.location = location
+
+        self.repository = Repository.objects.create(slug='published')
+        self.repository.add_units(make_rpm(), make_rpm(name='other', arch='x86_64'))
+
+    def read(self, unit):
+        unit_file = unit.files.get()
+        with content_storage.open(unit_file.content.name) as f:
+            data = f.read()
+        if unit.data_type != REPOMD:
+            data = gzip.decompress(data)
+        return data.decode('utf8')
+
+    def test_publish(self):
+        units = publish_metadata(self.repository, chunk_size=1)
+        self.assertEqual([unit.data_type for unit in units], list(DATA_TYPES) + [REPOMD])
+        self.assertEqual(set(YumMetadataFile.objects.filter(repositories=self.repository)),
+                         set(units))
+
+        primary = self.read(units[0])
+        self.assertIn('packages="2"', primary)
+        self.assertIn('<name>other</name>', primary)
+        self.assertLess(primary.index('<name>other</name>'), primary.index('<name>pulp</name>'))
+
+        repomd = self.read(units[-1])
+        for unit in units[:-1]:
+            self.assertIn(unit.checksum, repomd)
+            self.assertEqual(unit.files.get().sha256, unit.checksum)
+
+    def test_republish(self):
+        first = publish_metadata(self.repository)
+        second = publish_metadata(self.repository)
+        # the packages didn't change, so neither did primary, filelists, or other
+        self.assertEqual(first[:-1], second[:-1])
+        self.assertEqual(set(YumMetadataFile.objects.filter(repositories=self.repository)),
+                         set(second))
+        self.assertEqual(YumMetadataFile.objects.count(), len(second))
+
+    def test_publish_changed(self):
+        first = publish_metadata(self.repository)
+        self.repository.add_units(make_rpm(version='2.0'))
+        second = publish_metadata(self.repository)
+        self.assertIn('packages="3"', self.read(second[0]))
+        self.assertFalse(YumMetadataFile.objects.filter(pk__in=[unit.pk for unit in first]))
+
+    def test_publish_empty(self):
+        empty = Repository.objects.create(slug='empty')
+        units = publish_metadata(empty)
+        self.assertIn('packages="0"', self.read(units[0]))
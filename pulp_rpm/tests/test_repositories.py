@@ -0,0 +1,193 @@
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+
+from pulp.models import (Associated, ContentUnit, Disassociated, Repository,
+                         RepositoryChangeTracker, RepositoryContentUnit, RepositoryDiff,
+                         repository_content_changed)
+from pulp_rpm.models import RPM, SRPM
+from pulp_rpm.tests.test_models import make_rpm
+
+
+class AssociationTests(TestCase):
+    def setUp(self):
+        self.repository = Repository.objects.create(slug='associations')
+        self.rpms = [make_rpm(version=str(version)) for version in range(3)]
+
+    def pks(self):
+        return set(self.repository.units.values_list('pk', flat=True))
+
+    def test_associate(self):
+        result = RepositoryContentUnit.objects.associate(self.repository, self.rpms[:2])
+        self.assertEqual(result, Associated(2, 0))
+        self.assertEqual(self.pks(), {self.rpms[0].pk, self.rpms[1].pk})
+
+    def test_associate_skips_known(self):
+        self.repository.add_units(self.rpms[0])
+        # units already in the repository, and pks that aren't units, are skipped
+        result = RepositoryContentUnit.objects.associate(
+            self.repository, [rpm.pk for rpm in self.rpms] + [self.repository.pk])
+        self.assertEqual(result, Associated(2, 2))
+        self.assertEqual(self.pks(), set(rpm.pk for rpm in self.rpms))
+
+    def test_associate_queryset(self):
+        result = RepositoryContentUnit.objects.associate(
+            self.repository, ContentUnit.objects.filter(pk__in=[rpm.pk for rpm in self.rpms]))
+        self.assertEqual(result, Associated(3, 0))
+
+    def test_associate_chunks(self):
+        # the number of queries depends on the number of chunks, not of units
+        with CaptureQueriesContext(connection) as one_chunk:
+            RepositoryContentUnit.objects.associate(self.repository, self.rpms[:1])
+        self.repository.remove_units(self.rpms[0])
+        with CaptureQueriesContext(connection) as three_units:
+            RepositoryContentUnit.objects.associate(self.repository, self.rpms)
+        self.assertEqual(len(one_chunk), len(three_units))
+
+    def test_disassociate(self):
+        self.repository.add_units(*self.rpms)
+        result = RepositoryContentUnit.objects.disassociate(
+            self.repository, self.rpms[:2] + [make_rpm(name='other')])
+        self.assertEqual(result, Disassociated(2, 1))
+        self.assertEqual(self.pks(), {self.rpms[2].pk})
+
+    def test_queryset_delete(self):
+        self.repository.add_units(*self.rpms)
+        deleted = RepositoryContentUnit.objects.filter(
+            repository=self.repository, content_unit__in=self.rpms[1:]).delete()
+        self.assertEqual(deleted, 2)
+        self.assertEqual(self.pks(), {self.rpms[0].pk})
+        self.assertTrue(RPM.objects.filter(pk=self.rpms[1].pk).exists())
+
+
+class ChangeTrackerTests(TestCase):
+    def setUp(self):
+        self.repository = Repository.objects.create(slug='tracked')
+        self.rpms = [make_rpm(version=str(version)) for version in range(3)]
+
+    def repository_updates(self, queries):
+        table = Repository._meta.db_table
+        return [query for query in queries.captured_queries
+                if query['sql'].startswith('UPDATE "{}"'.format(table))]
+
+    def test_timestamps(self):
+        self.assertIsNone(self.repository.last_unit_added)
+        self.repository.add_units(*self.rpms)
+        # the instance is kept up to date along with the database
+        added = self.repository.last_unit_added
+        self.assertIsNotNone(added)
+        self.assertEqual(Repository.objects.get(pk=self.repository.pk).last_unit_added, added)
+        self.repository.remove_units(self.rpms[0])
+        self.assertIsNotNone(Repository.objects.get(pk=self.repository.pk).last_unit_removed)
+
+    def test_one_update_per_block(self):
+        with CaptureQueriesContext(connection) as queries:
+            with RepositoryChangeTracker():
+                for rpm in self.rpms:
+                    RepositoryContentUnit.objects.create(repository=self.repository,
+                                                         content_unit=rpm)
+                self.repository.remove_units(self.rpms[0])
+        self.assertEqual(len(self.repository_updates(queries)), 1)
+        repository = Repository.objects.get(pk=self.repository.pk)
+        self.assertIsNotNone(repository.last_unit_added)
+        self.assertIsNotNone(repository.last_unit_removed)
+
+    def test_rollback(self):
+        # changes recorded in a block that raises are thrown away with its transaction
+        with self.assertRaises(ValueError):
+            with RepositoryChangeTracker():
+                self.repository.add_units(*self.rpms)
+                raise ValueError
+        self.assertFalse(self.repository.units.exists())
+        self.assertIsNone(Repository.objects.get(pk=self.repository.pk).last_unit_added)
+
+    def test_signal(self):
+        received = []
+
+        def receiver(sender, changed, units, using, **kwargs):
+            received.append((changed, units))
+        repository_content_changed.connect(receiver)
+        self.addCleanup(repository_content_changed.disconnect, receiver)
+
+        self.repository.add_units(*self.rpms)
+        self.assertEqual(received, [({self.repository.pk: {'rpm'}},
+                                     {self.repository.pk: set(rpm.pk for rpm in self.rpms)})])
+
+
+class SetOperationTests(TestCase):
+    def setUp(self):
+        self.testing = Repository.objects.create(slug='testing')
+        self.stable = Repository.objects.create(slug='stable')
+        self.target = Repository.objects.create(slug='target')
+        self.rpms = [make_rpm(version=str(version)) for version in range(4)]
+        self.srpm = SRPM.objects.create(name='pulp', epoch='0', version='0', release='1',
+                                        arch='src', checksum='srpm', checksumtype='sha256')
+        self.testing.add_units(*self.rpms + [self.srpm])
+        self.stable.add_units(*self.rpms[:2])
+
+    def pks(self, repository):
+        return set(repository.units.values_list('pk', flat=True))
+
+    def test_copy(self):
+        result = RepositoryContentUnit.objects.copy(self.testing, self.stable)
+        self.assertEqual(result, Associated(3, 2))
+        self.assertEqual(self.pks(self.stable), self.pks(self.testing))
+        self.assertEqual(dict(self.stable.unit_counts.values_list('content_type', 'count')),
+                         {'rpm': 4, 'srpm': 1})
+        self.assertIsNotNone(Repository.objects.get(pk=self.stable.pk).last_unit_added)
+
+    def test_copy_filtered(self):
+        result = self.testing.copy_units_to(self.target, content_types=['srpm'])
+        self.assertEqual(result, Associated(1, 0))
+        self.assertEqual(self.pks(self.target), {self.srpm.pk})
+        units = ContentUnit.objects.filter(pk__in=[self.rpms[2].pk, self.srpm.pk])
+        result = RepositoryContentUnit.objects.copy(self.testing, self.target, units=units)
+        self.assertEqual(result, Associated(1, 1))
+        self.assertEqual(self.pks(self.target), {self.rpms[2].pk, self.srpm.pk})
+
+    def test_copy_to_self(self):
+        self.assertEqual(RepositoryContentUnit.objects.copy(self.testing, self.testing),
+                         Associated(0, 0))
+
+    def test_union(self):
+        other = make_rpm(name='other')
+        self.stable.add_units(other)
+        result = RepositoryContentUnit.objects.union(self.target, [self.testing, self.stable])
+        self.assertEqual(result, Associated(6, 0))
+        self.assertEqual(self.pks(self.target), self.pks(self.testing) | {other.pk})
+
+    def test_intersection(self):
+        result = RepositoryContentUnit.objects.intersection(
+            self.target, [self.testing, self.stable.pk])
+        self.assertEqual(result, Associated(2, 0))
+        self.assertEqual(self.pks(self.target), set(rpm.pk for rpm in self.rpms[:2]))
+
+    def test_difference(self):
+        units = RepositoryContentUnit.objects.difference(self.testing, self.stable)
+        self.assertEqual(set(unit.pk for unit in units),
+                         set(rpm.pk for rpm in self.rpms[2:]) | {self.srpm.pk})
+        units = RepositoryContentUnit.objects.difference(self.testing, self.stable, ['srpm'])
+        self.assertEqual([unit.pk for unit in units], [self.srpm.pk])
+
+    def test_diff(self):
+        self.assertEqual(self.stable.diff(self.testing),
+                         RepositoryDiff(added={'rpm': 2, 'srpm': 1}, removed={}))
+        self.assertEqual(self.testing.diff(self.stable),
+                         RepositoryDiff(added={}, removed={'rpm': 2, 'srpm': 1}))
+
+    def test_one_signal(self):
+        # one change for the whole copy, however many units it adds
+        received = []
+
+        def receiver(sender, changed, units, using, **kwargs):
+            received.append(changed)
+        repository_content_changed.connect(receiver)
+        self.addCleanup(repository_content_changed.disconnect, receiver)
+
+        with CaptureQueriesContext(connection) as queries:
+            RepositoryContentUnit.objects.copy(self.testing, self.target)
+        self.assertEqual(received, [{self.target.pk: {'rpm', 'srpm'}}])
+        table = RepositoryContentUnit._meta.db_table
+        inserts = [query for query in queries
+                   if 'INSERT INTO {} '.format(table) in query['sql'].replace('"', '')]
+        self.assertEqual(len(inserts), 1)
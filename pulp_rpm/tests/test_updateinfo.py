@@ -0,0 +1,94 @@
+import datetime
+from io import BytesIO
+
+from django.test import TestCase
+from django.utils import timezone
+
+from pulp_rpm import models
+from pulp_rpm.updateinfo import UpdateinfoLoaded, load_updateinfo, render_updateinfo
+
+MINIMAL = b'''<?xml version="1.0" encoding="UTF-8"?>
+<updates>
+  <update>
+    <id>MINIMAL-1</id>
+    <title/>
+    <pkglist><collection><package name="pulp"><sum/></package></collection></pkglist>
+  </update>
+</updates>
+'''
+
+FULL = b'''<?xml version="1.0" encoding="UTF-8"?>
+<updates>
+  <update from="security@example.com" status="final" type="security" version="2">
+    <id>RHSA-2016:0001</id>
+    <title>Important: pulp security update</title>
+    <severity>Important</severity>
+    <issued date="2016-01-01 00:00:00"/>
+    <updated date="1454284800"/>
+    <summary>An update for pulp</summary>
+    <description>Fixes things &amp; stuff</description>
+    <pushcount>3</pushcount>
+    <reboot_suggested>True</reboot_suggested>
+    <references>
+      <reference href="https://example.com/1" id="1" title="CVE-1" type="cve"/>
+    </references>
+    <pkglist>
+      <collection short="el7">
+        <name>Enterprise 7</name>
+        <package name="pulp" epoch="0" version="1.0" release="1" arch="noarch" src="pulp.src.rpm">
+          <filename>pulp-1.0-1.noarch.rpm</filename>
+          <sum type="sha256">abc</sum>
+        </package>
+      </collection>
+    </pkglist>
+  </update>
+</updates>
+'''
+
+
+class UpdateinfoTests(TestCase):
+    def setUp(self):
+        self.repository = models.RPMRepositoryProxy.objects.create(slug='updateinfo')
+
+    def load(self, data, **kwargs):
+        return load_updateinfo(self.repository, BytesIO(data), **kwargs)
+
+    def render(self):
+        return ''.join(render_updateinfo(self.repository)).encode('utf8')
+
+    def assertRoundTrip(self, data):
+        self.assertEqual(self.load(data), UpdateinfoLoaded(1, 0, 0, 0))
+        rendered = self.render()
+        # loading what was rendered doesn't change anything, and renders the same again
+        self.assertEqual(self.load(rendered), UpdateinfoLoaded(0, 0, 1, 0))
+        self.assertEqual(self.render(), rendered)
+        return rendered
+
+    def test_minimal(self):
+        rendered = self.assertRoundTrip(MINIMAL)
+        errata = models.Errata.objects.get()
+        self.assertIsNone(errata.issued)
+        self.assertIsNone(errata.updated)
+        self.assertNotIn(b'<issued', rendered)
+        package = models.ErrataPackage.objects.get()
+        self.assertEqual((package.name, package.sum, package.filename), ('pulp', '', ''))
+
+    def test_full(self):
+        rendered = self.assertRoundTrip(FULL)
+        errata = models.Errata.objects.get()
+        self.assertEqual(errata.issued, datetime.datetime(2016, 1, 1, tzinfo=timezone.utc))
+        self.assertEqual(errata.updated, datetime.datetime(2016, 2, 1, tzinfo=timezone.utc))
+        self.assertEqual(errata.pushcount, 3)
+        self.assertTrue(errata.reboot_suggested)
+        self.assertIn(b'<issued date="2016-01-01 00:00:00"/>', rendered)
+        self.assertIn(b'<updated date="2016-02-01 00:00:00"/>', rendered)
+        self.assertIn(b'Fixes things &amp; stuff', rendered)
+        self.assertIn(b'<sum type="sha256">abc</sum>', rendered)
+
+    def test_changed_and_removed(self):
+        self.load(FULL)
+        changed = FULL.replace(b'1454284800', b'1454371200')
+        self.assertEqual(self.load(changed), UpdateinfoLoaded(0, 1, 0, 0))
+        self.assertEqual(self.load(MINIMAL, remove_missing=True), UpdateinfoLoaded(1, 0, 0, 1))
+        self.assertEqual(list(models.Errata.objects.values_list('slug', flat=True)),
+                         ['MINIMAL-1'])
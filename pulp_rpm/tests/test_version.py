@@ -0,0 +1,90 @@
+from io import StringIO
+
+from django.core.management import call_command
+from django.test import SimpleTestCase, TestCase
+
+from pulp_rpm.models import RPM
+from pulp_rpm.tests.test_models import make_rpm
+from pulp_rpm.version import evr_sort_index, sort_index
+
+# (a, b, rpmvercmp(a, b)), mostly from rpm's own rpmvercmp tests
+RPMVERCMP = [
+    ('1.0', '1.0', 0),
+    ('1.0', '2.0', -1),
+    ('2.0.1', '2.0', 1),
+    ('2.0.1a', '2.0.1', 1),
+    ('2.0a', '2.0.1', -1),
+    ('5.5p1', '5.5p2', -1),
+    ('5.5p10', '5.5p2', 1),
+    ('10xyz', '10.1xyz', -1),
+    ('xyz10', 'xyz10.1', -1),
+    ('xyz.4', '8', -1),
+    ('1.01', '1.1', 0),
+    ('1.010', '1.01', 1),
+    ('1.0', '1_0', 0),
+    ('1.0', '1..0', 0),
+    ('FC5', 'fc4', -1),
+    ('a', 'ab', -1),
+    ('b', 'ab', 1),
+    ('1.0~rc1', '1.0', -1),
+    ('1.0~rc1', '1.0~rc2', -1),
+    ('1.0~rc1', '1.0~rc1', 0),
+    ('1.0~~', '1.0~', -1),
+    ('1.0^', '1.0', 1),
+    ('1.0^git1', '1.0.1', -1),
+    ('1.0^git1', '1.0^git2', -1),
+    ('1.0^git1', '1.0~rc1', 1),
+    ('9', '10', -1),
+    ('99999999999999999999', '100000000000000000000', -1),
+]
+
+
+def cmp(a, b):
+    return (a > b) - (a < b)
+
+
+class SortIndexTests(SimpleTestCase):
+    def test_rpmvercmp(self):
+        for a, b, expected in RPMVERCMP:
+            self.assertEqual(cmp(sort_index(a), sort_index(b)), expected, (a, b))
+            self.assertEqual(cmp(sort_index(b), sort_index(a)), -expected, (b, a))
+
+    def test_sorted(self):
+        versions = ['1.0~rc1', '1.0', '1.0^git1', '1.0.1', '1.0a', '1.2', '1.10', 'abc']
+        self.assertEqual(sorted(reversed(versions), key=sort_index),
+                         ['abc', '1.0~rc1', '1.0', '1.0^git1', '1.0a', '1.0.1', '1.2', '1.10'])
+
+    def test_charset(self):
+        # only digits and lowercase letters, which collate the same in every locale
+        self.assertRegex(sort_index('1.2~Rc^Git_3'), r'^[0-9a-z]+$')
+
+    def test_empty(self):
+        self.assertEqual(sort_index(''), sort_index(None))
+        self.assertLess(sort_index(''), sort_index('0'))
+
+    def test_too_long(self):
+        with self.assertRaises(ValueError):
+            sort_index('1' * 100)
+
+    def test_evr(self):
+        self.assertEqual(evr_sort_index(None, '1.0', '1'), evr_sort_index('0', '1.0', '1'))
+        # epoch wins over everything else
+        self.assertLess(evr_sort_index('0', '9.0', '9'), evr_sort_index('1', '1.0', '1'))
+
+
+class RebuildSortIndexesTests(TestCase):
+    def test_rebuild(self):
+        rpms = [make_rpm(version=version) for version in ('1.0', '1.10', '1.2')]
+        current = make_rpm(name='current')
+        RPM.objects.filter(pk__in=[rpm.pk for rpm in rpms]).update(
+            epoch_sort_index='', version_sort_index='', release_sort_index='')
+        out = StringIO()
+        call_command('rebuild_sort_indexes', chunk_size=2, stdout=out)
+        self.assertIn('Updated sort indexes for 3 rpm rows', out.getvalue())
+        for rpm in rpms + [current]:
+            rpm.refresh_from_db()
+            self.assertEqual(
+                (rpm.epoch_sort_index, rpm.version_sort_index, rpm.release_sort_index),
+                evr_sort_index(rpm.epoch, rpm.version, rpm.release))
+        versions = RPM.objects.filter(name='pulp').order_by('version_sort_index')
+        self.assertEqual([rpm.version for rpm in versions], ['1.0', '1.2', '1.10'])
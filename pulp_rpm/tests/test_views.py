@@ -0,0 +1,81 @@
+import json
+
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIClient
+
+from pulp.models import Repository
+from pulp_rpm.tests.test_models import make_rpm
+
+RPMS = '/api/v3/content/rpm/'
+
+
+class RPMListTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.repository = Repository.objects.create(slug='rpms')
+
+    def get(self, url):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def test_pages(self):
+        # pages are in NEVRA order, and units with the same NEVRA are all listed
+        rpms = [make_rpm(name=name, checksum='{}{}'.format(name, i))
+                for i, name in enumerate(['b', 'a', 'c', 'a', 'b'])]
+        expected = [rpm.checksum for rpm in sorted(rpms, key=lambda rpm: (rpm.name, rpm.pk))]
+        url = RPMS + '?page_size=2'
+        checksums = []
+        while url:
+            data = self.get(url)
+            self.assertLessEqual(len(data['results']), 2)
+            checksums.extend(unit['checksum'] for unit in data['results'])
+            url = data['next']
+        self.assertEqual(checksums, expected)
+
+    def test_filters(self):
+        rpms = [make_rpm(name='pulp', version=str(version)) for version in range(3)]
+        make_rpm(name='other')
+        self.repository.add_units(*rpms[:2])
+        data = self.get(RPMS + '?repository=rpms')
+        self.assertEqual(sorted(unit['version'] for unit in data['results']), ['0', '1'])
+        data = self.get(RPMS + '?name=pulp&version=2')
+        self.assertEqual([unit['version'] for unit in data['results']], ['2'])
+
+    def test_repositories(self):
+        rpm = make_rpm()
+        self.repository.add_units(rpm)
+        data = self.get(RPMS)
+        self.assertEqual(len(data['results'][0]['repositories']), 1)
+        self.assertTrue(data['results'][0]['repositories'][0].endswith('/repositories/rpms/'))
+
+    def list_queries(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.get(RPMS)
+        return len(queries)
+
+    def test_queries(self):
+        # the number of queries doesn't grow with the number of units listed
+        self.repository.add_units(make_rpm(version='0'))
+        one = self.list_queries()
+        self.repository.add_units(*[make_rpm(version=str(version)) for version in range(1, 6)])
+        self.assertEqual(one, self.list_queries())
+
+
+class RepositoryExportTests(TestCase):
+    def test_export(self):
+        repository = Repository.objects.create(slug='exported')
+        rpms = [make_rpm(version=str(version)) for version in range(3)]
+        make_rpm(name='elsewhere')
+        repository.add_units(*rpms)
+        response = APIClient().get('/api/v3/repositories/exported/export/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        lines = b''.join(response.streaming_content).decode('utf8').splitlines()
+        units = [json.loads(line) for line in lines]
+        # every unit, with its detail fields
+        self.assertEqual(sorted(unit['version'] for unit in units), ['0', '1', '2'])
+        self.assertEqual(set(unit['uuid'] for unit in units), set(str(rpm.pk) for rpm in rpms))
+        self.assertTrue(all(unit['content_type'] == 'rpm' for unit in units))
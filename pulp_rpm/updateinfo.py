@@ -0,0 +1,335 @@
+import datetime
+from collections import namedtuple
+from io import StringIO
+from itertools import groupby
+from operator import itemgetter
+from xml.etree import ElementTree
+from xml.sax.saxutils import XMLGenerator
+
+from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+from pulp.models import BULK_CHUNK_SIZE, get_content_type
+from pulp.utils import stream_rows
+from pulp_rpm import models
+from pulp_rpm.xmlgen import drain, write_text
+
+# Result of load_updateinfo, counting errata by what happened to them
+UpdateinfoLoaded = namedtuple('UpdateinfoLoaded', ('added', 'changed', 'unchanged', 'removed'))
+
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# Fields read from and written to the text of the same-named child elements of <update>
+ERRATA_TEXT_FIELDS = ('title', 'severity', 'release', 'rights', 'summary', 'description',
+                      'solution')
+
+# Columns of the ordered queries that render_updateinfo merges together. The first column of
+# each is the errata pk, which they're all ordered by.
+ERRATA_COLUMNS = ('pk', 'slug', 'errata_from', 'type', 'version', 'issued', 'updated',
+                  'pushcount', 'reboot_suggested') + ERRATA_TEXT_FIELDS
+REFERENCE_COLUMNS = ('errata', 'key', 'value', 'href', 'type')
+COLLECTION_COLUMNS = ('errata', 'pk', 'short', 'name')
+PACKAGE_COLUMNS = ('collection__errata', 'collection', 'name', 'epoch', 'version', 'release',
+                   'arch', 'src', 'filename', 'sum', 'sum_type')
+
+# Every model written by load_updateinfo, in insert order, parents before children
+LOAD_ORDER = (models.Errata, models.ErrataReference, models.ErrataCollection,
+              models.ErrataPackage)
+
+
+class ErrataWriter(object):
+    # Collects parsed errata and everything in them, and writes them chunk_size errata at a
+    # time: one delete for the changed errata being replaced, then one bulk_create per table
+    def __init__(self, chunk_size=BULK_CHUNK_SIZE):
+        self.chunk_size = chunk_size
+        self.replaced = []
+        self.pending = dict((model, []) for model in LOAD_ORDER)
+
+    def add(self, instances, replaces=None):
+        if replaces is not None:
+            self.replaced.append(replaces)
+        for instance in instances:
+            self.pending[type(instance)].append(instance)
+        if len(self.pending[models.Errata]) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if self.replaced:
+            models.Errata.objects.filter(pk__in=self.replaced).delete()
+            self.replaced = []
+        for model in LOAD_ORDER:
+            if self.pending[model]:
+                model.objects.bulk_create(self.pending[model])
+                self.pending[model] = []
+
+
+def load_updateinfo(repository, source, remove_missing=False, chunk_size=BULK_CHUNK_SIZE):
+    # Bring repository's errata in line with the updateinfo.xml in source (a filename or file
+    # object), parsed one <update> at a time so memory use doesn't depend on the document size.
+    # Errata already in the repository with the same id and updated date are left alone.
+    # Changed errata are deleted and inserted again (with the same pk) with everything in them,
+    # which is simpler and faster for big pkglists than diffing the pkglists. Errata in the
+    # repository but not in source are deleted with remove_missing. All of the writes are
+    # bulk, chunk_size errata at a time, in one transaction, which finishes by linking the
+    # new errata packages to the repository's RPMs. Returns an UpdateinfoLoaded.
+    # The Errata table only has one "updated" per errata, so that's all that's compared.
+    existing = dict(
+        (slug, (pk, updated)) for pk, slug, updated in
+        models.Errata.objects.filter(repository_id=repository.pk).values_list(
+            'pk', 'slug', 'updated')
+    )
+    seen = set()
+    added = changed = unchanged = 0
+
+    with transaction.atomic():
+        writer = ErrataWriter(chunk_size)
+        root = None
+        for event, element in ElementTree.iterparse(source, events=('start', 'end')):
+            if root is None:
+                root = element
+                continue
+            if event != 'end' or element.tag != 'update':
+                continue
+            slug = _text(element, 'id')
+            if slug in seen:
+                # a repeated id would be added twice, which the (repository, slug) unique
+                # constraint won't allow, so only the first one counts
+                root.clear()
+                continue
+            seen.add(slug)
+            updated = _date(element, 'updated') or _date(element, 'issued')
+            pk, existing_updated = existing.get(slug, (None, None))
+            if pk is not None and existing_updated == updated:
+                unchanged += 1
+            else:
+                if pk is None:
+                    added += 1
+                else:
+                    changed += 1
+                writer.add(_parse_update(repository, element, pk), replaces=pk)
+            root.clear()
+        writer.flush()
+
+        removed = 0
+        if remove_missing:
+            missing = [pk for slug, (pk, updated) in existing.items() if slug not in seen]
+            for chunk_start in range(0, len(missing), chunk_size):
+                models.Errata.objects.filter(
+                    pk__in=missing[chunk_start:chunk_start + chunk_size]).delete()
+            removed = len(missing)
+
+        # link the new errata packages to the repository's RPMs
+        if added or changed:
+            models.ErrataPackage.objects.link_units([repository])
+
+    return UpdateinfoLoaded(added, changed, unchanged, removed)
+
+
+def _text(element, tag):
+    child = element.find(tag)
+    if child is None or child.text is None:
+        return ''
+    return child.text.strip()
+
+
+def _date(element, tag):
+    # updateinfo dates are in the date attr, usually "2017-01-01 00:00:00", but sometimes
+    # just a date, or seconds since the epoch. They're all UTC.
+    child = element.find(tag)
+    if child is None or not child.get('date'):
+        return None
+    value = child.get('date').strip()
+    if value.isdigit():
+        return datetime.datetime.fromtimestamp(int(value), timezone.utc)
+    parsed = parse_datetime(value)
+    if parsed is None:
+        date = parse_date(value)
+        if date is None:
+            raise ValueError('Unrecognized updateinfo date: {}'.format(value))
+        parsed = datetime.datetime(date.year, date.month, date.day)
+    if timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed, timezone.utc)
+    return parsed
+
+
+def _parse_update(repository, element, pk=None):
+    # Turns an <update> element into a list of unsaved instances: the Errata (using pk,
+    # if it's replacing an existing errata), then its references, collections, and packages
+    issued = _date(element, 'issued')
+    errata = models.Errata(
+        repository_id=repository.pk,
+        slug=_text(element, 'id'),
+        errata_from=element.get('from', ''),
+        type=element.get('type', ''),
+        version=element.get('version', ''),
+        issued=issued,
+        updated=_date(element, 'updated') or issued,
+        pushcount=int(_text(element, 'pushcount') or 0),
+        reboot_suggested=_text(element, 'reboot_suggested').lower() in ('true', '1'),
+        **dict((field, _text(element, field)) for field in ERRATA_TEXT_FIELDS)
+    )
+    if pk is not None:
+        errata.pk = pk
+    # XXX status isn't on the Errata model, so everything is rendered as "final"
+    instances = [errata]
+
+    # ErrataReference is a GenericKeyValueStore, related to its errata with both the errata FK
+    # and the generic relation. The reference id is the key and its title is the value.
+    # XXX ErrataReference has an integer pk, which ErrataReferenceAttributes can't relate to
+    # with its uuid object_id, so any other reference attrs are dropped.
+    errata_content_type = get_content_type(models.Errata)
+    reference_keys = set()
+    for child in element.iterfind('references/reference'):
+        key = child.get('id') or child.get('href', '')
+        if key in reference_keys:
+            # the unique constraint is on key, errata
+            continue
+        reference_keys.add(key)
+        instances.append(models.ErrataReference(
+            errata_id=errata.pk, content_type_id=errata_content_type.pk, object_id=errata.pk,
+            key=key, value=child.get('title', ''), href=child.get('href', ''),
+            type=child.get('type', '')))
+
+    for collection_element in element.iterfind('pkglist/collection'):
+        collection = models.ErrataCollection(errata_id=errata.pk,
+                                             short=collection_element.get('short', ''),
+                                             name=_text(collection_element, 'name'))
+        instances.append(collection)
+        for package in collection_element.iterfind('package'):
+            checksum = package.find('sum')
+            errata_package = models.ErrataPackage(
+                collection_id=collection.pk,
+                name=package.get('name', ''),
+                epoch=package.get('epoch', '0'),
+                version=package.get('version', ''),
+                release=package.get('release', ''),
+                arch=package.get('arch', ''),
+                src=package.get('src', ''),
+                filename=_text(package, 'filename'),
+                sum=checksum.text.strip() if checksum is not None and checksum.text else '',
+                sum_type=checksum.get('type', '') if checksum is not None else '',
+            )
+            # bulk_create doesn't call save, which normally does this
+            errata_package.set_sort_indexes()
+            instances.append(errata_package)
+    return instances
+
+
+class _Children(object):
+    # Walks an iterator of rows ordered by their first column (an errata pk), handing out the
+    # rows for one errata at a time, in the same order as the errata query
+    def __init__(self, rows):
+        self.groups = groupby(rows, key=itemgetter(0))
+        self.next_group = next(self.groups, None)
+
+    def take(self, errata_pk):
+        if self.next_group is None or self.next_group[0] != errata_pk:
+            return []
+        rows = list(self.next_group[1])
+        self.next_group = next(self.groups, None)
+        return rows
+
+
+def render_updateinfo(repository):
+    # Generate updateinfo.xml for repository as text, a chunk per errata. The errata, their
+    # references, collections, and packages each come from one query, all ordered by errata,
+    # read with server-side cursors and merged together here, so memory use is the same
+    # however many errata and packages there are.
+    # The cursors are all read in one transaction, which lasts as long as the rendering does
+    # (e.g. the whole streaming response), so close the generator if it isn't read to the end.
+    with transaction.atomic(using=repository._state.db):
+        for chunk in _render_updateinfo(repository):
+            yield chunk
+
+
+def _render_updateinfo(repository):
+    errata_rows = _ordered_rows(models.Errata.objects.filter(repository_id=repository.pk),
+                                'pk', ERRATA_COLUMNS)
+    references = _Children(_ordered_rows(
+        models.ErrataReference.objects.filter(errata__repository_id=repository.pk),
+        'errata', REFERENCE_COLUMNS))
+    collections = _Children(_ordered_rows(
+        models.ErrataCollection.objects.filter(errata__repository_id=repository.pk),
+        'errata', COLLECTION_COLUMNS))
+    packages = _Children(_ordered_rows(
+        models.ErrataPackage.objects.filter(collection__errata__repository_id=repository.pk),
+        'collection__errata', PACKAGE_COLUMNS))
+
+    out = StringIO()
+    xml = XMLGenerator(out, encoding='utf-8', short_empty_elements=True)
+    xml.startDocument()
+    xml.startElement('updates', {})
+    xml.ignorableWhitespace('\n')
+    yield drain(out)
+
+    for row in errata_rows:
+        errata = dict(zip(ERRATA_COLUMNS, row))
+        _write_update(xml, errata, references.take(errata['pk']),
+                      collections.take(errata['pk']), packages.take(errata['pk']))
+        yield drain(out)
+
+    xml.endElement('updates')
+    xml.ignorableWhitespace('\n')
+    xml.endDocument()
+    yield drain(out)
+
+
+def _ordered_rows(queryset, errata_field, columns):
+    # the pk is last in the ordering so that the row order is stable between runs
+    queryset = queryset.order_by(errata_field, 'pk').values_list(*columns)
+    return stream_rows(queryset)
+
+
+def _write_empty(xml, tag, attrs):
+    xml.startElement(tag, attrs)
+    xml.endElement(tag)
+
+
+def _write_update(xml, errata, references, collections, packages):
+    xml.startElement('update', {
+        'from': errata['errata_from'],
+        'status': 'final',
+        'type': errata['type'],
+        'version': errata['version'],
+    })
+    write_text(xml, 'id', errata['slug'])
+    for field in ERRATA_TEXT_FIELDS[:3]:
+        write_text(xml, field, errata[field])
+    for field in ('issued', 'updated'):
+        # both optional, so left out rather than written without a date
+        if errata[field] is not None:
+            _write_empty(xml, field, {'date': errata[field].strftime(DATE_FORMAT)})
+    for field in ERRATA_TEXT_FIELDS[3:]:
+        write_text(xml, field, errata[field])
+    write_text(xml, 'pushcount', str(errata['pushcount']))
+    if errata['reboot_suggested']:
+        write_text(xml, 'reboot_suggested', 'True')
+
+    xml.startElement('references', {})
+    for errata_pk, key, value, href, reference_type in references:
+        _write_empty(xml, 'reference', {'href': href, 'id': key, 'title': value,
+                                        'type': reference_type})
+    xml.endElement('references')
+
+    # packages are ordered by errata, then pk, so they're grouped by collection here
+    collection_packages = dict(
+        (collection_pk, list(rows)) for collection_pk, rows in
+        groupby(sorted(packages, key=itemgetter(1)), key=itemgetter(1)))
+    xml.startElement('pkglist', {})
+    for errata_pk, collection_pk, short, name in collections:
+        xml.startElement('collection', {'short': short})
+        write_text(xml, 'name', name)
+        for package in collection_packages.get(collection_pk, ()):
+            package = dict(zip(PACKAGE_COLUMNS, package))
+            xml.startElement('package', dict(
+                (field, package[field]) for field in
+                ('name', 'epoch', 'version', 'release', 'arch', 'src')))
+            write_text(xml, 'filename', package['filename'])
+            write_text(xml, 'sum', package['sum'], {'type': package['sum_type']})
+            xml.endElement('package')
+        xml.endElement('collection')
+    xml.endElement('pkglist')
+
+    xml.endElement('update')
+    xml.ignorableWhitespace('\n')
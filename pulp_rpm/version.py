@@ -0,0 +1,47 @@
+import re
+
+# rpmvercmp splits versions into runs of digits and runs of letters. Everything else is a
+# separator, except for ~ (sorts before anything, even the end of the version) and ^ (sorts
+# after the end of the version, but before anything else).
+SEGMENT_RE = re.compile(r'(~|\^|[0-9]+|[a-zA-Z]+)')
+
+# Each segment in a sort index starts with one of these, so that segments of different kinds
+# sort the same way rpmvercmp orders them. END terminates every sort index.
+TILDE = 'b'
+END = 'c'
+CARET = 'd'
+ALPHA = 'e'
+NUMERIC = 'f'
+
+
+def sort_index(version):
+    # Encode an RPM version, release, or epoch as a string that sorts the same way rpmvercmp
+    # compares them under plain string ordering, so the database can compare and sort versions
+    # with normal indexes on CharFields.
+    #
+    # Numeric segments are their digits without leading zeros, prefixed with the two digit
+    # number of digits, so that longer numbers sort after shorter ones. Alpha segments are
+    # two digits per letter (in ASCII order, like rpm's strcmp), terminated with a 0 so that
+    # "a" sorts before "ab". Sort indexes only ever contain digits and the lowercase letters
+    # above, which collate the same way in every postgres locale, not just "C".
+    encoded = []
+    for segment in SEGMENT_RE.findall(version or ''):
+        if segment == '~':
+            encoded.append(TILDE)
+        elif segment == '^':
+            encoded.append(CARET)
+        elif segment.isdigit():
+            digits = segment.lstrip('0')
+            if len(digits) > 99:
+                raise ValueError('Version segment too long to index: {}'.format(segment))
+            encoded.append('{}{:02d}{}'.format(NUMERIC, len(digits), digits))
+        else:
+            letters = ''.join('{:02d}'.format(ord(letter) - ord('A') + 10) for letter in segment)
+            encoded.append('{}{}0'.format(ALPHA, letters))
+    encoded.append(END)
+    return ''.join(encoded)
+
+
+def evr_sort_index(epoch, version, release):
+    # (epoch, version, release) sort indexes, for comparing as a row, with a missing epoch as 0
+    return sort_index(epoch or '0'), sort_index(version), sort_index(release)
@@ -1,11 +1,20 @@
+from pulp.pagination import KeysetPagination
 from pulp.views import ContentUnitViewSet, router
 from pulp_rpm import models, serializers
 
 
+class NEVRAPagination(KeysetPagination):
+    # NEVRA isn't unique on its own, so the unit PK breaks ties. RPMBase
+    # has an index on these fields in this order to page through.
+    ordering = models.RPMBase.NEVRA_FIELDS + ('contentunit_ptr',)
+
+
 # TODO: Magic trick: autogenerate viewsets by finding contentunit model classes
 class RPMViewSet(ContentUnitViewSet):
     queryset = models.RPM.objects.all()
     serializer_class = serializers.RPMSerializer
+    pagination_class = NEVRAPagination
+    filter_fields = models.RPM.NEVRA_FIELDS
 
 
 class SRPMViewSet(ContentUnitViewSet):
@@ -15,6 +24,8 @@ class SRPMViewSet(ContentUnitViewSet):
     """
     queryset = models.SRPM.objects.all()
     serializer_class = serializers.SRPMSerializer
+    pagination_class = NEVRAPagination
+    filter_fields = models.SRPM.NEVRA_FIELDS
 
 router.register(r'content/rpm', RPMViewSet)
 router.register(r'content/srpm', SRPMViewSet)
@@ -0,0 +1,15 @@
+# Helpers shared by the XMLGenerator-based metadata renderers (comps, updateinfo)
+
+
+def drain(out):
+    # Return what's been written to the StringIO out so far, and empty it
+    text = out.getvalue()
+    out.seek(0)
+    out.truncate()
+    return text
+
+
+def write_text(xml, tag, text, attrs=None):
+    xml.startElement(tag, attrs or {})
+    xml.characters(text)
+    xml.endElement(tag)
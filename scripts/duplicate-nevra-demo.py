@@ -4,33 +4,12 @@ import random
 import time
 
 from pulp_rpm.models import RPM, RPMRepositoryProxy
+from scripts.utils import timer
 
 # don't make more duplicates than this in a single repo
 repo_max_duplicates = 100
 
 
-# the actual duplicate nevra killer
-def duplicate_nevra_detector(repo):
-    print('Calculating duplicates for repo {}'.format(repo.slug), end='', flush=True)
-    seen_nevra = set()
-    duplicate_nevra = set()
-    # sift rpms to find duplicate nevra in a repo
-    for rpm in RPM.objects.filter(repositories=repo):
-        nevra = rpm.nevra_tuple
-        if nevra in seen_nevra:
-            duplicate_nevra.add(nevra)
-        else:
-            seen_nevra.add(nevra)
-    # get a list of packages matching this nevra sorted by their updated timestamp, descending (newest first)
-    removed_dupes = 0
-    for nevra in duplicate_nevra:
-        packages = RPM.objects.filter(repositories=repo, **nevra._asdict()).order_by('-repositorycontentunit__updated')
-        duplicates = packages[1:]
-        repo.remove_units(*duplicates)
-        removed_dupes += len(duplicates)
-    print(': removed {} duplicate RPMs.'.format(removed_dupes))
-
-
 def run():
     print('Creating duplicate NEVRA in all repos')
     # stash the duplicates we create in a set of dupe tuples for later assertion
@@ -68,8 +47,9 @@ def run():
 
     # run it!
     print('Destroying duplicate NEVRA in all repos')
-    for repo in RPMRepositoryProxy.objects.all():
-        duplicate_nevra_detector(repo)
+    with timer:
+        removed_dupes = RPMRepositoryProxy.objects.all().remove_duplicate_nevra()
+    print('Removed {} duplicate RPMs.'.format(removed_dupes))
 
     print('Asserting no duplicates remain')
     for repo, old_pks, new_pk in dupe_map:
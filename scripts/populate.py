@@ -68,11 +68,8 @@ def run():
     # This bit is special: Associate all rpms with the first repo,
     # for maximum relational query fun
     
-    num_units = platform.ContentUnit.objects.count() 
     repo = globals()['repository0']
-    bar = Bar('Adding all units to {} repo'.format(repo.slug))
-    bar.max = num_units
-    for unit in platform.ContentUnit.objects.all():
-        repo.add_units(unit)
-        bar.next()
-    bar.finish()
+    print('Adding all units to {} repo'.format(repo.slug))
+    added, skipped = platform.RepositoryContentUnit.objects.associate(
+        repo, platform.ContentUnit.objects.all())
+    print('Added {} units, {} already present'.format(added, skipped))